@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+import queue
+import time
+from collections import deque
+
+from PyQt5.QtCore import QThread, pyqtSignal
+
+CHUNK_SIZE = 500 * 1024   # 500KB mỗi chunk
+WINDOW = 8                # số chunk gửi đi mà chưa nhận FILE_CHUNK_RECEIVED
+ACK_TIMEOUT = 15.0        # giây chờ ack trước khi gửi lại chunk
+MAX_RETRIES = 5           # số lần gửi lại tối đa cho một chunk
+MAX_END_ROUNDS = 3        # số lần SEND_FILE_END được trả về missing_chunks
+
+
+class UploadFailed(Exception):
+    pass
+
+
+class ChunkUploadWorker(QThread):
+    """Upload một file qua server bằng SEND_FILE_START / SEND_FILE_CHUNK / SEND_FILE_END.
+
+    Chạy trên thread riêng, giữ tối đa `window` chunk chưa được ack: mỗi
+    FILE_CHUNK_RECEIVED mở chỗ cho chunk tiếp theo, FILE_CHUNK_ERROR hoặc hết
+    ACK_TIMEOUT thì gửi lại chunk đó. Chỉ gửi các chunk server chưa có (haveChunks).
+
+    Phản hồi của server đi qua NetworkWorker -> GUI thread, nên ChatWindow chuyển
+    chúng vào đây bằng on_server_message().
+    """
+    progress = pyqtSignal(int, int, float)   # acked_bytes, total_bytes, bytes/giây
+    upload_failed = pyqtSignal(str, str)     # client_msg_id, error
+
+    def __init__(self, network, file_path, file_name, client_msg_id, to_uid=None, group_id=None,
+                 chunk_size=CHUNK_SIZE, window=WINDOW):
+        super().__init__()
+        self.network = network
+        self.file_path = file_path
+        self.file_name = file_name
+        self.client_msg_id = client_msg_id
+        self.to_uid = to_uid
+        self.group_id = group_id
+        self.chunk_size = chunk_size
+        self.window = max(1, window)
+        self._inbox = queue.Queue()
+        self._cancelled = False
+
+    def on_server_message(self, data):
+        """Gọi từ GUI thread với các lệnh FILE_CHUNK_* / FILE_SENT của upload này."""
+        self._inbox.put(data)
+
+    def cancel(self):
+        self._cancelled = True
+        self._inbox.put(None)
+
+    def run(self):
+        try:
+            self._upload()
+        except UploadFailed as e:
+            self.upload_failed.emit(self.client_msg_id, str(e))
+        except Exception as e:
+            print(f"[Upload] Error sending file chunks: {e}")
+            self.upload_failed.emit(self.client_msg_id, str(e))
+
+    def _send(self, cmd):
+        if not self.network.send_data("CMD " + json.dumps(cmd)):
+            raise UploadFailed("connection_lost")
+
+    def _wait(self, timeout):
+        try:
+            data = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if self._cancelled:
+            raise UploadFailed("cancelled")
+        return data
+
+    def _upload(self):
+        file_size = os.path.getsize(self.file_path)
+        # sha256 cho phép server tiếp tục upload dở và dùng lại file đã gửi trong cuộc trò chuyện
+        digest = hashlib.sha256()
+        with open(self.file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+
+        start_cmd = {
+            'type': 'SEND_FILE_START',
+            'fileName': self.file_name,
+            'fileSize': file_size,
+            'chunkSize': self.chunk_size,
+            'sha256': digest.hexdigest(),
+            'clientMsgId': self.client_msg_id
+        }
+        if self.group_id:
+            start_cmd['groupId'] = self.group_id
+        else:
+            start_cmd['toUid'] = self.to_uid
+        self._send(start_cmd)
+
+        started = None
+        busy_retries = 0
+        deadline = time.monotonic() + ACK_TIMEOUT
+        while started is None:
+            data = self._wait(max(0.0, deadline - time.monotonic()))
+            if data is None:
+                raise UploadFailed("start_timeout")
+            if data.get('type') == 'FILE_CHUNK_ERROR':
+                # Pool ghi đĩa của server đang đầy: chờ retryAfterMs rồi gửi lại
+                if data.get('error') == 'busy' and busy_retries < MAX_RETRIES:
+                    busy_retries += 1
+                    self._backoff(data)
+                    self._send(start_cmd)
+                    deadline = time.monotonic() + ACK_TIMEOUT
+                    continue
+                raise UploadFailed(data.get('error') or 'start_failed')
+            if data.get('type') == 'FILE_CHUNK_STARTED':
+                started = data
+
+        # Server có thể chọn chunkSize khác (upload dở có sẵn)
+        self.chunk_size = started.get('chunkSize') or self.chunk_size
+        num_chunks = (file_size + self.chunk_size - 1) // self.chunk_size
+        have = set(started.get('haveChunks') or [])
+        pending = deque(i for i in range(num_chunks) if i not in have)
+        acked_bytes = sum(self._chunk_len(i, file_size) for i in have)
+        self.progress.emit(acked_bytes, file_size, 0.0)
+
+        with open(self.file_path, 'rb') as f:
+            for _ in range(MAX_END_ROUNDS):
+                acked_bytes = self._send_window(f, pending, file_size, acked_bytes)
+                self._send({'type': 'SEND_FILE_END', 'clientMsgId': self.client_msg_id})
+                while True:
+                    data = self._wait(ACK_TIMEOUT * 4)
+                    if data is None:
+                        raise UploadFailed("end_timeout")
+                    if data.get('type') == 'FILE_SENT':
+                        break
+                if data.get('ok'):
+                    return
+                if data.get('error') != 'missing_chunks':
+                    raise UploadFailed(data.get('error') or 'upload_failed')
+                pending.extend(data.get('missing') or [])
+        raise UploadFailed("missing_chunks")
+
+    def _backoff(self, data):
+        time.sleep(min(5000, data.get('retryAfterMs') or 500) / 1000.0)
+        if self._cancelled:
+            raise UploadFailed("cancelled")
+
+    def _chunk_len(self, index, file_size):
+        return min(self.chunk_size, file_size - index * self.chunk_size)
+
+    def _send_window(self, f, pending, file_size, acked_bytes):
+        in_flight = {}   # chunk_index -> thời điểm gửi
+        retries = {}
+        first_sent = None
+        sent_bytes_at_start = acked_bytes
+
+        def send_chunk(index):
+            f.seek(index * self.chunk_size)
+            header = {'type': 'SEND_FILE_CHUNK', 'chunkIndex': index, 'clientMsgId': self.client_msg_id}
+            if not self.network.send_chunk(header, f.read(self.chunk_size)):
+                raise UploadFailed("connection_lost")
+            in_flight[index] = time.monotonic()
+
+        def retry(index, reason):
+            retries[index] = retries.get(index, 0) + 1
+            if retries[index] > MAX_RETRIES:
+                raise UploadFailed(f"chunk {index}: {reason}")
+            in_flight.pop(index, None)
+            pending.appendleft(index)
+
+        while pending or in_flight:
+            if self._cancelled:
+                raise UploadFailed("cancelled")
+            while pending and len(in_flight) < self.window:
+                send_chunk(pending.popleft())
+                if first_sent is None:
+                    first_sent = time.monotonic()
+
+            data = self._wait(ACK_TIMEOUT)
+            if data is None:
+                # Không có ack nào trong ACK_TIMEOUT: gửi lại các chunk quá hạn
+                now = time.monotonic()
+                for index, sent_at in list(in_flight.items()):
+                    if now - sent_at >= ACK_TIMEOUT:
+                        retry(index, "timeout")
+                continue
+
+            cmd_type = data.get('type')
+            index = data.get('chunkIndex')
+            if cmd_type == 'FILE_CHUNK_RECEIVED' and index in in_flight:
+                del in_flight[index]
+                acked_bytes += self._chunk_len(index, file_size)
+                elapsed = time.monotonic() - first_sent
+                rate = (acked_bytes - sent_bytes_at_start) / elapsed if elapsed > 0 else 0.0
+                self.progress.emit(acked_bytes, file_size, rate)
+            elif cmd_type == 'FILE_CHUNK_ERROR':
+                if index is None:
+                    raise UploadFailed(data.get('error') or 'chunk_failed')
+                if index in in_flight:
+                    if data.get('error') == 'busy':
+                        self._backoff(data)
+                    retry(index, data.get('error') or 'chunk_failed')
+            elif cmd_type == 'FILE_SENT' and not data.get('ok'):
+                raise UploadFailed(data.get('error') or 'upload_failed')
+        return acked_bytes
@@ -25,6 +25,15 @@ except Exception:
     except Exception:
         API_KEY = None
 
+try:
+    from lib.resumable_upload import upload_blob
+except Exception:
+    import sys
+    _project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    if _project_root not in sys.path:
+        sys.path.insert(0, _project_root)
+    from lib.resumable_upload import upload_blob
+
 _BUCKET_CACHE = None
 
 def _get_storage_bucket():
@@ -90,7 +99,8 @@ def _get_storage_bucket():
         raise RuntimeError(f"Failed to initialize storage bucket '{bucket_name}': {e}")
 
 
-def upload_file_to_firebase_storage(file_path: str, conversation_id: str, id_token: str) -> tuple[str, str]:
+def upload_file_to_firebase_storage(file_path: str, conversation_id: str, id_token: str,
+                                    progress=None) -> tuple[str, str]:
 
     if not os.path.isfile(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
@@ -133,18 +143,10 @@ def upload_file_to_firebase_storage(file_path: str, conversation_id: str, id_tok
     blob_path = f"chat_files/{conversation_id}/{file_name}"
     
     try:
-        # Tạo blob
-        blob = bucket.blob(blob_path)
-        
-        # Upload file sử dụng SDK - tự xử lý mọi thứ
+        # File lớn đi qua resumable session: upload bị ngắt (kể cả khi tắt app) sẽ tiếp tục
+        # từ byte cuối cùng server đã nhận. ACL public đặt ngay khi tạo object.
         print(f"[Upload SDK] Đang upload: {file_name} ({content_type})...")
-        blob.upload_from_filename(file_path, content_type=content_type)
-        
-        # Make public để lấy link tải trực tiếp
-        blob.make_public()
-        
-        # Lấy public URL
-        file_url = blob.public_url
+        file_url = upload_blob(bucket, blob_path, file_path, content_type, progress=progress)
         
         print(f"[Upload SDK] Thành công: {file_url}")
         return file_url, content_type
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from PyQt5.QtCore import QObject, pyqtSignal
+
+# Số HEAD request chạy cùng lúc
+WORKERS = int(os.environ.get('CHAT_FILE_CHECK_WORKERS', '4'))
+# Kết quả được tin trong bao lâu: file còn tồn tại có thể bị xóa sau đó nên kiểm tra lại sớm hơn
+EXISTS_TTL = float(os.environ.get('CHAT_FILE_CHECK_TTL', str(6 * 3600)))
+MISSING_TTL = 7 * 24 * 3600
+CACHE_FILE = os.environ.get('CHAT_FILE_CHECK_FILE', '').strip() or \
+    os.path.join(os.path.expanduser('~'), '.qt5chat', 'file_checks.json')
+TIMEOUT = 10
+
+
+class FileChecker(QObject):
+    """Kiểm tra file tin nhắn còn trên Storage không, dùng chung cho cả cửa sổ chat.
+
+    check(urls) nhận cả một trang lịch sử: URL trùng, URL đang được kiểm tra và URL đã có
+    kết quả còn hạn đều bị bỏ qua; phần còn lại chạy HEAD trên thread pool với một
+    requests.Session dùng chung. Khi cả lô xong, checked phát một lần với {url: exists}.
+    Kết quả được lưu vào CACHE_FILE nên lần mở app sau không phải kiểm tra lại.
+    """
+
+    checked = pyqtSignal(dict)  # {file_url: exists}
+
+    def __init__(self, parent=None, path=CACHE_FILE):
+        super().__init__(parent)
+        self.path = path
+        self._lock = threading.Lock()
+        self._results = self._load()   # {file_url: [exists, checked_at]}
+        self._inflight = set()
+        # Một thread điều phối các lô (theo thứ tự), HEAD chạy trên pool WORKERS thread
+        self._dispatcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='file-check-batch')
+        self._pool = ThreadPoolExecutor(max_workers=max(1, WORKERS), thread_name_prefix='file-check')
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, WORKERS), pool_maxsize=max(1, WORKERS))
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict):
+            return {}
+        return {url: entry for url, entry in data.items() if isinstance(entry, list) and len(entry) == 2}
+
+    def _save(self):
+        now = time.time()
+        with self._lock:
+            data = {url: entry for url, entry in self._results.items() if self._fresh(entry, now)}
+        try:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"[FileCheck] Không lưu được kết quả kiểm tra: {e}")
+
+    @staticmethod
+    def _fresh(entry, now):
+        exists, checked_at = entry
+        return now - checked_at <= (EXISTS_TTL if exists else MISSING_TTL)
+
+    def is_missing(self, file_url):
+        """True nếu file đã được kiểm tra (còn hạn) và không còn tồn tại."""
+        with self._lock:
+            entry = self._results.get(file_url)
+        return entry is not None and not entry[0] and self._fresh(entry, time.time())
+
+    def check(self, file_urls):
+        """Kiểm tra một lô URL (ví dụ mọi file trong một trang lịch sử) ở nền.
+
+        Trả về {url: exists} các URL đã có kết quả còn hạn; checked sẽ phát cho phần còn lại.
+        """
+        now = time.time()
+        known = {}
+        todo = []
+        with self._lock:
+            for url in dict.fromkeys(u for u in file_urls if u):
+                entry = self._results.get(url)
+                if entry is not None and self._fresh(entry, now):
+                    known[url] = entry[0]
+                elif url not in self._inflight:
+                    self._inflight.add(url)
+                    todo.append(url)
+        if todo:
+            self._dispatcher.submit(self._check_batch, todo)
+        return known
+
+    def _check_batch(self, urls):
+        """Chạy trên thread điều phối: HEAD từng URL trên pool, rồi phát kết quả một lần."""
+        results = {}
+        try:
+            for url, exists in zip(urls, self._pool.map(self._exists, urls)):
+                if exists is not None:
+                    results[url] = exists
+        finally:
+            now = time.time()
+            with self._lock:
+                for url in urls:
+                    self._inflight.discard(url)
+                for url, exists in results.items():
+                    self._results[url] = [exists, now]
+        if results:
+            self._save()
+            self.checked.emit(results)
+
+    def _exists(self, file_url):
+        """True/False theo Storage; None khi lỗi mạng (không kết luận, lần sau kiểm tra lại)."""
+        try:
+            response = self._session.head(file_url, timeout=TIMEOUT, allow_redirects=True)
+            if response.status_code == 405:  # Method Not Allowed
+                response = self._session.get(file_url, timeout=TIMEOUT, stream=True)
+                response.close()
+            if response.status_code == 200:
+                return True
+            if response.status_code in (403, 404, 410):
+                return False
+            return None
+        except requests.exceptions.RequestException as e:
+            print(f"[FileCheck] Error checking file {file_url}: {e}")
+            return None
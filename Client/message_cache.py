@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+# Thư mục chứa cache tin nhắn, mỗi tài khoản một file SQLite
+CACHE_DIR = os.environ.get('CHAT_MESSAGE_CACHE_DIR', '').strip() or \
+    os.path.join(os.path.expanduser('~'), '.qt5chat', 'messages')
+# Số tin mới nhất giữ lại cho mỗi cuộc trò chuyện; tin cũ hơn tải lại từ server khi cuộn lên
+MAX_PER_CONVERSATION = int(os.environ.get('CHAT_MESSAGE_CACHE_MAX', '500'))
+
+
+def conversation_key(target_id, is_group):
+    return f"{'g' if is_group else 'u'}:{target_id}"
+
+
+class MessageCache:
+    """Lịch sử chat lưu trên đĩa để chuyển chat hiển thị ngay, chỉ hỏi server tin mới hơn.
+
+    Mỗi cuộc trò chuyện (conversation_key) là một đoạn tin liên tục, từ tin cũ nhất đã tải
+    tới tin mới nhất; chỉ các trang DM_HISTORY / GROUP_HISTORY nối liền với đoạn đó mới
+    được lưu, nên cursor tin mới nhất không bao giờ bỏ sót tin ở giữa.
+    """
+
+    def __init__(self, account, cache_dir=CACHE_DIR, max_per_conversation=MAX_PER_CONVERSATION):
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        name = hashlib.sha1((account or 'default').encode('utf-8')).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, f"{name}.db")
+        self.max_per_conversation = max(1, max_per_conversation)
+        try:
+            # Lịch sử chat là dữ liệu riêng tư: chỉ chủ tài khoản máy được đọc. File chính được
+            # tạo sẵn với 0600 nên SQLite tạo -wal/-shm cùng quyền đó; thư mục 0700 che cả
+            # các file cũ tạo trước khi có bản sửa này
+            os.chmod(cache_dir, 0o700)
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            for path in (self.path, self.path + '-wal', self.path + '-shm'):
+                if os.path.exists(path):
+                    os.chmod(path, 0o600)
+        except OSError:
+            pass
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            ' conv TEXT NOT NULL, id TEXT NOT NULL, ts INTEGER NOT NULL, payload TEXT NOT NULL,'
+            ' PRIMARY KEY (conv, id))'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS messages_ts ON messages (conv, ts, id)')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS conversations ('
+            ' conv TEXT PRIMARY KEY, me_uid TEXT, has_more INTEGER NOT NULL, updated REAL NOT NULL)'
+        )
+        self._conn.commit()
+
+    def load(self, conv):
+        """(messages tăng dần theo ts, me_uid, has_more) hoặc None nếu chưa có cache."""
+        row = self._conn.execute('SELECT me_uid, has_more FROM conversations WHERE conv = ?', (conv,)).fetchone()
+        if row is None:
+            return None
+        rows = self._conn.execute('SELECT payload FROM messages WHERE conv = ? ORDER BY ts, id',
+                                  (conv,)).fetchall()
+        if not rows:
+            return None
+        return [json.loads(payload) for (payload,) in rows], row[0], bool(row[1])
+
+    def newest(self, conv):
+        """Cursor (ts, id) của tin mới nhất trong cache, hoặc None."""
+        return self._conn.execute('SELECT ts, id FROM messages WHERE conv = ? ORDER BY ts DESC, id DESC LIMIT 1',
+                                  (conv,)).fetchone()
+
+    def _oldest(self, conv):
+        return self._conn.execute('SELECT ts, id FROM messages WHERE conv = ? ORDER BY ts, id LIMIT 1',
+                                  (conv,)).fetchone()
+
+    def store_page(self, conv, data):
+        """Lưu một trang lịch sử nếu nó nối liền với đoạn đã có; trả về True nếu đã lưu."""
+        messages = [m for m in data.get('messages', []) if m.get('id') and m.get('ts') is not None]
+        has_more = data.get('hasMore')
+        if data.get('after') is not None:
+            # Trang tin mới hơn: chỉ nối được khi cursor của nó không vượt quá tin mới nhất đã có
+            newest = self.newest(conv)
+            if newest is None or (data['after'], data.get('afterId', '')) > tuple(newest):
+                return False
+            has_more = None
+        elif data.get('before') is not None:
+            # Trang cũ hơn: phải bắt đầu ngay trước tin cũ nhất đã có
+            oldest = self._oldest(conv)
+            if oldest is None or (data['before'], data.get('beforeId', '')) != tuple(oldest):
+                return False
+        else:
+            # Trang mới nhất: thay toàn bộ đoạn cũ (có thể đã cách quãng)
+            self._conn.execute('DELETE FROM messages WHERE conv = ?', (conv,))
+        self._conn.executemany('INSERT OR REPLACE INTO messages (conv, id, ts, payload) VALUES (?, ?, ?, ?)',
+                               [(conv, m['id'], m['ts'], json.dumps(m)) for m in messages])
+        trimmed = self._conn.execute(
+            'DELETE FROM messages WHERE conv = ? AND rowid IN ('
+            ' SELECT rowid FROM messages WHERE conv = ? ORDER BY ts DESC, id DESC LIMIT -1 OFFSET ?)',
+            (conv, conv, self.max_per_conversation)).rowcount
+        if trimmed:
+            has_more = True
+        if has_more is None:
+            self._conn.execute('UPDATE conversations SET updated = ? WHERE conv = ?', (time.time(), conv))
+        else:
+            self._conn.execute(
+                'INSERT INTO conversations (conv, me_uid, has_more, updated) VALUES (?, ?, ?, ?)'
+                ' ON CONFLICT (conv) DO UPDATE SET me_uid = COALESCE(excluded.me_uid, me_uid),'
+                ' has_more = excluded.has_more, updated = excluded.updated',
+                (conv, data.get('meUid'), 1 if has_more else 0, time.time()))
+        self._conn.commit()
+        return True
+
+    def forget(self, conv):
+        """Xóa cache của một cuộc trò chuyện (ví dụ sau khi rời nhóm)."""
+        self._conn.execute('DELETE FROM messages WHERE conv = ?', (conv,))
+        self._conn.execute('DELETE FROM conversations WHERE conv = ?', (conv,))
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -6,6 +6,7 @@ import os
 import requests
 import tempfile
 import base64
+import threading
 
 # Add parent directory to path for imports
 _parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -26,8 +27,10 @@ from widgets.file_message_widgets import (
     create_audio_widget,
     create_file_widget,
 )
+from widgets.message_list import MessageListModel, MessageListView, history_rows
 from voice.recorder import AudioRecorder, PYAUDIO_AVAILABLE
 from voice.player import VoicePlayer
+from lib.framing import LineFramer, FRAME_TEXT, UPGRADE_LINE, encode_frame, encode_data_frame
 try:
     from Client.video_call_ui import VideoCallWindow
 except Exception as e:
@@ -44,39 +47,45 @@ except Exception:
         from Client.client_upload import upload_file_to_firebase_storage
     except Exception:
         upload_file_to_firebase_storage = None
-
-# --- WORKER KIỂM TRA FILE TỒN TẠI ---
-class FileCheckWorker(QThread):
-    check_complete = pyqtSignal(object, bool, str)  # container, exists, file_url
-    
-    def __init__(self, file_url, container):
-        super().__init__()
-        self.file_url = file_url
-        self.container = container
-    
-    def run(self):
-        try:
-            response = requests.head(self.file_url, timeout=10, allow_redirects=True)
-            file_exists = response.status_code == 200
-            
-            if response.status_code == 405:  # Method Not Allowed
-                response = requests.get(self.file_url, timeout=10, stream=True)
-                file_exists = response.status_code == 200
-            
-            self.check_complete.emit(self.container, file_exists, self.file_url)
-        except requests.exceptions.RequestException as e:
-            # Nếu lỗi, coi như file không tồn tại
-            print(f"[FileCheck] Error checking file {self.file_url}: {e}")
-            self.check_complete.emit(self.container, False, self.file_url)
-        except Exception as e:
-            print(f"[FileCheck] Unexpected error: {e}")
-            self.check_complete.emit(self.container, False, self.file_url)
+try:
+    from upload_manager import UploadManager, UploadListWidget
+except Exception:
+    from Client.upload_manager import UploadManager, UploadListWidget
+try:
+    from file_check import FileChecker
+except Exception:
+    from Client.file_check import FileChecker
+try:
+    from message_cache import MessageCache, conversation_key
+except Exception:
+    from Client.message_cache import MessageCache, conversation_key
 
 # --- LỚP XỬ LÝ MẠNG (NETWORK WORKER) ---
+# Số lần thử kết nối lại sau khi mất kết nối (chờ 1s, 2s, 4s, ... tối đa 10s giữa các lần)
+RECONNECT_ATTEMPTS = 5
+# Khi bắt kịp tin nhắn bị lỡ, hỏi lùi lại chừng này ms so với cursor (ts của tin nhắn realtime là
+# ước lượng của server); các tin đã hiển thị được lọc theo id
+CATCHUP_SKEW_MS = 5000
+# Lệnh chỉ thêm tin vào cuối khung chat; trong một lô từ NetworkWorker chúng được gom
+# thành một lần insert vào model
+BATCHED_COMMANDS = ('DM', 'GROUP_MESSAGE', 'FILE_MESSAGE', 'PENDING')
+
+
+def shape_command(data):
+    """Chuẩn bị sẵn trên thread mạng những gì GUI thread cần cho lệnh (dòng cho model)."""
+    cmd_type = data.get('type')
+    if cmd_type in ('DM_HISTORY', 'GROUP_HISTORY') and data.get('ok', True):
+        data['rows'] = history_rows(data, cmd_type == 'GROUP_HISTORY')
+    return data
+
+
 class NetworkWorker(QThread):
-    message_received = pyqtSignal(str)
+    # Có lệnh mới trong hộp thư (take_commands); chỉ phát một lần cho tới khi GUI lấy hết,
+    # nên một loạt dòng đến dồn dập chỉ tốn một lần xử lý trên GUI thread
+    commands_ready = pyqtSignal()
     connection_lost = pyqtSignal()
     auth_successful = pyqtSignal()
+    reconnected = pyqtSignal(bool)  # True: phiên được resume bằng session ticket
 
     def __init__(self, host, port, id_token):
         super().__init__()
@@ -85,64 +94,190 @@ class NetworkWorker(QThread):
         self.id_token = id_token
         self.socket = None
         self.is_running = True
+        # Sau BINARY_OK: gửi binary frames (file chunk là bytes thô, không base64)
+        self.binary = False
+        self._send_lock = threading.Lock()
+        # Session ticket server gửi sau AUTH_OK (CMD SESSION), dùng cho RESUME khi kết nối lại
+        self.session_ticket = None
+        self._ticket_deadline = 0.0
+        # Lệnh đã giải mã (dict) hoặc dòng không phải CMD (str), chờ GUI thread lấy
+        self._inbox = []
+        self._inbox_signalled = False
+        self._inbox_lock = threading.Lock()
 
     def run(self):
-        try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.host, self.port))
-            
-            # Gửi handshake AUTH
-            auth_cmd = f"AUTH {self.id_token}\n"
-            self.socket.sendall(auth_cmd.encode('utf-8'))
-            
-            # Đọc phản hồi AUTH
-            buffer = b""
-            while b"\n" not in buffer:
-                chunk = self.socket.recv(1024)
-                if not chunk: raise ConnectionError("Connection closed during auth")
-                buffer += chunk
-            
-            line, buffer = buffer.split(b"\n", 1)
-            response = line.decode('utf-8').strip()
-            
-            if response != "AUTH_OK":
-                print(f"Auth failed: {response}")
-                self.connection_lost.emit()
-                return
-            self.auth_successful.emit()
-            # Vòng lặp nhận tin nhắn chính
-            while self.is_running:
-                try:
-                    chunk = self.socket.recv(4096)
-                    if not chunk:
-                        break
-                    buffer += chunk
-                    
-                    while b"\n" in buffer:
-                        line, buffer = buffer.split(b"\n", 1)
-                        text = line.decode('utf-8').strip()
-                        if text:
-                            self.message_received.emit(text)
-                except socket.timeout:
-                    continue
-                except Exception as e:
-                    print(f"Socket error: {e}")
+        first = True
+        retries = 0
+        while self.is_running:
+            try:
+                session = self._handshake()
+            except Exception as e:
+                print(f"Connection error: {e}")
+                if first or retries >= RECONNECT_ATTEMPTS or not self.is_running:
                     break
-                    
-        except Exception as e:
-            print(f"Connection error: {e}")
-        
+                retries += 1
+                time.sleep(min(2 ** (retries - 1), 10))
+                continue
+            if session is None:
+                # Server từ chối AUTH: không thử lại
+                break
+            framer, lines, resumed = session
+            retries = 0
+            if first:
+                self.auth_successful.emit()
+                first = False
+            else:
+                print(f"[Network] Đã kết nối lại ({'resume' if resumed else 'AUTH'})")
+                self.reconnected.emit(resumed)
+            # Server cũ trả về unknown_command và client tiếp tục dùng line protocol
+            self.send_data('CMD ' + json.dumps({'type': 'BINARY_UPGRADE', 'version': 1}))
+            # Các dòng đến cùng lúc với AUTH_OK
+            self._receive_loop(framer, lines)
+            if self.is_running:
+                print("[Network] Mất kết nối, đang kết nối lại...")
+                try:
+                    self.socket.close()
+                except Exception:
+                    pass
+
         self.connection_lost.emit()
 
+    def _open(self, hello):
+        """Mở kết nối mới, gửi dòng handshake và đọc phản hồi đầu tiên."""
+        sock = socket.create_connection((self.host, self.port), timeout=15)
+        sock.settimeout(None)
+        sock.sendall(hello.encode('utf-8'))
+        framer = LineFramer()
+        lines = []
+        while not lines:
+            lines = framer.recv_from(sock)
+            if lines is None:
+                sock.close()
+                raise ConnectionError("Connection closed during auth")
+        return sock, framer, lines, lines[0].decode('utf-8', errors='replace').strip()
+
+    def _handshake(self):
+        """RESUME bằng session ticket nếu còn hạn, ngược lại (hoặc bị từ chối) AUTH bằng ID token.
+
+        Trả về (framer, các dòng còn lại, resumed) hoặc None nếu AUTH bị từ chối.
+        """
+        with self._send_lock:
+            self.binary = False
+        if self.session_ticket and time.monotonic() < self._ticket_deadline:
+            sock, framer, lines, response = self._open(f"RESUME {self.session_ticket}\n")
+            if response == "AUTH_OK":
+                self.socket = sock
+                return framer, lines[1:], True
+            print(f"[Network] Không resume được phiên ({response}), xác thực lại bằng ID token")
+            sock.close()
+        self.session_ticket = None
+        sock, framer, lines, response = self._open(f"AUTH {self.id_token}\n")
+        if response != "AUTH_OK":
+            print(f"Auth failed: {response}")
+            sock.close()
+            return None
+        self.socket = sock
+        return framer, lines[1:], False
+
+    def _receive_loop(self, framer, lines):
+        """Vòng lặp nhận tin nhắn chính, đến khi socket đóng."""
+        while self.is_running:
+            try:
+                for line in lines:
+                    # Byte UTF-8 hỏng chỉ làm hỏng dòng đó, không làm rớt kết nối
+                    self._handle_line(line.decode('utf-8', errors='replace').strip())
+                lines = framer.recv_from(self.socket)
+                if lines is None:
+                    return
+            except socket.timeout:
+                lines = []
+                continue
+            except Exception as e:
+                print(f"Socket error: {e}")
+                return
+
+    def _handle_line(self, text):
+        """Giải mã một dòng ngay trên thread mạng; lệnh nội bộ xử lý tại chỗ, còn lại vào hộp thư."""
+        if not text:
+            return
+        if not text.startswith("CMD "):
+            self._deliver(text)
+            return
+        try:
+            data = json.loads(text[4:])
+        except Exception as e:
+            print(f"JSON parse error: {e}")
+            return
+        if not isinstance(data, dict):
+            return
+        cmd_type = data.get('type')
+        if cmd_type == 'BINARY_OK' and not self.binary:
+            self._switch_to_frames()
+            return
+        if cmd_type == 'SESSION' and data.get('ticket'):
+            self._take_session(data)
+            return
+        self._deliver(shape_command(data))
+
+    def _deliver(self, item):
+        with self._inbox_lock:
+            self._inbox.append(item)
+            if self._inbox_signalled:
+                return
+            self._inbox_signalled = True
+        self.commands_ready.emit()
+
+    def take_commands(self):
+        """Lấy hết lệnh đang chờ (gọi trên GUI thread khi nhận commands_ready)."""
+        with self._inbox_lock:
+            items, self._inbox = self._inbox, []
+            self._inbox_signalled = False
+        return items
+
+    def _take_session(self, data):
+        """Lưu session ticket từ CMD SESSION (không chuyển lên UI)."""
+        self.session_ticket = data['ticket']
+        # Trừ hao vài giây để không gửi ticket vừa hết hạn
+        self._ticket_deadline = time.monotonic() + max(0, int(data.get('expiresIn') or 0) - 5)
+
+    def _switch_to_frames(self):
+        with self._send_lock:
+            try:
+                self.socket.sendall(UPGRADE_LINE + b"\n")
+                self.binary = True
+            except Exception as e:
+                print(f"Send error: {e}")
+
     def send_data(self, data_str):
         if self.socket:
             try:
-                self.socket.sendall((data_str + "\n").encode('utf-8'))
+                data = data_str.encode('utf-8')
+                with self._send_lock:
+                    if self.binary:
+                        self.socket.sendall(encode_frame(FRAME_TEXT, data))
+                    else:
+                        self.socket.sendall(data + b"\n")
                 return True
             except Exception as e:
                 print(f"Send error: {e}")
         return False
 
+    def send_chunk(self, header, data):
+        """Gửi lệnh kèm dữ liệu thô (SEND_FILE_CHUNK): binary frame nếu có, ngược lại base64 trong JSON."""
+        if not self.socket:
+            return False
+        if not self.binary:
+            cmd = dict(header, chunkData=base64.b64encode(data).decode('utf-8'))
+            return self.send_data("CMD " + json.dumps(cmd))
+        try:
+            frame = encode_data_frame(header, data)
+            with self._send_lock:
+                self.socket.sendall(frame)
+            return True
+        except Exception as e:
+            print(f"Send error: {e}")
+        return False
+
     def stop(self):
         self.is_running = False
         if self.socket:
@@ -542,17 +677,43 @@ class ChatWindow(QWidget):
         self._uploading_file_name = None  
         self._upload_client_msg_id = None  
         
-        self._file_check_workers = []
-        
-        self._file_check_cache = {}  # {file_url: exists (bool)}
+        # Kiểm tra file còn trên Storage theo lô, kết quả có hạn và được lưu lại giữa các lần mở app
+        self.file_checker = FileChecker(self)
+        self.file_checker.checked.connect(self._on_files_checked)
+
+        # Tin mới đang gom trong lúc xử lý một lô lệnh từ server (None: ngoài lô)
+        self._message_batch = None
+
+        # Cache lịch sử chat trên đĩa: chuyển chat hiển thị ngay từ cache, chỉ tải tin mới hơn
+        try:
+            self.message_cache = MessageCache(self.current_user_email)
+        except Exception as e:
+            print(f"[Cache] Không mở được cache tin nhắn: {e}")
+            self.message_cache = None
+
+        # Phân trang lịch sử chat: tải trang cũ hơn khi cuộn lên đầu
+        self._history_cursor = None     # (ts, id) của tin cũ nhất đang hiển thị
+        self._history_has_more = False
+        self._history_loading = False
+        # Tin nhắn mới nhất đã thấy trong chat hiện tại: khi kết nối lại chỉ tải các tin sau nó
+        self._seen_cursor = None        # (ts, id)
+        self._shown_ids = set()
+        # Số tin chưa đọc theo bạn bè / nhóm (hiện cạnh tên trong danh sách)
+        self._unread = {}
         
         self.setup_ui()
         
         # Khởi động kết nối mạng
         self.network = NetworkWorker(self.host, self.port, self.id_token)
+        # Upload nhiều file song song, tiến độ hiển thị trong self.upload_list
+        self.upload_manager = UploadManager(self.network, self.send_command,
+                                            upload_file_to_firebase_storage, self.id_token, parent=self)
+        self.upload_list = UploadListWidget(self.upload_manager)
+        self.upload_panel_layout.addWidget(self.upload_list)
+        self.setAcceptDrops(True)
         self.connect_signals()
         # self.network.auth_successful.connect(self.on_auth_success)
-        # self.network.message_received.connect(self.handle_server_message)
+        # self.network.commands_ready.connect(self.handle_server_messages)
         # self.network.connection_lost.connect(self.handle_connection_lost)
         self.network.start()
 
@@ -698,15 +859,18 @@ class ChatWindow(QWidget):
         self.group_members_panel.hide()
         right_layout.addWidget(self.group_members_panel)
 
-        # Chat Area
-        self.message_area = QScrollArea()
-        self.message_area.setWidgetResizable(True)
-        self.message_container = QWidget()
-        self.message_layout = QVBoxLayout(self.message_container)
-        self.message_layout.setAlignment(Qt.AlignTop)
-        self.message_area.setWidget(self.message_container)
+        # Chat Area: model/view, chỉ vẽ các dòng đang hiển thị; widget file tạo khi cuộn tới
+        self.message_model = MessageListModel(self)
+        self.message_area = MessageListView(self._create_file_widget)
+        self.message_area.setModel(self.message_model)
+        self.message_area.verticalScrollBar().valueChanged.connect(self._on_message_scroll)
         right_layout.addWidget(self.message_area)
 
+        # Danh sách file đang upload (UploadListWidget, thêm sau khi tạo UploadManager)
+        self.upload_panel_layout = QVBoxLayout()
+        self.upload_panel_layout.setContentsMargins(0, 0, 0, 0)
+        right_layout.addLayout(self.upload_panel_layout)
+
         # Emoji Picker component
         self.emoji_picker = EmojiPicker(self)
         self.emoji_picker.emoji_selected.connect(self.insert_emoji)
@@ -849,8 +1013,9 @@ class ChatWindow(QWidget):
     def connect_signals(self):
         # Kết nối sự kiện AUTH thành công
         self.network.auth_successful.connect(self.on_auth_success)
-        self.network.message_received.connect(self.handle_server_message)
+        self.network.commands_ready.connect(self.handle_server_messages)
         self.network.connection_lost.connect(self.handle_connection_lost)
+        self.network.reconnected.connect(self.on_reconnected)
         self.btn_tab_user.clicked.connect(self.load_users)
         self.btn_tab_group.clicked.connect(self.load_groups)
 
@@ -859,21 +1024,70 @@ class ChatWindow(QWidget):
         print("[Network] Xác thực socket thành công. Đang tải danh sách bạn bè...")
         self.send_command({'type': 'LIST_FRIENDS'})
 
+    def on_reconnected(self, resumed):
+        """Kết nối lại sau khi mất mạng: chỉ tải các tin nhắn bị lỡ của chat đang mở.
+
+        Phiên resume giữ nguyên danh sách bạn bè/nhóm đang hiển thị; nếu phải AUTH lại
+        từ đầu thì tải lại danh sách bạn bè.
+        """
+        self.upload_manager.on_reconnected()
+        if not resumed:
+            self.send_command({'type': 'LIST_FRIENDS'})
+        if not self.current_chat_uid:
+            return
+        key = 'groupId' if self.current_chat_is_group else 'peerUid'
+        cmd = {'type': 'LOAD_GROUP_HISTORY' if self.current_chat_is_group else 'LOAD_THREAD',
+               key: self.current_chat_uid, 'limit': 50}
+        if self._seen_cursor:
+            cmd['after'] = max(1, self._seen_cursor[0] - CATCHUP_SKEW_MS)
+            cmd['afterId'] = ''
+        else:
+            self._history_loading = True
+        self.send_command(cmd)
+
+    def _note_seen(self, ts, msg_id):
+        """Ghi nhận một tin nhắn của chat hiện tại đã hiển thị (cursor cho lần kết nối lại)."""
+        if not ts or not msg_id:
+            return
+        self._shown_ids.add(msg_id)
+        if self._seen_cursor is None or (ts, msg_id) > self._seen_cursor:
+            self._seen_cursor = (ts, msg_id)
+
     def send_command(self, cmd_dict):
         """Gửi lệnh JSON xuống socket"""
         cmd_str = "CMD " + json.dumps(cmd_dict)
         self.network.send_data(cmd_str)
 
-    def handle_server_message(self, text):
-        """Router xử lý các tin nhắn từ server"""
-        if text.startswith("CMD "):
-            try:
-                data = json.loads(text[4:])
-                self.process_command(data)
-            except Exception as e:
-                print(f"JSON parse error: {e}")
-        else:
-            print(f"Server: {text}")
+    def handle_server_messages(self):
+        """Router xử lý các lệnh từ server (đã được NetworkWorker giải mã), cả lô một lần.
+
+        Tin mới cho chat đang mở được gom lại và thêm vào model một lần ở cuối lô.
+        """
+        self._message_batch = []
+        try:
+            for item in self.network.take_commands():
+                if isinstance(item, str):
+                    print(f"Server: {item}")
+                    continue
+                if item.get('type') not in BATCHED_COMMANDS:
+                    # Giữ đúng thứ tự với các lệnh đụng tới khung chat theo cách khác
+                    self._flush_message_batch()
+                try:
+                    self.process_command(item)
+                except Exception as e:
+                    print(f"Command error ({item.get('type')}): {e}")
+        finally:
+            self._flush_message_batch()
+            self._message_batch = None
+
+    def _flush_message_batch(self):
+        rows = self._message_batch
+        if not rows:
+            return
+        self._message_batch = []
+        self.message_model.append_messages(rows)
+        self.message_area.scrollToBottom()
+        self._check_files_exist([r['fileURL'] for r in rows if r.get('fileURL')])
 
     def handle_connection_lost(self):
         QMessageBox.critical(self, "Lỗi", "Mất kết nối đến server!")
@@ -912,41 +1126,41 @@ class ChatWindow(QWidget):
             sender_uid = data.get('fromUid')
             text = data.get('text')
             if sender_uid == self.current_chat_uid:
+                if data.get('messageId') in self._shown_ids:
+                    return
                 self.add_message_bubble(text, is_self=False)
+                self._note_seen(data.get('ts'), data.get('messageId'))
             else:
-                # TODO: Hiển thị notif
-                pass
+                self._mark_unread(sender_uid)
+
+        elif cmd_type == 'GROUP_MESSAGE':
+            group_id = data.get('groupId')
+            if self.current_chat_is_group and group_id == self.current_chat_uid:
+                if data.get('messageId') in self._shown_ids:
+                    return
+                self.add_message_bubble(data.get('text'), is_self=False)
+                self._note_seen(data.get('ts'), data.get('messageId'))
+            else:
+                self._mark_unread(group_id)
+
+        elif cmd_type == 'PENDING':
+            # Tin nhắn đến khi đang offline, server gửi một lần ngay sau AUTH_OK
+            events = data.get('events', [])
+            print(f"[System] {len(events)} tin nhắn đến khi offline"
+                  + (" (đã bỏ bớt tin cũ)" if data.get('truncated') else ""))
+            for event in events:
+                if isinstance(event, dict) and event.get('type') != 'PENDING':
+                    self.process_command(event)
+
+        elif cmd_type in ('DM_DELIVERED', 'GROUP_MESSAGE_DELIVERED'):
+            # Tin của mình đã hiển thị ngay khi gửi; ghi lại id để không hiện lại khi bắt kịp
+            if data.get('ok'):
+                self._note_seen(data.get('ts'), data.get('messageId'))
 
         elif cmd_type == 'DM_HISTORY':
-            # Nhận lịch sử chat
-            msgs = data.get('messages', [])
-            me_uid = data.get('meUid')
-            # Lưu UID của chính mình nếu chưa có
-            if me_uid and not self.current_user_uid:
-                self.current_user_uid = me_uid
-            
-            # Xóa chat cũ
-            for i in reversed(range(self.message_layout.count())): 
-                self.message_layout.itemAt(i).widget().setParent(None)
-            
-            for m in msgs:
-                is_me = (m.get('senderUid') == me_uid)
-                # Kiểm tra nếu là message có file
-                if m.get('fileURL'):
-                    file_url = m.get('fileURL', '')
-                    # Kiểm tra cache trước - nếu file đã biết là không tồn tại thì bỏ qua
-                    if file_url in self._file_check_cache and not self._file_check_cache[file_url]:
-                        # File đã được kiểm tra và không tồn tại - bỏ qua message này
-                        print(f"[FileCheck] Bỏ qua message với file không tồn tại (từ cache): {file_url}")
-                        continue
-                    
-                    self.add_file_message({
-                        'fileType': m.get('fileType', 'application'),
-                        'fileURL': file_url,
-                        'fileName': m.get('fileName', 'Unknown')
-                    }, is_self=is_me)
-                else:
-                    self.add_message_bubble(m.get('text'), is_self=is_me)
+            # Nhận lịch sử chat (một trang)
+            self._cache_history_page(data, is_group=False)
+            self._show_history_page(data, is_group=False)
         
         elif cmd_type == 'FILE_MESSAGE':
             # Nhận file message từ người khác
@@ -955,16 +1169,30 @@ class ChatWindow(QWidget):
             file_name = data.get('fileName', 'Unknown')
             file_type = data.get('fileType', 'application')
             
-            if sender_uid == self.current_chat_uid or (self.current_chat_is_group and data.get('groupId') == self.current_chat_uid):
+            group_id = data.get('groupId')
+            if (not group_id and sender_uid == self.current_chat_uid) or (self.current_chat_is_group and group_id == self.current_chat_uid):
+                if data.get('messageId') in self._shown_ids:
+                    return
                 self.add_file_message({
                     'fileType': file_type,
                     'fileURL': file_url,
                     'fileName': file_name
                 }, is_self=False)
+                self._note_seen(data.get('ts'), data.get('messageId'))
+            else:
+                self._mark_unread(group_id or sender_uid)
+        
+        elif cmd_type in ('FILE_CHUNK_STARTED', 'FILE_CHUNK_RECEIVED', 'FILE_CHUNK_ERROR'):
+            self.upload_manager.on_server_message(data)
         
         elif cmd_type == 'FILE_SENT':
             # Response từ server khi upload thành công
             client_msg_id = data.get('clientMsgId', '')
+            if data.get('ok') and data.get('messageId'):
+                # File của mình hiển thị ngay; không hiện lại khi bắt kịp sau kết nối lại
+                self._shown_ids.add(data['messageId'])
+            if self.upload_manager.on_server_message(data):
+                return
             
             # Đóng loading dialog
             self._hide_upload_progress()
@@ -1004,8 +1232,7 @@ class ChatWindow(QWidget):
                 
                 print(f"[File] Upload thành công: {file_url}")
                 # Cuộn xuống cuối
-                QApplication.processEvents()
-                self.message_area.verticalScrollBar().setValue(self.message_area.verticalScrollBar().maximum())
+                self.message_area.scrollToBottom()
             else:
                 error_msg = data.get('error', 'Unknown error')
                 QMessageBox.warning(self, "Lỗi", f"Không thể upload file: {error_msg}")
@@ -1033,41 +1260,9 @@ class ChatWindow(QWidget):
                     self.create_group_window.show_group_created(success=False, error_msg=error_msg)
 
         elif cmd_type == 'GROUP_HISTORY': # <--- THÊM LOGIC NÀY
-            # Xử lý lịch sử chat Nhóm
-            msgs = data.get('messages', [])
-            me_uid = data.get('meUid')
-            # Lưu UID của chính mình nếu chưa có
-            if me_uid and not self.current_user_uid:
-                self.current_user_uid = me_uid
-            
-            # Xóa chat cũ (Lặp lại logic xóa)
-            for i in reversed(range(self.message_layout.count())): 
-                self.message_layout.itemAt(i).widget().setParent(None)
-
-            for m in msgs:
-                sender_uid = m.get('senderUid')
-                is_me = (sender_uid == me_uid) if me_uid else False
-                
-                # Bỏ qua tin nhắn hệ thống
-                if m.get('system'):
-                    continue
-                
-                # Kiểm tra nếu là message có file
-                if m.get('fileURL'):
-                    file_url = m.get('fileURL', '')
-                    # Kiểm tra cache trước - nếu file đã biết là không tồn tại thì bỏ qua
-                    if file_url in self._file_check_cache and not self._file_check_cache[file_url]:
-                        # File đã được kiểm tra và không tồn tại - bỏ qua message này
-                        print(f"[FileCheck] Bỏ qua message với file không tồn tại (từ cache): {file_url}")
-                        continue
-                    
-                    self.add_file_message({
-                        'fileType': m.get('fileType', 'application'),
-                        'fileURL': file_url,
-                        'fileName': m.get('fileName', 'Unknown')
-                    }, is_self=is_me)
-                elif m.get('text'):  # Chỉ hiển thị nếu có text
-                    self.add_message_bubble(m.get('text'), is_me)
+            # Xử lý lịch sử chat Nhóm (một trang)
+            self._cache_history_page(data, is_group=True)
+            self._show_history_page(data, is_group=True)
 
         elif cmd_type == 'GROUP_MEMBERS':
             if not data.get('ok'):
@@ -1087,6 +1282,8 @@ class ChatWindow(QWidget):
             if data.get('ok'):
                 group_id = data.get('groupId')
                 print(f"[Group] Đã rời nhóm thành công: {group_id}")
+                if self.message_cache:
+                    self.message_cache.forget(conversation_key(group_id, True))
                 
                 # Nếu đang chat nhóm này, đóng chat
                 if self.current_chat_is_group and self.current_chat_uid == group_id:
@@ -1096,10 +1293,7 @@ class ChatWindow(QWidget):
                     self.group_members_panel.hide()
                     
                     # Xóa tin nhắn
-                    for i in reversed(range(self.message_layout.count())):
-                        widget = self.message_layout.itemAt(i).widget()
-                        if widget is not None:
-                            widget.deleteLater()
+                    self.message_model.clear()
                 
                 # Reload danh sách nhóm
                 self.load_groups()
@@ -1282,7 +1476,8 @@ class ChatWindow(QWidget):
             item_widget = QListWidgetItem(self.contact_list)
             item_widget.setSizeHint(QSize(200, 60))
             
-            btn = QPushButton(name)
+            unread = self._unread.get(item_uid, 0)
+            btn = QPushButton(f"{name} ({unread})" if unread else name)
             # ... (Style và Cursor giữ nguyên) ...
             btn.setStyleSheet("""
                 QPushButton { text-align: left; padding: 15px; border: none; font-size: 14px; }
@@ -1299,6 +1494,22 @@ class ChatWindow(QWidget):
             btn.clicked.connect(lambda _, b=btn: self.select_item(b))
             
             self.contact_list.setItemWidget(item_widget, btn)
+
+    def _contact_button(self, target_id):
+        for i in range(self.contact_list.count()):
+            btn = self.contact_list.itemWidget(self.contact_list.item(i))
+            if btn is not None and btn.property("target_id") == target_id:
+                return btn
+        return None
+
+    def _mark_unread(self, target_id):
+        """Tăng số tin chưa đọc của một bạn bè / nhóm không đang mở."""
+        if not target_id:
+            return
+        self._unread[target_id] = self._unread.get(target_id, 0) + 1
+        btn = self._contact_button(target_id)
+        if btn is not None:
+            btn.setText(f"{btn.property('name')} ({self._unread[target_id]})")
                     
     def select_item(self, btn):
         """Xử lý sự kiện khi nhấn vào một mục (bạn bè hoặc nhóm)."""
@@ -1318,6 +1529,8 @@ class ChatWindow(QWidget):
         target_id = btn.property("target_id")
         name = btn.property("name")
         is_group = btn.property("is_group")
+        if self._unread.pop(target_id, None):
+            btn.setText(name)
         
         # Stop any playing voice message when switching chat
         if self.voice_player:
@@ -1340,18 +1553,21 @@ class ChatWindow(QWidget):
             self.group_members_panel.hide()
             self._current_group_members = []
         
-        for i in reversed(range(self.message_layout.count())): 
-            widget = self.message_layout.itemAt(i).widget()
-            if widget is not None:
-                widget.deleteLater()
-
-        # Tải lịch sử chat
-        if is_group:
-            # Gửi lệnh tải lịch sử nhóm (tùy vào commands.py của bạn)
-            self.send_command({'type': 'LOAD_GROUP_HISTORY', 'groupId': target_id, 'limit': 50})
-        else:
-            # Gửi lệnh tải lịch sử DM
-            self.send_command({'type': 'LOAD_THREAD', 'peerUid': target_id, 'limit': 50})
+        self.message_model.clear()
+
+        # Tải lịch sử chat (trang mới nhất; trang cũ hơn tải khi cuộn lên)
+        self._history_cursor = None
+        self._history_has_more = False
+        self._seen_cursor = None
+        self._shown_ids = set()
+        self._history_loading = True
+        key = 'groupId' if is_group else 'peerUid'
+        cmd = {'type': 'LOAD_GROUP_HISTORY' if is_group else 'LOAD_THREAD', key: target_id, 'limit': 50}
+        cached = self._show_cached_history(target_id, is_group)
+        if cached:
+            # Đã hiển thị từ cache: chỉ hỏi server các tin mới hơn tin mới nhất trong cache
+            cmd['after'], cmd['afterId'] = cached
+        self.send_command(cmd)
         if is_group:
             self.send_command({'type': 'LIST_GROUP_MEMBERS', 'groupId': target_id})
 
@@ -1384,13 +1600,9 @@ class ChatWindow(QWidget):
         # 2. Gửi lên server
         self.send_command(command)
         
-        # 3. Hiển thị ngay lập tức (Optimistic UI)
+        # 3. Hiển thị ngay lập tức (Optimistic UI), add_message_bubble cuộn xuống cuối
         self.add_message_bubble(text, is_self=True)
         self.msg_input.clear()
-        
-        # 4. Cuộn xuống cuối
-        QApplication.processEvents()
-        self.message_area.verticalScrollBar().setValue(self.message_area.verticalScrollBar().maximum())
 
     def _update_group_members_panel(self, members: list[dict]):
         """Hiển thị danh sách thành viên nhóm ngay dưới header."""
@@ -1422,97 +1634,28 @@ class ChatWindow(QWidget):
             return f"{uid_a}__{uid_b}"
         return f"{uid_b}__{uid_a}"
     
-    def _send_file_chunked(self, file_path, file_name, client_msg_id, to_uid=None, group_id=None):
-        """Gửi file theo chunks cho file lớn"""
-        CHUNK_SIZE = 500 * 1024  # 500KB mỗi chunk (sau base64 sẽ ~667KB)
-        
-        try:
-            file_size = os.path.getsize(file_path)
-            
-            # Gửi metadata trước
-            if group_id:
-                start_cmd = {
-                    'type': 'SEND_FILE_START',
-                    'groupId': group_id,
-                    'fileName': file_name,
-                    'fileSize': file_size,
-                    'clientMsgId': client_msg_id
-                }
-            else:
-                start_cmd = {
-                    'type': 'SEND_FILE_START',
-                    'toUid': to_uid,
-                    'fileName': file_name,
-                    'fileSize': file_size,
-                    'clientMsgId': client_msg_id
-                }
-            self.send_command(start_cmd)
-            
-            # Gửi từng chunk
-            chunk_index = 0
-            with open(file_path, 'rb') as f:
-                while True:
-                    chunk_data = f.read(CHUNK_SIZE)
-                    if not chunk_data:
-                        break
-                    
-                    chunk_b64 = base64.b64encode(chunk_data).decode('utf-8')
-                    chunk_cmd = {
-                        'type': 'SEND_FILE_CHUNK',
-                        'chunkIndex': chunk_index,
-                        'chunkData': chunk_b64,
-                        'clientMsgId': client_msg_id
-                    }
-                    self.send_command(chunk_cmd)
-                    chunk_index += 1
-                    
-                    # Cập nhật progress
-                    if self._upload_progress_dialog:
-                        progress = min(100, int((f.tell() / file_size) * 100))
-                        self._upload_progress_dialog.setMaximum(100)
-                        self._upload_progress_dialog.setValue(progress)
-                    QApplication.processEvents()  # Để UI không bị đơ
-            
-            # Gửi kết thúc
-            end_cmd = {
-                'type': 'SEND_FILE_END',
-                'clientMsgId': client_msg_id
-            }
-            self.send_command(end_cmd)
-            
-        except Exception as e:
-            print(f"[Upload] Error sending file chunks: {e}")
-            QMessageBox.critical(self, "Lỗi", f"Không thể gửi file: {str(e)}")
-    
     def upload_file(self):
-        """Chọn file và upload trực tiếp lên Firebase Storage, sau đó gửi URL cho server."""
+        """Chọn một hoặc nhiều file và đưa vào hàng đợi upload (không chặn khung chat)."""
         if not self.current_chat_uid or not self.current_user_uid:
             QMessageBox.warning(self, "Thông báo", "Vui lòng chọn người nhận trước khi gửi file")
             return
         
-        # Chọn file
-        file_path, _ = QFileDialog.getOpenFileName(
+        # Chọn file (được chọn nhiều file)
+        file_paths, _ = QFileDialog.getOpenFileNames(
             self,
             "Chọn file để gửi",
             "",
             "All Files (*.*);;Images (*.png *.jpg *.jpeg *.gif *.bmp);;Audio (*.mp3 *.wav *.ogg);;Documents (*.pdf *.doc *.docx *.txt);;Videos (*.mp4 *.avi *.mov)"
         )
-        
-        if not file_path:
+        self._enqueue_uploads(file_paths)
+    
+    def _enqueue_uploads(self, file_paths):
+        """Upload các file cho cuộc trò chuyện đang mở qua UploadManager."""
+        if not file_paths:
+            return
+        if not self.current_chat_uid or not self.current_user_uid:
+            QMessageBox.warning(self, "Thông báo", "Vui lòng chọn người nhận trước khi gửi file")
             return
-        
-        # Lấy tên file
-        file_name = os.path.basename(file_path)
-        
-        # Tạo client message ID
-        client_msg_id = str(int(time.time()*1000))
-        
-        # Lưu thông tin upload
-        self._uploading_file_name = file_name
-        self._upload_client_msg_id = client_msg_id
-        
-        # Hiển thị loading dialog
-        self._show_upload_progress(file_name)
         
         # Tính conversation_id
         if self.current_chat_is_group:
@@ -1520,87 +1663,157 @@ class ChatWindow(QWidget):
         else:
             conversation_id = self._make_thread_id(self.current_user_uid, self.current_chat_uid)
         
-        # Upload trực tiếp lên Firebase Storage
-        try:
-            if not upload_file_to_firebase_storage:
-                raise RuntimeError("Upload module not available. Please ensure client_upload.py exists.")
-            
-            if self._upload_progress_dialog:
-                self._upload_progress_dialog.setLabelText(f"Đang upload: {file_name}...")
-                self._upload_progress_dialog.setValue(50)  # Indeterminate for now
-            
-            file_url, content_type = upload_file_to_firebase_storage(
-                file_path, 
-                conversation_id, 
-                self.id_token
-            )
-            
-            # Xác định file_type từ content_type
-            file_type = content_type.split("/")[0] if "/" in content_type else "application"
-            
-            if self._upload_progress_dialog:
-                self._upload_progress_dialog.setValue(90)
-            
-            # Gửi URL cho server (không gửi file content)
+        for file_path in file_paths:
+            if not os.path.isfile(file_path):
+                continue
             if self.current_chat_is_group:
-                command = {
-                    'type': 'SEND_FILE_URL',
-                    'groupId': self.current_chat_uid,
-                    'fileName': file_name,
-                    'fileURL': file_url,
-                    'fileType': file_type,
-                    'clientMsgId': client_msg_id
-                }
+                self.upload_manager.enqueue(file_path, group_id=self.current_chat_uid, conversation_id=conversation_id)
             else:
-                command = {
-                    'type': 'SEND_FILE_URL',
-                    'toUid': self.current_chat_uid,
-                    'fileName': file_name,
-                    'fileURL': file_url,
-                    'fileType': file_type,
-                    'clientMsgId': client_msg_id
-                }
-            
-            self.send_command(command)
-            
-            if self._upload_progress_dialog:
-                self._upload_progress_dialog.setValue(100)
-            
+                self.upload_manager.enqueue(file_path, to_uid=self.current_chat_uid, conversation_id=conversation_id)
+    
+    def dragEnterEvent(self, event):
+        if event.mimeData().hasUrls() and any(u.isLocalFile() for u in event.mimeData().urls()):
+            event.acceptProposedAction()
+        else:
+            event.ignore()
+    
+    def dropEvent(self, event):
+        """Kéo thả file vào cửa sổ chat để gửi."""
+        file_paths = [u.toLocalFile() for u in event.mimeData().urls() if u.isLocalFile()]
+        if file_paths:
+            event.acceptProposedAction()
+            self._enqueue_uploads(file_paths)
+    
+    def _cache_history_page(self, data, is_group):
+        """Lưu trang lịch sử vừa nhận vào cache trên đĩa (nếu nối liền với phần đã lưu)."""
+        if not self.message_cache or not data.get('ok', True):
+            return
+        target_id = data.get('groupId') if is_group else data.get('peerUid')
+        if not target_id:
+            return
+        try:
+            self.message_cache.store_page(conversation_key(target_id, is_group), data)
         except Exception as e:
-            print(f"[Upload] Error: {e}")
-            import traceback
-            traceback.print_exc()
-            QMessageBox.critical(self, "Lỗi", f"Không thể upload file: {str(e)}")
-            self._hide_upload_progress()
-        
-    def add_message_bubble(self, text, is_self):
-        container = QWidget()
-        layout = QHBoxLayout(container)
-        layout.setContentsMargins(0, 5, 0, 5)
-        
-        lbl = QLabel(text)
-        lbl.setWordWrap(True)
-        lbl.setFont(QFont("Arial", 12))
-        lbl.setContentsMargins(10, 10, 10, 10)
-        lbl.setMaximumWidth(400)
-        
-        if is_self:
-            layout.addStretch()
-            lbl.setStyleSheet("background-color: #DCF8C6; border-radius: 10px; color: black;")
-            layout.addWidget(lbl)
+            print(f"[Cache] Không lưu được lịch sử: {e}")
+
+    def _show_cached_history(self, target_id, is_group):
+        """Hiển thị lịch sử đã cache của chat; trả về cursor (ts, id) tin mới nhất, hoặc None."""
+        if not self.message_cache:
+            return None
+        try:
+            cached = self.message_cache.load(conversation_key(target_id, is_group))
+        except Exception as e:
+            print(f"[Cache] Không đọc được lịch sử: {e}")
+            return None
+        if not cached:
+            return None
+        msgs, me_uid, has_more = cached
+        self._show_history_page({
+            'messages': msgs, 'meUid': me_uid, 'groupId' if is_group else 'peerUid': target_id,
+            'hasMore': has_more, 'nextBefore': msgs[0]['ts'], 'nextBeforeId': msgs[0]['id']
+        }, is_group)
+        return msgs[-1]['ts'], msgs[-1]['id']
+
+    def _show_history_page(self, data, is_group):
+        """Hiển thị một trang DM_HISTORY / GROUP_HISTORY.
+
+        Trang đầu (không có 'before') thay toàn bộ khung chat; trang cũ hơn được chèn
+        lên đầu và giữ nguyên vị trí đang đọc; trang 'after' (tin bị lỡ khi mất kết nối)
+        được nối vào cuối, bỏ qua tin đã hiển thị.
+        """
+        me_uid = data.get('meUid')
+        # Lưu UID của chính mình nếu chưa có
+        if me_uid and not self.current_user_uid:
+            self.current_user_uid = me_uid
+
+        # Bỏ qua trang của cuộc trò chuyện khác (người dùng đã chuyển chat)
+        target_id = data.get('groupId') if is_group else data.get('peerUid')
+        if target_id and target_id != self.current_chat_uid:
+            return
+
+        older = data.get('before') is not None
+        newer = data.get('after') is not None
+        if newer:
+            if data.get('hasMore') and data.get('nextAfter') is not None:
+                # Còn tin bị lỡ: tải tiếp trang sau
+                key = 'groupId' if is_group else 'peerUid'
+                self.send_command({'type': 'LOAD_GROUP_HISTORY' if is_group else 'LOAD_THREAD',
+                                   key: self.current_chat_uid, 'limit': 50,
+                                   'after': data['nextAfter'], 'afterId': data.get('nextAfterId', '')})
         else:
-            lbl.setStyleSheet("background-color: white; border-radius: 10px; border: 1px solid #ddd; color: black;")
-            layout.addWidget(lbl)
-            layout.addStretch()
-            
-        self.message_layout.addWidget(container)
-        # Scroll xuống dưới cùng
-        QApplication.processEvents()
-        self.message_area.verticalScrollBar().setValue(self.message_area.verticalScrollBar().maximum())
+            self._history_has_more = bool(data.get('hasMore'))
+            if data.get('nextBefore') is not None:
+                self._history_cursor = (data.get('nextBefore'), data.get('nextBeforeId', ''))
+
+        if not older and not newer:
+            self._seen_cursor = None
+            self._shown_ids = set()
+
+        # Cả trang được đưa vào model trong một lần insert; các dòng thường đã được
+        # NetworkWorker dựng sẵn (shape_command), trang từ cache thì dựng ở đây
+        rows = []
+        shaped = data.get('rows')
+        for msg_id, ts, row in (shaped if shaped is not None else history_rows(data, is_group)):
+            if newer and msg_id in self._shown_ids:
+                continue
+            self._note_seen(ts, msg_id)
+            if row is None:
+                continue
+            # File đã biết là không tồn tại (kết quả còn hạn) thì bỏ qua
+            if row.get('fileURL') and self.file_checker.is_missing(row['fileURL']):
+                continue
+            rows.append(row)
+
+        scrollbar = self.message_area.verticalScrollBar()
+        if older:
+            # Chèn lên đầu, giữ nguyên vị trí đang đọc
+            dist_from_bottom = scrollbar.maximum() - scrollbar.value()
+            self.message_model.prepend_messages(rows)
+            self.message_area.doItemsLayout()
+            scrollbar.setValue(scrollbar.maximum() - dist_from_bottom)
+        else:
+            if newer:
+                self.message_model.append_messages(rows)
+            else:
+                self.message_model.set_messages(rows)
+            self.message_area.scrollToBottom()
+        if not newer:
+            # Mở lại sau khi đã cuộn xong, để việc reset / chèn không kích hoạt tải thêm trang
+            self._history_loading = False
+
+        # Cả trang kiểm tra một lần (URL trùng / đã có kết quả không gửi HEAD)
+        self._check_files_exist([r['fileURL'] for r in rows if r.get('fileURL')])
+
+    def _on_message_scroll(self, value):
+        """Cuộn lên đầu khung chat -> tải trang lịch sử cũ hơn."""
+        if value != self.message_area.verticalScrollBar().minimum():
+            return
+        if not self.current_chat_uid or self._history_loading or not self._history_has_more or not self._history_cursor:
+            return
+        self._history_loading = True
+        before, before_id = self._history_cursor
+        if self.current_chat_is_group:
+            self.send_command({'type': 'LOAD_GROUP_HISTORY', 'groupId': self.current_chat_uid,
+                               'limit': 50, 'before': before, 'beforeId': before_id})
+        else:
+            self.send_command({'type': 'LOAD_THREAD', 'peerUid': self.current_chat_uid,
+                               'limit': 50, 'before': before, 'beforeId': before_id})
+
+    def add_message_bubble(self, text, is_self):
+        """Thêm tin văn bản vào cuối khung chat (delegate tự vẽ bong bóng) và cuộn xuống."""
+        row = {'text': text or '', 'is_self': is_self}
+        if self._message_batch is not None:
+            # Đang xử lý một lô lệnh: thêm cùng các tin khác khi hết lô
+            self._message_batch.append(row)
+            return
+        self.message_model.append_messages([row])
+        self.message_area.scrollToBottom()
     
     def add_file_message(self, msg_data, is_self):
         """
-        Hiển thị message có file (ảnh, audio, file).
+        Thêm message có file (ảnh, audio, file) vào cuối khung chat và cuộn xuống.
+
+        Widget của nó chỉ được tạo (_create_file_widget) khi dòng hiện trong vùng nhìn thấy.
         
         Args:
             msg_data: Dictionary chứa thông tin message:
@@ -1609,13 +1822,33 @@ class ChatWindow(QWidget):
                 - fileName: Tên file
             is_self: True nếu là tin nhắn của mình
         """
+        file_url = msg_data.get("fileURL", "")
+        row = {
+            'fileType': msg_data.get("fileType", "application"),
+            'fileURL': file_url,
+            'fileName': msg_data.get("fileName", "Unknown"),
+            'is_self': is_self
+        }
+        if self._message_batch is not None:
+            # Đang xử lý một lô lệnh: thêm (và kiểm tra file) cùng các tin khác khi hết lô
+            self._message_batch.append(row)
+            return
+        self.message_model.append_messages([row])
+        self.message_area.scrollToBottom()
+        
+        # Kiểm tra file có tồn tại không (async)
+        self._check_files_exist([file_url])
+
+    def _create_file_widget(self, msg):
+        """widget_factory của MessageListView: widget ảnh / audio / file cho một dòng."""
+        is_self = bool(msg.get('is_self'))
         container = QWidget()
         layout = QHBoxLayout(container)
         layout.setContentsMargins(0, 5, 0, 5)
         
-        file_type = msg_data.get("fileType", "").lower()
-        file_url = msg_data.get("fileURL", "")
-        file_name = msg_data.get("fileName", "Unknown")
+        file_type = msg.get("fileType", "").lower()
+        file_url = msg.get("fileURL", "")
+        file_name = msg.get("fileName", "Unknown")
         
         # Tạo widget tương ứng với loại file
         if file_type == "image":
@@ -1626,9 +1859,9 @@ class ChatWindow(QWidget):
                 self._download_image
             )
         elif file_type == "audio":
-            # Tạo callback để xóa widget khi file không tồn tại
+            # Tạo callback để xóa tin nhắn khi file không tồn tại
             def remove_widget_callback():
-                self._remove_message_widget(container)
+                self.message_model.remove_file(file_url)
             
             widget = create_audio_widget(
                 file_url,
@@ -1667,96 +1900,18 @@ class ChatWindow(QWidget):
         container.setProperty('file_url', file_url)
         container.setProperty('file_type', file_type)
         container.setProperty('file_name', file_name)
-        
-        self.message_layout.addWidget(container)
-        QApplication.processEvents()
-        self.message_area.verticalScrollBar().setValue(self.message_area.verticalScrollBar().maximum())
-        
-        # Kiểm tra file có tồn tại không (async)
-        self._check_file_exists(file_url, container)
-    
-    def _check_file_exists(self, file_url, container):
-        """Kiểm tra file có tồn tại trên Firebase Storage không."""
-        # Kiểm tra cache trước
-        if file_url in self._file_check_cache:
-            exists = self._file_check_cache[file_url]
-            if not exists:
-                # File đã được kiểm tra và không tồn tại - xóa widget ngay
-                print(f"[FileCheck] File không tồn tại (từ cache), đã xóa widget: {file_url}")
-                self._remove_message_widget(container)
-            # Nếu file tồn tại, giữ widget
-            return
-        
-        def on_check_complete(checked_container, exists, checked_url):
-            """Callback khi kiểm tra xong."""
-            try:
-                # Lưu kết quả vào cache
-                self._file_check_cache[checked_url] = exists
-                
-                # Kiểm tra container có còn tồn tại không (tránh lỗi khi widget đã bị xóa)
-                if not checked_container:
-                    return
-                
-                # Kiểm tra container có còn trong UI không
-                try:
-                    parent = checked_container.parent()
-                    if not parent:
-                        return
-                except RuntimeError:
-                    # Widget đã bị xóa, bỏ qua
-                    return
-                
-                if not exists:
-                    # File không tồn tại - xóa widget
-                    print(f"[FileCheck] File không tồn tại")
-                    self._remove_message_widget(checked_container)
-            except Exception as e:
-                # Bỏ qua mọi lỗi để tránh crash
-                print(f"[FileCheck] Error in callback: {e}")
-        
-        # Tạo worker thread và kết nối signal
-        worker = FileCheckWorker(file_url, container)
-        worker.check_complete.connect(on_check_complete)
-        worker.finished.connect(worker.deleteLater)  # Tự xóa worker khi xong
-        
-        # Lưu worker để tránh bị garbage collect
-        self._file_check_workers.append(worker)
-        worker.finished.connect(lambda: self._file_check_workers.remove(worker) if worker in self._file_check_workers else None)
-        
-        # Bắt đầu kiểm tra
-        worker.start()
-    
-    def _remove_message_widget(self, container):
-        """Xóa message widget khỏi UI."""
-        try:
-            if not container:
-                return
-            
-            # Kiểm tra container có còn tồn tại không
-            try:
-                parent = container.parent()
-                if not parent:
-                    return
-            except RuntimeError:
-                # Widget đã bị xóa, bỏ qua
-                return
-            
-            # Tìm container trong layout
-            for i in range(self.message_layout.count()):
-                try:
-                    item = self.message_layout.itemAt(i)
-                    if item and item.widget() == container:
-                        # Xóa widget khỏi layout
-                        self.message_layout.removeWidget(container)
-                        container.setParent(None)
-                        container.deleteLater()
-                        break
-                except RuntimeError:
-                    # Widget đã bị xóa trong lúc xử lý, bỏ qua
-                    continue
-        except Exception as e:
-            # Bỏ qua mọi lỗi để tránh crash
-            print(f"[RemoveWidget] Error removing widget: {e}")
+        return container
+
+    def _check_files_exist(self, file_urls):
+        """Kiểm tra các file trên Firebase Storage ở nền; file không tồn tại bị xóa khỏi khung chat."""
+        known = self.file_checker.check(file_urls)
+        self._on_files_checked({url: exists for url, exists in known.items() if not exists})
+
+    def _on_files_checked(self, results):
+        """Kết quả một lô kiểm tra {file_url: exists}."""
+        for file_url, exists in results.items():
+            if not exists and self.message_model.remove_file(file_url):
+                print(f"[FileCheck] File không tồn tại, đã xóa tin: {file_url}")
     
     def _show_image_context_menu(self, image_url, file_name, position):
         """Hiển thị menu context cho ảnh (click chuột phải)."""
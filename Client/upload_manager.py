@@ -0,0 +1,330 @@
+import itertools
+import os
+import time
+from collections import deque
+
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QLabel, QProgressBar, QPushButton
+
+try:
+    from chunk_upload import ChunkUploadWorker
+except Exception:
+    try:
+        from Client.chunk_upload import ChunkUploadWorker
+    except Exception:
+        ChunkUploadWorker = None
+
+# Số file upload cùng lúc, các file còn lại chờ trong hàng đợi
+MAX_CONCURRENT = int(os.environ.get('CHAT_UPLOAD_CONCURRENCY', '3'))
+# Số giây chờ FILE_SENT sau SEND_FILE_URL; quá hạn thì báo lỗi để giải phóng slot
+REPLY_TIMEOUT = float(os.environ.get('CHAT_UPLOAD_REPLY_TIMEOUT', '30'))
+# Cách upload: 'direct' (thẳng lên Storage), 'chunked' (qua server, ChunkUploadWorker) hoặc
+# 'auto' - direct, chuyển sang chunked khi không có client_upload, khi file từ
+# CHAT_UPLOAD_CHUNKED_MIN_BYTES trở lên (0 = tắt) hoặc khi upload direct bị lỗi
+UPLOAD_MODE = os.environ.get('CHAT_UPLOAD_MODE', 'auto').strip().lower()
+CHUNKED_MIN_BYTES = int(os.environ.get('CHAT_UPLOAD_CHUNKED_MIN_BYTES', '0'))
+
+
+def choose_upload_path(file_size, has_direct, has_chunked, mode=None, chunked_min=None):
+    """Trả về 'direct', 'chunked' hoặc None (không có cách upload nào dùng được)."""
+    mode = UPLOAD_MODE if mode is None else mode
+    chunked_min = CHUNKED_MIN_BYTES if chunked_min is None else chunked_min
+    if mode == 'direct':
+        return 'direct' if has_direct else None
+    if mode == 'chunked':
+        return 'chunked' if has_chunked else None
+    if has_chunked and (not has_direct or (chunked_min > 0 and file_size >= chunked_min)):
+        return 'chunked'
+    return 'direct' if has_direct else None
+
+
+def can_fall_back(error, mode=None):
+    """Upload direct lỗi (không phải do người dùng hủy) thì thử lại qua server ở chế độ auto."""
+    mode = UPLOAD_MODE if mode is None else mode
+    return mode == 'auto' and ChunkUploadWorker is not None and error != 'cancelled'
+
+
+class DirectUploadWorker(QThread):
+    """Gọi client_upload.upload_file_to_firebase_storage trên thread riêng."""
+    uploaded = pyqtSignal(str, str)        # file_url, content_type
+    upload_failed = pyqtSignal(str)        # error
+    progress = pyqtSignal(int, int, float)  # sent_bytes, total_bytes, bytes/giây
+
+    def __init__(self, upload_fn, file_path, conversation_id, id_token):
+        super().__init__()
+        self.upload_fn = upload_fn
+        self.file_path = file_path
+        self.conversation_id = conversation_id
+        self.id_token = id_token
+        self._cancelled = False
+
+    def cancel(self):
+        # Không dừng được upload đang chạy, chỉ bỏ qua kết quả (session resumable vẫn được giữ)
+        self._cancelled = True
+
+    def run(self):
+        started = time.monotonic()
+
+        def on_progress(sent, total):
+            elapsed = time.monotonic() - started
+            self.progress.emit(sent, total, sent / elapsed if elapsed > 0 else 0.0)
+
+        try:
+            file_url, content_type = self.upload_fn(self.file_path, self.conversation_id, self.id_token,
+                                                    progress=on_progress)
+        except Exception as e:
+            print(f"[Upload] Error: {e}")
+            self.upload_failed.emit('cancelled' if self._cancelled else str(e))
+            return
+        if self._cancelled:
+            self.upload_failed.emit('cancelled')
+        else:
+            self.uploaded.emit(file_url, content_type)
+
+
+class UploadJob:
+    def __init__(self, client_msg_id, file_path, to_uid=None, group_id=None, conversation_id=''):
+        self.client_msg_id = client_msg_id
+        self.file_path = file_path
+        self.file_name = os.path.basename(file_path)
+        self.to_uid = to_uid
+        self.group_id = group_id
+        self.conversation_id = conversation_id
+        self.worker = None
+        self.done = False
+        self.awaiting_reply = False   # đã gửi SEND_FILE_URL, chờ FILE_SENT
+
+
+class UploadManager(QObject):
+    """Hàng đợi upload nhiều file, chạy tối đa max_concurrent file cùng lúc.
+
+    Mỗi file được upload thẳng lên Storage (direct_upload, rồi SEND_FILE_URL) hoặc gửi qua
+    server bằng ChunkUploadWorker, chọn theo choose_upload_path(); upload direct bị lỗi thì
+    thử lại qua server (can_fall_back). Không có dialog modal: tiến độ từng file đi qua các
+    signal job_* (xem UploadListWidget).
+    """
+    job_added = pyqtSignal(str, str)             # client_msg_id, file_name
+    job_progress = pyqtSignal(str, int, float)   # client_msg_id, phần trăm (-1 = chưa rõ), bytes/giây
+    job_finished = pyqtSignal(str, bool, str)    # client_msg_id, ok, error
+
+    def __init__(self, network, send_command, direct_upload=None, id_token='',
+                 max_concurrent=MAX_CONCURRENT, parent=None):
+        super().__init__(parent)
+        self.network = network
+        self.send_command = send_command
+        self.direct_upload = direct_upload
+        self.id_token = id_token
+        self.max_concurrent = max(1, max_concurrent)
+        self._queue = deque()
+        self._jobs = {}       # client_msg_id -> UploadJob (đang chờ hoặc đang chạy)
+        self._running = 0
+        self._ids = itertools.count()
+
+    def enqueue(self, file_path, to_uid=None, group_id=None, conversation_id=''):
+        # clientMsgId phải khác nhau kể cả khi nhiều file được thêm trong cùng một ms
+        client_msg_id = f"{int(time.time() * 1000)}-{next(self._ids)}"
+        job = UploadJob(client_msg_id, file_path, to_uid, group_id, conversation_id)
+        self._jobs[client_msg_id] = job
+        self._queue.append(job)
+        self.job_added.emit(client_msg_id, job.file_name)
+        self._pump()
+        return client_msg_id
+
+    def cancel(self, client_msg_id):
+        job = self._jobs.get(client_msg_id)
+        if job is None:
+            return
+        if job.worker is None:
+            self._queue.remove(job)
+            self._finish(job, False, 'cancelled')
+            return
+        job.worker.cancel()
+        if isinstance(job.worker, DirectUploadWorker):
+            # Kết quả upload SDK sẽ bị bỏ qua (job.done)
+            self._finish(job, False, 'cancelled')
+
+    def on_server_message(self, data):
+        """Nhận FILE_CHUNK_* / FILE_SENT; trả về True nếu ChatWindow không cần xử lý tiếp."""
+        job = self._jobs.get(data.get('clientMsgId', ''))
+        if job is None or job.worker is None:
+            return False
+        cmd_type = data.get('type')
+        if isinstance(job.worker, DirectUploadWorker):
+            if cmd_type == 'FILE_SENT':
+                self._finish(job, bool(data.get('ok')), data.get('error', ''))
+            return False
+        job.worker.on_server_message(data)
+        if cmd_type == 'FILE_SENT':
+            # Worker tự gửi lại các chunk còn thiếu rồi SEND_FILE_END lần nữa
+            if not data.get('ok') and data.get('error') == 'missing_chunks':
+                return True
+            self._finish(job, bool(data.get('ok')), data.get('error', ''))
+        return cmd_type != 'FILE_SENT'
+
+    def _pump(self):
+        while self._queue and self._running < self.max_concurrent:
+            self._start(self._queue.popleft())
+
+    def _start(self, job):
+        try:
+            file_size = os.path.getsize(job.file_path)
+        except OSError as e:
+            self._finish(job, False, str(e))
+            return
+        path = choose_upload_path(file_size, self.direct_upload is not None, ChunkUploadWorker is not None)
+        if path is None:
+            self._finish(job, False, 'upload module not available')
+            return
+        self._running += 1
+        if path == 'direct':
+            self._start_direct(job)
+        else:
+            self._start_chunked(job)
+
+    def _start_direct(self, job):
+        cid = job.client_msg_id
+        worker = DirectUploadWorker(self.direct_upload, job.file_path, job.conversation_id, self.id_token)
+        worker.uploaded.connect(lambda url, ct, job=job: self._on_direct_uploaded(job, url, ct))
+        worker.upload_failed.connect(lambda error, job=job: self._on_direct_failed(job, error))
+        worker.progress.connect(
+            lambda sent, total, rate, cid=cid: self.job_progress.emit(
+                cid, min(100, int(sent * 100 / total)) if total else 0, rate))
+        # File nhỏ đi một request nên chỉ có tiến độ khi xong
+        self.job_progress.emit(cid, -1, 0.0)
+        self._run_worker(job, worker)
+
+    def _start_chunked(self, job):
+        cid = job.client_msg_id
+        worker = ChunkUploadWorker(self.network, job.file_path, job.file_name, cid,
+                                   to_uid=job.to_uid, group_id=job.group_id)
+        worker.progress.connect(
+            lambda acked, total, rate, cid=cid: self.job_progress.emit(
+                cid, min(100, int(acked * 100 / total)) if total else 0, rate))
+        worker.upload_failed.connect(lambda _cid, error, job=job: self._finish(job, False, error))
+        self._run_worker(job, worker)
+
+    def _run_worker(self, job, worker):
+        worker.finished.connect(worker.deleteLater)
+        job.worker = worker
+        worker.start()
+
+    def _on_direct_failed(self, job, error):
+        if job.done:
+            return
+        if not can_fall_back(error):
+            self._finish(job, False, error)
+            return
+        print(f"[Upload] Direct upload of {job.file_name} failed ({error}), sending through the server")
+        # Giữ nguyên slot đang chạy (_running) cho lần thử qua server
+        self._start_chunked(job)
+
+    def _on_direct_uploaded(self, job, file_url, content_type):
+        if job.done:
+            return
+        self.job_progress.emit(job.client_msg_id, 100, 0.0)
+        # Xác định file_type từ content_type
+        file_type = content_type.split("/")[0] if "/" in content_type else "application"
+        command = {
+            'type': 'SEND_FILE_URL',
+            'fileName': job.file_name,
+            'fileURL': file_url,
+            'fileType': file_type,
+            'clientMsgId': job.client_msg_id
+        }
+        if job.group_id:
+            command['groupId'] = job.group_id
+        else:
+            command['toUid'] = job.to_uid
+        # Slot được giải phóng khi server trả FILE_SENT, khi hết REPLY_TIMEOUT hoặc khi
+        # mất kết nối (on_reconnected)
+        job.awaiting_reply = True
+        self.send_command(command)
+        QTimer.singleShot(int(REPLY_TIMEOUT * 1000), lambda job=job: self._finish(job, False, 'timeout'))
+
+    def on_reconnected(self):
+        """Gọi khi NetworkWorker kết nối lại: FILE_SENT của kết nối cũ sẽ không bao giờ tới."""
+        for job in [job for job in self._jobs.values() if job.awaiting_reply]:
+            self._finish(job, False, 'connection_lost')
+
+    def _finish(self, job, ok, error):
+        if job.done:
+            return
+        job.done = True
+        self._jobs.pop(job.client_msg_id, None)
+        if job.worker is not None:
+            self._running -= 1
+        self.job_finished.emit(job.client_msg_id, ok, error or '')
+        self._pump()
+
+
+class UploadListWidget(QWidget):
+    """Danh sách file đang upload (tên, thanh tiến độ, nút hủy), ẩn khi trống."""
+
+    def __init__(self, manager, parent=None):
+        super().__init__(parent)
+        self.manager = manager
+        self._rows = {}   # client_msg_id -> (row widget, label, progress bar, file name)
+        self._layout = QVBoxLayout(self)
+        self._layout.setContentsMargins(10, 2, 10, 2)
+        self._layout.setSpacing(2)
+        self.setStyleSheet("QLabel { color: #555; font-size: 12px; }")
+        manager.job_added.connect(self._on_added)
+        manager.job_progress.connect(self._on_progress)
+        manager.job_finished.connect(self._on_finished)
+        self.hide()
+
+    def _on_added(self, client_msg_id, file_name):
+        row = QWidget()
+        row_layout = QHBoxLayout(row)
+        row_layout.setContentsMargins(0, 0, 0, 0)
+        label = QLabel(f"⏳ {file_name}")
+        label.setMinimumWidth(180)
+        bar = QProgressBar()
+        bar.setFixedHeight(12)
+        bar.setTextVisible(False)
+        bar.setRange(0, 100)
+        bar.setValue(0)
+        btn_cancel = QPushButton("✕")
+        btn_cancel.setFixedSize(22, 22)
+        btn_cancel.setToolTip("Hủy upload")
+        btn_cancel.clicked.connect(lambda: self.manager.cancel(client_msg_id))
+        row_layout.addWidget(label)
+        row_layout.addWidget(bar, 1)
+        row_layout.addWidget(btn_cancel)
+        self._layout.addWidget(row)
+        self._rows[client_msg_id] = (row, label, bar, file_name)
+        self.show()
+
+    def _on_progress(self, client_msg_id, percent, bytes_per_sec):
+        entry = self._rows.get(client_msg_id)
+        if entry is None:
+            return
+        _, label, bar, file_name = entry
+        if percent < 0:
+            bar.setRange(0, 0)  # chưa biết tiến độ (upload SDK)
+        else:
+            bar.setRange(0, 100)
+            bar.setValue(percent)
+        speed = f" ({bytes_per_sec / (1024 * 1024):.1f} MB/s)" if bytes_per_sec > 0 else ""
+        label.setText(f"⬆ {file_name}{speed}")
+
+    def _on_finished(self, client_msg_id, ok, error):
+        entry = self._rows.get(client_msg_id)
+        if entry is None:
+            return
+        _, label, bar, file_name = entry
+        bar.setRange(0, 100)
+        if ok:
+            bar.setValue(100)
+            label.setText(f"✔ {file_name}")
+            QTimer.singleShot(1500, lambda: self._remove(client_msg_id))
+        else:
+            label.setText(f"✖ {file_name}: {error}")
+            QTimer.singleShot(1500 if error == 'cancelled' else 5000, lambda: self._remove(client_msg_id))
+
+    def _remove(self, client_msg_id):
+        entry = self._rows.pop(client_msg_id, None)
+        if entry is not None:
+            entry[0].deleteLater()
+        if not self._rows:
+            self.hide()
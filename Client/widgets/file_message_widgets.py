@@ -1,8 +1,4 @@
-import os
-import time
-
 import qtawesome as qta
-import requests
 from PyQt5.QtWidgets import (
     QFrame,
     QVBoxLayout,
@@ -11,9 +7,11 @@ from PyQt5.QtWidgets import (
     QHBoxLayout,
     QSlider,
 )
-from PyQt5.QtGui import QPixmap, QFont
+from PyQt5.QtGui import QFont
 from PyQt5.QtCore import Qt, QSize
 
+from widgets.image_loader import get_image_loader, image_file_name
+
 
 def create_image_widget(image_url, is_self, show_context_menu, download_image):
     frame = QFrame()
@@ -37,91 +35,71 @@ def create_image_widget(image_url, is_self, show_context_menu, download_image):
     layout.setContentsMargins(5, 5, 5, 5)
     layout.setSpacing(5)
 
-    pixmap = None
-    file_name = None
-    try:
-        response = requests.get(image_url, timeout=10)
-        if response.status_code == 200:
-            pixmap = QPixmap()
-            pixmap.loadFromData(response.content)
-
-            try:
-                from urllib.parse import urlparse, unquote
-                parsed_url = urlparse(image_url)
-                file_name = unquote(os.path.basename(parsed_url.path))
-                if not file_name or '.' not in file_name:
-                    content_type = response.headers.get('Content-Type', '')
-                    ext = 'jpg'
-                    if 'png' in content_type:
-                        ext = 'png'
-                    elif 'gif' in content_type:
-                        ext = 'gif'
-                    elif 'webp' in content_type:
-                        ext = 'webp'
-                    file_name = f"image_{int(time.time())}.{ext}"
-            except Exception:
-                file_name = f"image_{int(time.time())}.jpg"
-
-            if pixmap.width() > 400:
-                pixmap = pixmap.scaledToWidth(400, Qt.SmoothTransformation)
-
-            image_container = QFrame()
-            image_container.setStyleSheet("background-color: transparent;")
-            image_layout = QVBoxLayout(image_container)
-            image_layout.setContentsMargins(0, 0, 0, 0)
-
-            label = QLabel()
-            label.setPixmap(pixmap)
-            label.setAlignment(Qt.AlignCenter)
-            label.setContextMenuPolicy(Qt.CustomContextMenu)
-            label.customContextMenuRequested.connect(
-                lambda pos: show_context_menu(image_url, file_name, label.mapToGlobal(pos))
-            )
-            image_layout.addWidget(label)
-            layout.addWidget(image_container)
-
-            btn_download = QPushButton("Tải ảnh xuống")
-            btn_download.setStyleSheet("""
-                QPushButton {
-                    background-color: #f5f5f5;
-                    border: 1px solid #ddd;
-                    border-radius: 5px;
-                    padding: 5px 10px;
-                    font-size: 11px;
-                }
-                QPushButton:hover {
-                    background-color: #e0e0e0;
-                    border: 1px solid #2196F3;
-                }
-                QPushButton:pressed {
-                    background-color: #d0d0d0;
-                }
-            """ if not is_self else """
-                QPushButton {
-                    background-color: #c8e6c9;
-                    border: 1px solid #4caf50;
-                    border-radius: 5px;
-                    padding: 5px 10px;
-                    font-size: 11px;
-                }
-                QPushButton:hover {
-                    background-color: #a5d6a7;
-                    border: 1px solid #2e7d32;
-                }
-                QPushButton:pressed {
-                    background-color: #81c784;
-                }
-            """)
-            btn_download.clicked.connect(lambda: download_image(image_url, file_name))
-            layout.addWidget(btn_download)
-        else:
-            error_label = QLabel("Không thể tải ảnh")
-            error_label.setAlignment(Qt.AlignCenter)
-            layout.addWidget(error_label)
-    except Exception as e:
-        error_label = QLabel(f"Lỗi tải ảnh: {str(e)}")
-        error_label.setAlignment(Qt.AlignCenter)
-        layout.addWidget(error_label)
+    # Hiện chỗ giữ tạm ngay, ảnh được tải nền bởi ImageLoader (không chặn GUI thread)
+    status_label = QLabel("Đang tải ảnh...")
+    status_label.setAlignment(Qt.AlignCenter)
+    status_label.setMinimumHeight(120)
+    layout.addWidget(status_label)
+    file_name = image_file_name(image_url)
+
+    def on_loaded(pixmap, error):
+        if pixmap is None or pixmap.isNull():
+            status_label.setMinimumHeight(0)
+            status_label.setText(f"Lỗi tải ảnh: {error}" if error else "Không thể tải ảnh")
+            return
+        status_label.hide()
+
+        image_container = QFrame()
+        image_container.setStyleSheet("background-color: transparent;")
+        image_layout = QVBoxLayout(image_container)
+        image_layout.setContentsMargins(0, 0, 0, 0)
+
+        label = QLabel()
+        label.setPixmap(pixmap)
+        label.setAlignment(Qt.AlignCenter)
+        label.setContextMenuPolicy(Qt.CustomContextMenu)
+        label.customContextMenuRequested.connect(
+            lambda pos: show_context_menu(image_url, file_name, label.mapToGlobal(pos))
+        )
+        image_layout.addWidget(label)
+        layout.addWidget(image_container)
+
+        btn_download = QPushButton("Tải ảnh xuống")
+        btn_download.setStyleSheet("""
+            QPushButton {
+                background-color: #f5f5f5;
+                border: 1px solid #ddd;
+                border-radius: 5px;
+                padding: 5px 10px;
+                font-size: 11px;
+            }
+            QPushButton:hover {
+                background-color: #e0e0e0;
+                border: 1px solid #2196F3;
+            }
+            QPushButton:pressed {
+                background-color: #d0d0d0;
+            }
+        """ if not is_self else """
+            QPushButton {
+                background-color: #c8e6c9;
+                border: 1px solid #4caf50;
+                border-radius: 5px;
+                padding: 5px 10px;
+                font-size: 11px;
+            }
+            QPushButton:hover {
+                background-color: #a5d6a7;
+                border: 1px solid #2e7d32;
+            }
+            QPushButton:pressed {
+                background-color: #81c784;
+            }
+        """)
+        btn_download.clicked.connect(lambda: download_image(image_url, file_name))
+        layout.addWidget(btn_download)
+
+    get_image_loader().load(image_url, on_loaded)
 
     return frame
 
@@ -0,0 +1,175 @@
+"""Tải ảnh tin nhắn nền cho create_image_widget.
+
+Ảnh được tải trên thread pool bằng một requests.Session dùng chung (giữ kết nối tới
+Storage), giải mã và thu nhỏ thành thumbnail rộng tối đa THUMB_WIDTH ngay trên thread
+đó (QImage, không đụng GUI thread). Thumbnail được giữ ở hai tầng, theo URL:
+    - bộ nhớ: LRU các QPixmap (MEMORY_ITEMS ảnh)
+    - đĩa: file PNG trong DISK_CACHE_DIR, tổng dung lượng tối đa DISK_CACHE_BYTES
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
+
+import requests
+from requests.adapters import HTTPAdapter
+from PyQt5.QtGui import QImage, QPixmap
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+
+THUMB_WIDTH = 400
+WORKERS = int(os.environ.get('CHAT_IMAGE_WORKERS', '4'))
+MEMORY_ITEMS = int(os.environ.get('CHAT_IMAGE_MEMORY_ITEMS', '200'))
+DISK_CACHE_DIR = os.environ.get('CHAT_THUMB_CACHE_DIR', '').strip() or \
+    os.path.join(os.path.expanduser('~'), '.qt5chat', 'thumbs')
+DISK_CACHE_BYTES = int(os.environ.get('CHAT_THUMB_CACHE_MB', '100')) * 1024 * 1024
+TIMEOUT = 10
+
+
+def image_file_name(image_url, content_type=''):
+    """Tên file để tải xuống: lấy từ URL, thiếu đuôi thì đoán theo Content-Type."""
+    try:
+        file_name = unquote(os.path.basename(urlparse(image_url).path))
+    except Exception:
+        file_name = ''
+    if file_name and '.' in file_name:
+        return file_name
+    ext = 'jpg'
+    for candidate in ('png', 'gif', 'webp'):
+        if candidate in (content_type or ''):
+            ext = candidate
+            break
+    return f"image_{int(time.time())}.{ext}"
+
+
+class ImageLoader(QObject):
+    """Dịch vụ tải ảnh dùng chung; load(url, callback) gọi callback(pixmap, error) trên GUI thread."""
+
+    # Phát từ thread pool, Qt chuyển về GUI thread (queued connection)
+    _done = pyqtSignal(str, object, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._memory = OrderedDict()   # url -> QPixmap, cuối = dùng gần nhất
+        self._callbacks = {}           # url -> [callback] đang chờ
+        self._executor = ThreadPoolExecutor(max_workers=max(1, WORKERS), thread_name_prefix='image-loader')
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(1, WORKERS), pool_maxsize=max(1, WORKERS))
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._disk_lock = threading.Lock()
+        self._done.connect(self._on_done)
+
+    def cached(self, image_url):
+        """QPixmap đã có trong bộ nhớ (hoặc None)."""
+        pixmap = self._memory.get(image_url)
+        if pixmap is not None:
+            self._memory.move_to_end(image_url)
+        return pixmap
+
+    def load(self, image_url, callback):
+        """Lấy thumbnail của image_url; callback(pixmap, error) - một trong hai là None."""
+        pixmap = self.cached(image_url)
+        if pixmap is not None:
+            callback(pixmap, None)
+            return
+        waiting = self._callbacks.get(image_url)
+        if waiting is not None:
+            # Đang tải rồi (cùng ảnh xuất hiện nhiều lần): chỉ chờ kết quả
+            waiting.append(callback)
+            return
+        self._callbacks[image_url] = [callback]
+        self._executor.submit(self._fetch, image_url)
+
+    def _disk_path(self, image_url):
+        return os.path.join(DISK_CACHE_DIR, hashlib.sha1(image_url.encode('utf-8')).hexdigest() + '.png')
+
+    def _fetch(self, image_url):
+        """Chạy trên thread pool: đĩa -> mạng, giải mã và thu nhỏ thành QImage."""
+        path = self._disk_path(image_url)
+        try:
+            image = QImage(path) if os.path.exists(path) else QImage()
+            if not image.isNull():
+                os.utime(path, None)  # đánh dấu mới dùng, tránh bị dọn trước
+                self._done.emit(image_url, image, '')
+                return
+            response = self._session.get(image_url, timeout=TIMEOUT)
+            if response.status_code != 200:
+                self._done.emit(image_url, None, f"HTTP {response.status_code}")
+                return
+            image = QImage()
+            if not image.loadFromData(response.content):
+                self._done.emit(image_url, None, "Không đọc được ảnh")
+                return
+            if image.width() > THUMB_WIDTH:
+                image = image.scaledToWidth(THUMB_WIDTH, Qt.SmoothTransformation)
+            self._store_on_disk(path, image)
+            self._done.emit(image_url, image, '')
+        except Exception as e:
+            self._done.emit(image_url, None, str(e))
+
+    def _store_on_disk(self, path, image):
+        try:
+            with self._disk_lock:
+                os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+                tmp_path = path + '.tmp'
+                if image.save(tmp_path, 'PNG'):
+                    os.replace(tmp_path, path)
+                self._trim_disk()
+        except Exception as e:
+            print(f"[ImageCache] Không ghi được thumbnail: {e}")
+
+    def _trim_disk(self):
+        """Xóa thumbnail ít dùng nhất khi thư mục cache vượt DISK_CACHE_BYTES."""
+        entries = []
+        total = 0
+        for name in os.listdir(DISK_CACHE_DIR):
+            if not name.endswith('.png'):
+                continue
+            full = os.path.join(DISK_CACHE_DIR, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+            total += st.st_size
+        if total <= DISK_CACHE_BYTES:
+            return
+        for _, size, full in sorted(entries):
+            try:
+                os.remove(full)
+            except OSError:
+                continue
+            total -= size
+            if total <= DISK_CACHE_BYTES:
+                break
+
+    def _on_done(self, image_url, image, error):
+        pixmap = None
+        if image is not None:
+            pixmap = QPixmap.fromImage(image)
+            self._memory[image_url] = pixmap
+            self._memory.move_to_end(image_url)
+            while len(self._memory) > MEMORY_ITEMS:
+                self._memory.popitem(last=False)
+        for callback in self._callbacks.pop(image_url, []):
+            try:
+                callback(pixmap, error or None)
+            except RuntimeError:
+                # Widget đã bị xóa (đổi chat) trước khi ảnh tải xong
+                pass
+            except Exception as e:
+                print(f"[ImageLoader] Error in callback: {e}")
+
+
+_loader = None
+
+
+def get_image_loader():
+    """ImageLoader dùng chung của ứng dụng (tạo lần đầu, trên GUI thread)."""
+    global _loader
+    if _loader is None:
+        _loader = ImageLoader()
+    return _loader
@@ -0,0 +1,253 @@
+"""Khung tin nhắn dạng model/view cho ChatWindow.
+
+Mỗi tin nhắn là một dict trong MessageListModel:
+    - tin văn bản: {'text', 'is_self', ['id', 'ts']}
+    - tin có file: {'fileType', 'fileURL', 'fileName', 'is_self', ['id', 'ts']}
+
+MessageDelegate tự vẽ bong bóng văn bản (không tạo QWidget nào), nên chỉ các dòng đang
+hiển thị tốn công vẽ. Widget nặng của tin có file (ảnh, audio player, nút tải) chỉ được
+tạo bằng widget_factory khi dòng đó cuộn tới vùng nhìn thấy; khi widget đổi kích thước
+(ví dụ ảnh tải nền xong) dòng của nó được đo lại.
+"""
+from PyQt5.QtWidgets import QAbstractItemView, QListView, QStyledItemDelegate
+from PyQt5.QtGui import QBrush, QColor, QFont, QFontMetrics, QPainter, QPen
+from PyQt5.QtCore import QAbstractListModel, QEvent, QModelIndex, QPersistentModelIndex, QRect, QSize, Qt, QTimer
+
+MESSAGE_ROLE = Qt.UserRole + 1
+
+# Giống bong bóng QLabel cũ: lề dòng 5px, padding 10px, rộng tối đa 400px, bo góc 10px
+ROW_MARGIN = 5
+BUBBLE_PADDING = 10
+BUBBLE_MAX_WIDTH = 400
+BUBBLE_RADIUS = 10
+SELF_COLOR = QColor('#DCF8C6')
+PEER_COLOR = QColor('white')
+PEER_BORDER = QColor('#ddd')
+# Chiều cao tạm của tin có file khi widget chưa được tạo
+PLACEHOLDER_HEIGHTS = {'image': 240, 'audio': 110}
+PLACEHOLDER_HEIGHT = 70
+# Số dòng ngoài vùng nhìn thấy cũng được tạo widget trước (cuộn mượt hơn)
+PRELOAD_ROWS = 3
+
+
+def is_file_message(msg):
+    return bool(msg.get('fileURL'))
+
+
+def history_rows(data, is_group):
+    """Dòng cho model từ một trang DM_HISTORY / GROUP_HISTORY: [(id, ts, row hoặc None)].
+
+    row là None với tin không hiển thị (tin hệ thống của nhóm, tin nhóm không có text)
+    nhưng vẫn được tính là đã thấy. Không đụng tới widget nên chạy được trên thread mạng.
+    """
+    me_uid = data.get('meUid')
+    out = []
+    for m in data.get('messages', []):
+        is_me = (m.get('senderUid') == me_uid) if me_uid else False
+        row = None
+        if is_group and m.get('system'):
+            pass
+        elif m.get('fileURL'):
+            row = {
+                'fileType': m.get('fileType', 'application'),
+                'fileURL': m.get('fileURL', ''),
+                'fileName': m.get('fileName', 'Unknown'),
+                'is_self': is_me, 'id': m.get('id'), 'ts': m.get('ts')
+            }
+        elif not is_group or m.get('text'):  # Nhóm: chỉ hiển thị nếu có text
+            row = {'text': m.get('text') or '', 'is_self': is_me, 'id': m.get('id'), 'ts': m.get('ts')}
+        out.append((m.get('id'), m.get('ts'), row))
+    return out
+
+
+class MessageListModel(QAbstractListModel):
+    """Danh sách tin nhắn của chat đang mở; mỗi trang lịch sử là một lần insert."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or not (0 <= index.row() < len(self._rows)):
+            return None
+        msg = self._rows[index.row()]
+        if role == MESSAGE_ROLE:
+            return msg
+        if role == Qt.DisplayRole:
+            return msg.get('fileName') if is_file_message(msg) else msg.get('text', '')
+        return None
+
+    def set_messages(self, rows):
+        """Thay toàn bộ danh sách (trang đầu của một chat)."""
+        self.beginResetModel()
+        self._rows = list(rows)
+        self.endResetModel()
+
+    def clear(self):
+        self.set_messages([])
+
+    def append_messages(self, rows):
+        """Thêm vào cuối (tin mới, tin bắt kịp sau kết nối lại)."""
+        if not rows:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        self._rows.extend(rows)
+        self.endInsertRows()
+
+    def prepend_messages(self, rows):
+        """Chèn lên đầu (trang lịch sử cũ hơn)."""
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self._rows[0:0] = rows
+        self.endInsertRows()
+
+    def remove_file(self, file_url):
+        """Xóa các tin có file file_url (file không còn trên Storage); trả về số dòng đã xóa."""
+        removed = 0
+        for row in reversed(range(len(self._rows))):
+            if self._rows[row].get('fileURL') == file_url:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self._rows[row]
+                self.endRemoveRows()
+                removed += 1
+        return removed
+
+
+class MessageDelegate(QStyledItemDelegate):
+    """Vẽ bong bóng văn bản; dòng có file lấy chiều cao từ widget của nó (hoặc chỗ giữ tạm)."""
+
+    def __init__(self, view):
+        super().__init__(view)
+        self._view = view
+        self._font = QFont("Arial", 12)
+        self._metrics = QFontMetrics(self._font)
+
+    def _text_rect(self, text, width):
+        max_text = max(40, min(BUBBLE_MAX_WIDTH, width) - 2 * BUBBLE_PADDING)
+        return self._metrics.boundingRect(QRect(0, 0, max_text, 1000000), Qt.TextWordWrap, text or '')
+
+    def sizeHint(self, option, index):
+        width = self._view.viewport().width()
+        msg = index.data(MESSAGE_ROLE) or {}
+        if is_file_message(msg):
+            widget = self._view.indexWidget(index)
+            if widget is not None:
+                return QSize(width, widget.sizeHint().height())
+            file_type = (msg.get('fileType') or '').lower()
+            return QSize(width, PLACEHOLDER_HEIGHTS.get(file_type, PLACEHOLDER_HEIGHT))
+        rect = self._text_rect(msg.get('text', ''), width)
+        return QSize(width, rect.height() + 2 * BUBBLE_PADDING + 2 * ROW_MARGIN)
+
+    def paint(self, painter, option, index):
+        msg = index.data(MESSAGE_ROLE) or {}
+        is_self = bool(msg.get('is_self'))
+        row = option.rect
+        painter.save()
+        painter.setRenderHint(QPainter.Antialiasing)
+        if is_file_message(msg):
+            if self._view.indexWidget(index) is None:
+                # Widget chưa tạo (dòng vừa cuộn tới): vẽ khung tạm với tên file
+                height = row.height() - 2 * ROW_MARGIN
+                left = row.right() - 300 if is_self else row.left()
+                bubble = QRect(left, row.top() + ROW_MARGIN, 300, height)
+                painter.setPen(Qt.NoPen if is_self else QPen(PEER_BORDER))
+                painter.setBrush(QBrush(SELF_COLOR if is_self else PEER_COLOR))
+                painter.drawRoundedRect(bubble, BUBBLE_RADIUS, BUBBLE_RADIUS)
+                painter.setPen(QColor('#666'))
+                painter.drawText(bubble.adjusted(BUBBLE_PADDING, 0, -BUBBLE_PADDING, 0),
+                                 Qt.AlignVCenter | Qt.TextWordWrap, f"📎 {msg.get('fileName', '')}")
+            painter.restore()
+            return
+        text = msg.get('text', '')
+        text_rect = self._text_rect(text, row.width())
+        bubble_w = text_rect.width() + 2 * BUBBLE_PADDING
+        bubble_h = text_rect.height() + 2 * BUBBLE_PADDING
+        left = row.right() - bubble_w if is_self else row.left()
+        bubble = QRect(left, row.top() + ROW_MARGIN, bubble_w, bubble_h)
+        painter.setPen(Qt.NoPen if is_self else QPen(PEER_BORDER))
+        painter.setBrush(QBrush(SELF_COLOR if is_self else PEER_COLOR))
+        painter.drawRoundedRect(bubble, BUBBLE_RADIUS, BUBBLE_RADIUS)
+        painter.setPen(QColor('black'))
+        painter.setFont(self._font)
+        painter.drawText(bubble.adjusted(BUBBLE_PADDING, BUBBLE_PADDING, -BUBBLE_PADDING, -BUBBLE_PADDING),
+                         Qt.TextWordWrap, text)
+        painter.restore()
+
+
+class MessageListView(QListView):
+    """QListView cho khung chat: cuộn theo pixel, không chọn dòng, widget file tạo lười.
+
+    widget_factory(msg) trả về QWidget cho một tin có file (hoặc None); được gọi một lần
+    cho mỗi dòng khi dòng đó (± PRELOAD_ROWS) xuất hiện trong vùng nhìn thấy.
+    """
+
+    def __init__(self, widget_factory, parent=None):
+        super().__init__(parent)
+        self._widget_factory = widget_factory
+        self._widget_rows = {}  # widget -> QPersistentModelIndex, để đo lại dòng khi widget đổi cỡ
+        self.setItemDelegate(MessageDelegate(self))
+        self.setSelectionMode(QAbstractItemView.NoSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.setResizeMode(QListView.Adjust)
+        self.setUniformItemSizes(False)
+        self.setFocusPolicy(Qt.NoFocus)
+        # Gom các lần cuộn / insert trong một vòng event loop thành một lần tạo widget
+        self._widgets_timer = QTimer(self)
+        self._widgets_timer.setSingleShot(True)
+        self._widgets_timer.setInterval(0)
+        self._widgets_timer.timeout.connect(self._create_visible_widgets)
+        self.verticalScrollBar().valueChanged.connect(self._schedule_widgets)
+
+    def setModel(self, model):
+        super().setModel(model)
+        model.rowsInserted.connect(self._schedule_widgets)
+        model.rowsRemoved.connect(self._schedule_widgets)
+        model.modelReset.connect(self._schedule_widgets)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self._schedule_widgets()
+
+    def _schedule_widgets(self, *args):
+        if not self._widgets_timer.isActive():
+            self._widgets_timer.start()
+
+    def _create_visible_widgets(self):
+        model = self.model()
+        count = model.rowCount() if model is not None else 0
+        if not count:
+            return
+        viewport = self.viewport().rect()
+        first = self.indexAt(viewport.topLeft())
+        last = self.indexAt(viewport.bottomLeft())
+        start = max(0, (first.row() if first.isValid() else 0) - PRELOAD_ROWS)
+        end = min(count - 1, (last.row() if last.isValid() else count - 1) + PRELOAD_ROWS)
+        delegate = self.itemDelegate()
+        for row in range(start, end + 1):
+            index = model.index(row, 0)
+            msg = index.data(MESSAGE_ROLE) or {}
+            if not is_file_message(msg) or self.indexWidget(index) is not None:
+                continue
+            widget = self._widget_factory(msg)
+            if widget is None:
+                continue
+            self.setIndexWidget(index, widget)
+            self._widget_rows[widget] = QPersistentModelIndex(index)
+            widget.installEventFilter(self)
+            widget.destroyed.connect(lambda _=None, w=widget: self._widget_rows.pop(w, None))
+            # Chiều cao dòng đổi từ chỗ giữ tạm sang chiều cao thật của widget
+            delegate.sizeHintChanged.emit(index)
+
+    def eventFilter(self, obj, event):
+        if event.type() == QEvent.LayoutRequest:
+            persistent = self._widget_rows.get(obj)
+            if persistent is not None and persistent.isValid():
+                self.itemDelegate().sizeHintChanged.emit(self.model().index(persistent.row(), 0))
+        return super().eventFilter(obj, event)
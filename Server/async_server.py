@@ -0,0 +1,230 @@
+import asyncio
+import os
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from lib.framing import FRAME_HEADER, UPGRADE_LINE
+except Exception:
+    _lib_path = os.path.join(os.path.dirname(__file__), '..', 'lib')
+    if _lib_path not in sys.path:
+        sys.path.insert(0, _lib_path)
+    from framing import FRAME_HEADER, UPGRADE_LINE
+
+try:
+    from Server.handler import authenticate, session_line, register_client, unregister_client, handle_line, handle_frame, AUTH_LINE_LIMIT, MAX_LINE
+    from Server.state import clients, clients_lock
+    from Server.outbound import MAX_QUEUED_BYTES, OVERFLOW_POLICY, drop_droppable
+    from Server.log import get_logger
+except Exception:
+    from handler import authenticate, session_line, register_client, unregister_client, handle_line, handle_frame, AUTH_LINE_LIMIT, MAX_LINE
+    from state import clients, clients_lock
+    from outbound import MAX_QUEUED_BYTES, OVERFLOW_POLICY, drop_droppable
+    from log import get_logger
+
+_log = get_logger('async')
+
+AUTH_TIMEOUT = 15.0
+
+
+class AsyncConnection:
+    """Socket-like adapter around a StreamWriter.
+
+    Command handlers, broadcast() and the state maps only ever call sendall()/close()
+    on a connection and use it as a dict key, so the asyncio engine hands them this
+    object instead of a real socket. It is also its own outbound queue (put()), with the
+    same byte cap and overflow policy as outbound.OutboundQueue. Safe to call from
+    executor threads; the transport itself is only touched on the loop thread.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter, loop: asyncio.AbstractEventLoop,
+                 max_bytes: int = MAX_QUEUED_BYTES, policy: str = OVERFLOW_POLICY):
+        self._writer = writer
+        self._loop = loop
+        self._closed = False
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped = 0
+        # Writes from worker threads are batched so a burst costs one loop wakeup
+        self._pending: deque[tuple[bytes, bool]] = deque()   # (data, droppable)
+        self._pending_bytes = 0
+        self._pending_lock = threading.Lock()
+
+    def put(self, data: bytes, droppable: bool = False) -> bool:
+        if self._closed:
+            return False
+        with self._pending_lock:
+            # Bytes already in the transport buffer are counted by _flush() on the loop thread
+            excess = self._make_room(self._pending_bytes + len(data) - self.max_bytes)
+            if excess > 0 and droppable and self.policy != 'disconnect':
+                self.dropped += 1
+                return True
+            if excess > 0:
+                self.close()
+                return False
+            self._pending.append((data, droppable))
+            self._pending_bytes += len(data)
+            if len(self._pending) > 1:
+                return True
+        self._loop.call_soon_threadsafe(self._flush)
+        return True
+
+    def sendall(self, data: bytes):
+        if not self.put(bytes(data)):
+            raise ConnectionResetError('connection closed')
+
+    def _make_room(self, excess: int) -> int:
+        """Drop queued broadcasts to free `excess` bytes; returns what is still over. Hold _pending_lock."""
+        if excess > 0 and self.policy != 'disconnect':
+            freed, dropped = drop_droppable(self._pending, excess)
+            self._pending_bytes -= freed
+            self.dropped += dropped
+            excess -= freed
+        return excess
+
+    def _flush(self):
+        # Runs on the loop thread, the only place get_write_buffer_size() may be called
+        transport = self._writer.transport
+        buffered = transport.get_write_buffer_size() if transport is not None else 0
+        with self._pending_lock:
+            excess = self._make_room(buffered + self._pending_bytes - self.max_bytes)
+            pending = list(self._pending)
+            self._pending.clear()
+            self._pending_bytes = 0
+        if excess > 0:
+            self.close()
+            return
+        if self._closed or self._writer.is_closing():
+            return
+        self._writer.writelines([data for data, _ in pending])
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._loop.call_soon_threadsafe(self._writer.close)
+
+    def getpeername(self):
+        return self._writer.get_extra_info('peername')
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes | None:
+    try:
+        line = await reader.readuntil(b"\n")
+    except asyncio.IncompleteReadError:
+        return None
+    return line[:-1]
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> tuple[int, bytes] | None:
+    try:
+        frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        if length > MAX_LINE:
+            raise ValueError(f'frame exceeds {MAX_LINE} bytes')
+        return frame_type, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+async def _serve_frames(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, conn: AsyncConnection,
+                        addr, executor: ThreadPoolExecutor):
+    """Rest of a connection that switched to binary frames."""
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            frame = await _read_frame(reader)
+        except ValueError:
+            conn.put(b'CMD {"type":"ERROR","message":"line_too_long"}\n')
+            return
+        if frame is None:
+            return
+        keep_going = await loop.run_in_executor(executor, handle_frame, conn, addr, frame[0], frame[1])
+        if not keep_going:
+            return
+        await writer.drain()
+
+
+async def _handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, executor: ThreadPoolExecutor):
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info('peername')
+    conn = AsyncConnection(writer, loop)
+    authed = False
+    _log.info('Connection from %s has been established!', addr)
+    try:
+        # The reader's limit is MAX_LINE (commands after AUTH need it); the AUTH line itself
+        # must fit in AUTH_LINE_LIMIT and arrive within AUTH_TIMEOUT
+        try:
+            line = await asyncio.wait_for(_read_line(reader), AUTH_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+            return
+        if line is None or len(line) > AUTH_LINE_LIMIT:
+            return
+        text = line.decode('utf-8', errors='replace')
+        ok, label, uid, email, name, auth_at, resumed = await loop.run_in_executor(executor, authenticate, text)
+        if not ok:
+            writer.write(f"AUTH_ERR {label}\n".encode('utf-8', errors='replace'))
+            return
+        writer.write(b"AUTH_OK\n" + session_line(uid, email, name, auth_at, resumed))
+        await loop.run_in_executor(executor, register_client, conn, label, uid, email, name, resumed)
+        authed = True
+
+        while True:
+            try:
+                line = await _read_line(reader)
+            except (asyncio.LimitOverrunError, ValueError):
+                conn.put(b'CMD {"type":"ERROR","message":"line_too_long"}\n')
+                break
+            if line is None:
+                break
+            if line == UPGRADE_LINE:
+                await _serve_frames(reader, writer, conn, addr, executor)
+                break
+            text = line.decode('utf-8', errors='replace')
+            # Lines are handled in arrival order; io_pools runs the commands of one connection
+            # one at a time so replies keep their order
+            keep_going = await loop.run_in_executor(executor, handle_line, conn, addr, text)
+            if not keep_going:
+                break
+            await writer.drain()
+    except (ConnectionError, asyncio.CancelledError):
+        pass
+    except Exception as exc:
+        _log.warning('Error with %s: %s', addr, exc)
+    finally:
+        if authed:
+            try:
+                await loop.run_in_executor(executor, unregister_client, conn, addr)
+            except Exception:
+                pass
+        else:
+            conn.close()
+
+
+async def serve(host: str, port: int, backlog: int, workers: int):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='chat-io')
+    server = await asyncio.start_server(
+        lambda r, w: _handle_connection(r, w, executor),
+        host, port, backlog=backlog, limit=MAX_LINE,
+    )
+    _log.info('Server (asyncio, backlog=%d, workers=%d) is listening on port %d...', backlog, workers, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        with clients_lock:
+            for c in clients:
+                try:
+                    c.close()
+                except Exception:
+                    pass
+            clients.clear()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_async_server(host: str = '0.0.0.0', port: int = 8080, backlog: int = 128, workers: int = 32):
+    try:
+        asyncio.run(serve(host, port, backlog, workers))
+    except KeyboardInterrupt:
+        _log.info('Shutting down server...')
@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+
+try:
+    from Server import metrics
+except Exception:
+    import metrics
+
+PROFILE_TTL = float(os.environ.get('CHAT_PROFILE_CACHE_TTL', '300'))
+FRIENDS_TTL = float(os.environ.get('CHAT_FRIENDS_CACHE_TTL', '60'))
+BLOB_TTL = float(os.environ.get('CHAT_BLOB_CACHE_TTL', '86400'))
+# Verified ID tokens live until their own exp; this is only the upper bound
+TOKEN_TTL = float(os.environ.get('CHAT_TOKEN_CACHE_TTL', '3600'))
+# How long a user's revocation state (tokensValidAfter, disabled) is trusted
+REVOCATION_TTL = float(os.environ.get('CHAT_AUTH_REVOCATION_RECHECK', '300'))
+MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', '100000'))
+
+
+class TTLCache:
+    """Thread-safe dict whose entries expire ttl seconds after they were stored.
+
+    Entries are also dropped explicitly (invalidate) when the server itself writes the
+    underlying RTDB node, so the TTL only bounds staleness for changes made elsewhere
+    (console, other tools). Hit/miss counts are reported through metrics as cache.<name>.
+    """
+
+    def __init__(self, name: str, ttl: float, max_entries: int = MAX_ENTRIES):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._data: dict = {}
+        self._lock = threading.Lock()
+        metrics.register_gauge(f'cache.{name}', self.stats)
+
+    def get(self, key):
+        """Return the cached value, or None when missing or expired."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, ttl: float | None = None):
+        """Store value for `ttl` seconds (at most the cache's own ttl)."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or value is None:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.max_entries:
+                # dicts keep insertion order, so the first key is the oldest entry
+                del self._data[next(iter(self._data))]
+            self._data[key] = (time.monotonic() + ttl, value)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+
+# uid -> {'uid', 'email', 'displayName'}
+profile_cache = TTLCache('profiles', PROFILE_TTL)
+# uid -> list of friend uids
+friends_cache = TTLCache('friends', FRIENDS_TTL)
+# "{conversation_id}:{sha256}" -> {'fileURL', 'fileType'} of a file already in Storage
+blob_cache = TTLCache('blobs', BLOB_TTL)
+# sha256(id_token) -> {'uid', 'email', 'name', 'label', 'iat'} of a token whose signature checked out
+token_cache = TTLCache('tokens', TOKEN_TTL)
+# uid -> {'valid_after_ms', 'disabled'} from Firebase Auth, for revocation checks
+revocation_cache = TTLCache('revocation', REVOCATION_TTL)
@@ -1,80 +1,111 @@
 import json
+import logging
+import os
+import time
+from typing import Callable, NamedTuple
 
 try:
     from Server.firebase_admin_utils import get_user_by_email, list_friends, get_email_for_uid, ensure_user_profile
+    from Server.firebase_admin_utils import get_profiles, invalidate_friends
     from Server.firebase_admin_utils import init_firebase_if_needed
     from Server.firebase_admin_utils import db
-    from Server.state import socket_to_user
-    from Server.state import uid_to_socket
-    from Server.state import file_chunks_storage, file_chunks_lock
+    from Server.state import uid_to_socket, socket_to_uid, delivery_lock
     from Server.state import active_calls, active_calls_lock
+    from Server.outbound import send_bytes
+    from Server.group_index import group_index
+    from Server.message_store import get_message_store, make_message
+    from Server.pending_delivery import get_pending_queue
+    from Server.upload_spool import DEFAULT_CHUNK_SIZE, MAX_INLINE_FILE_SIZE, UploadRejected, Base64Reader, open_upload, get_upload, take_upload, remember_blob
+    from Server.log import get_logger
+    from Server import metrics, io_pools
 except Exception:
     from firebase_admin_utils import get_user_by_email, list_friends, get_email_for_uid, ensure_user_profile
+    from firebase_admin_utils import get_profiles, invalidate_friends
     from firebase_admin_utils import init_firebase_if_needed
     from firebase_admin_utils import db
-    from state import socket_to_user
-    from state import uid_to_socket
-    from state import file_chunks_storage, file_chunks_lock
+    from state import uid_to_socket, socket_to_uid, delivery_lock
     from state import active_calls, active_calls_lock
+    from outbound import send_bytes
+    from group_index import group_index
+    from message_store import get_message_store, make_message
+    from pending_delivery import get_pending_queue
+    from upload_spool import DEFAULT_CHUNK_SIZE, MAX_INLINE_FILE_SIZE, UploadRejected, Base64Reader, open_upload, get_upload, take_upload, remember_blob
+    from log import get_logger
+    import metrics
+    import io_pools
+
+_log = get_logger('cmd')
+
+# Version of the binary frame channel answered to BINARY_UPGRADE
+BINARY_FRAMES_VERSION = 1
+# Hint sent with 'busy' replies when a worker pool is full
+BUSY_RETRY_AFTER_MS = 500
+# Uids allowed to read server metrics with STATS (comma separated); empty disables STATS
+STATS_ADMIN_UIDS = frozenset(u.strip() for u in os.environ.get('CHAT_STATS_ADMIN_UIDS', '').split(',') if u.strip())
+
 
 # Handle type of command
+class CommandSpec(NamedTuple):
+    # handler(conn, obj, uid); uid is '' only for needs_uid=False commands before AUTH
+    handler: Callable[..., None]
+    # Reject before calling the handler when the connection has no uid yet
+    needs_uid: bool = True
+    # Kind of blocking I/O the handler does: 'db_read', 'db_write', 'storage' or None (memory only)
+    io: str | None = 'db_read'
+    # Reply type the client waits for, used for the generic unauthorized and busy errors
+    reply: str | None = None
+
+
+def _conn_uid(conn) -> str:
+    # Plain sockets (threaded engine) cannot carry _chat_uid, they are only in socket_to_uid
+    return getattr(conn, '_chat_uid', '') or socket_to_uid.get(conn, '')
+
+
 def handle_command_line(conn, obj: dict):
     cmd_type = (obj.get('type') or '').upper()
-    try:
-        print(f"[CMD] received type={cmd_type} obj_keys={list(obj.keys())}")
-    except Exception:
-        pass
-    if cmd_type == 'FIND_USER':
-        _cmd_find_user(conn, obj)
-    elif cmd_type == 'LIST_FRIENDS':
-        _cmd_list_friends(conn)
-    elif cmd_type == 'SEND_FRIEND_REQUEST':
-        _cmd_send_friend_request(conn, obj)
-    elif cmd_type == 'ACCEPT_REQUEST':
-        _cmd_accept_request(conn, obj)
-    elif cmd_type == 'REJECT_REQUEST':
-        _cmd_reject_request(conn, obj)
-    elif cmd_type == 'FRIEND_REQUESTS':
-        _cmd_friend_requests(conn)
-    elif cmd_type == 'SEND_DM':
-        _cmd_send_dm(conn, obj)
-    elif cmd_type == 'LOAD_THREAD':
-        _cmd_load_thread(conn, obj)
-    elif cmd_type == 'CREATE_GROUP':
-        _cmd_create_group(conn, obj)
-    elif cmd_type == 'LIST_GROUPS':
-        _cmd_list_groups(conn)
-    elif cmd_type == 'SEND_GROUP_MESSAGE':
-        _cmd_send_group_message(conn, obj)
-    elif cmd_type == 'LOAD_GROUP_HISTORY':
-        _cmd_load_group_history(conn, obj)
-    elif cmd_type == 'LEAVE_GROUP':
-        _cmd_leave_group(conn, obj)
-    elif cmd_type == 'LIST_GROUP_MEMBERS':
-        _cmd_list_group_members(conn, obj)
-    elif cmd_type == 'SEND_FILE':
-        _cmd_send_file(conn, obj)
-    elif cmd_type == 'SEND_FILE_URL':
-        _cmd_send_file_url(conn, obj)
-    elif cmd_type == 'SEND_FILE_START':
-        _cmd_send_file_start(conn, obj)
-    elif cmd_type == 'SEND_FILE_CHUNK':
-        _cmd_send_file_chunk(conn, obj)
-    elif cmd_type == 'SEND_FILE_END':
-        _cmd_send_file_end(conn, obj)
-    elif cmd_type == 'CALL_INVITE':
-        _cmd_call_invite(conn, obj)
-    elif cmd_type == 'CALL_ACCEPT':
-        _cmd_call_accept(conn, obj)
-    elif cmd_type == 'CALL_REJECT':
-        _cmd_call_reject(conn, obj)
-    elif cmd_type == 'CALL_END':
-        _cmd_call_end(conn, obj)
-    else:
+    spec = COMMANDS.get(cmd_type)
+    if spec is None:
+        _log.debug('unknown command type=%s', cmd_type)
+        metrics.record_command('UNKNOWN', 0.0, ok=False)
         _send_cmd(conn, { 'type': 'ERROR', 'message': 'unknown_command' })
+        return
+    if _log.isEnabledFor(logging.DEBUG):
+        _log.debug('received type=%s keys=%s', cmd_type, list(obj.keys()))
+    uid = _conn_uid(conn)
+    if spec.needs_uid and not uid:
+        metrics.record_command(cmd_type, 0.0, ok=False)
+        _send_cmd(conn, { 'type': spec.reply or 'ERROR', 'ok': False, 'error': 'unauthorized' })
+        return
 
-
-def _cmd_find_user(conn, obj: dict):
+    def run():
+        started = time.perf_counter()
+        ok = False
+        try:
+            spec.handler(conn, obj, uid)
+            ok = True
+        except Exception as e:
+            _log.warning('command %s failed: %s', cmd_type, e)
+            _send_cmd(conn, { 'type': 'ERROR', 'message': f'cmd_failed: {e}' })
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.record_command(cmd_type, elapsed, ok)
+            if _log.isEnabledFor(logging.DEBUG):
+                _log.debug('handled type=%s ok=%s in %.1f ms', cmd_type, ok, elapsed * 1000.0)
+
+    # Firebase/Storage calls run on the pool for spec.io, after this connection's earlier commands
+    if not io_pools.submit(conn, spec.io, run):
+        metrics.record_command(cmd_type, 0.0, ok=False)
+        busy = { 'type': spec.reply or 'ERROR', 'ok': False, 'error': 'busy', 'retryAfterMs': BUSY_RETRY_AFTER_MS }
+        if obj.get('clientMsgId'):
+            busy['clientMsgId'] = obj['clientMsgId']
+        if 'chunkIndex' in obj:
+            # The uploader resends just this chunk
+            busy['chunkIndex'] = obj['chunkIndex']
+        # Queued behind the connection's earlier commands too, so replies stay in order
+        io_pools.submit(conn, None, lambda: _send_cmd(conn, busy))
+
+
+def _cmd_find_user(conn, obj: dict, uid: str):
     email = (obj.get('email') or '').strip()
     if not email:
         _send_cmd(conn, { 'type': 'FIND_USER_RESULT', 'found': False, 'error': 'missing_email' })
@@ -93,33 +124,47 @@ def _cmd_find_user(conn, obj: dict):
 
 # Send command to client
 def _send_cmd(conn, obj: dict):
+    send_bytes(conn, ("CMD " + json.dumps(obj) + "\n").encode('utf-8'))
+
+
+def _queue_offline(uids, payload: str):
     try:
-        conn.sendall(("CMD " + json.dumps(obj) + "\n").encode('utf-8'))
-    except Exception:
-        pass
+        get_pending_queue().add(uids, payload)
+    except Exception as e:
+        _log.warning('queueing event for %d offline user(s) failed: %s', len(uids), e)
 
 
-def _cmd_list_friends(conn):
-    # Pull uid from connection attribute set during AUTH
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        # Fallback resolve from socket_to_uid map
-        try:
-            from state import socket_to_uid as _s2u  # type: ignore
-        except Exception:
-            from state import socket_to_uid as _s2u  # type: ignore
-        try:
-            uid = _s2u.get(conn, '')
-        except Exception:
-            uid = ''
-        if not uid:
-            _send_cmd(conn, { 'type': 'FRIENDS', 'friends': [], 'error': 'unauthorized' })
+def _send_to_user(uid: str, obj: dict):
+    """Push a message event to uid, or queue it for the PENDING batch at uid's next login."""
+    payload = json.dumps(obj)
+    with delivery_lock:
+        sock = uid_to_socket.get(uid)
+        if sock is not None and send_bytes(sock, ("CMD " + payload + "\n").encode('utf-8')):
             return
+        _queue_offline([uid], payload)
+
+
+def _send_to_group(group_id: str, obj: dict, exclude_uid: str = ''):
+    # Fan out to online members; the payload is encoded once for all of them and queued
+    # in one batch for the members that are offline
+    payload = json.dumps(obj)
+    data = ("CMD " + payload + "\n").encode('utf-8')
+    offline = []
+    members = group_index.members(group_id)
+    with delivery_lock:
+        for member_uid in members:
+            if member_uid == exclude_uid:
+                continue
+            member_socket = uid_to_socket.get(member_uid)
+            if member_socket is None or not send_bytes(member_socket, data):
+                offline.append(member_uid)
+        if offline:
+            _queue_offline(offline, payload)
+
+
+def _cmd_list_friends(conn, obj: dict, uid: str):
     friends = list_friends(uid)
-    try:
-        print(f"[FRIEND] LIST_FRIENDS uid={uid}: {len(friends)} item(s)")
-    except Exception:
-        pass
+    _log.debug('LIST_FRIENDS uid=%s: %d item(s)', uid, len(friends))
     _send_cmd(conn, { 'type': 'FRIENDS', 'friends': friends })
 
 
@@ -140,15 +185,7 @@ def _make_thread_id(uid_a: str, uid_b: str) -> str:
     return f"{uid_b}__{uid_a}"
 
 
-def _cmd_send_dm(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        # try fallback
-        try:
-            from Server.state import socket_to_uid as _s2u  
-        except Exception:
-            from state import socket_to_uid as _s2u  
-        uid = _s2u.get(conn, '') if _s2u else ''
+def _cmd_send_dm(conn, obj: dict, uid: str):
     to_uid = (obj.get('toUid') or '').strip()
     text = (obj.get('text') or '').strip()
     client_msg_id = (obj.get('clientMsgId') or '').strip()
@@ -159,133 +196,99 @@ def _cmd_send_dm(conn, obj: dict):
         init_firebase_if_needed()
         thread_id = _make_thread_id(uid, to_uid)
         # Write message to database
-        msg_ref = db.reference(f'/chats/{thread_id}/messages').push({
-            'senderUid': uid,
-            'text': text,
-            'ts': {'.sv': 'timestamp'},
-        })
-        # Deliver to recipient if user online
+        record = get_message_store().append(thread_id, make_message(uid, text))
+        # Deliver to recipient now, or at their next login
         try:
-            peer_socket = uid_to_socket.get(to_uid)
-            if peer_socket is not None:
-                _send_cmd(peer_socket, { 'type': 'DM', 'fromUid': uid, 'text': text, 'threadId': thread_id })
+            _send_to_user(to_uid, { 'type': 'DM', 'fromUid': uid, 'text': text, 'threadId': thread_id,
+                                    'messageId': record['id'], 'ts': record['ts'] })
         except Exception:
             pass
-        _send_cmd(conn, { 'type': 'DM_DELIVERED', 'ok': True, 'clientMsgId': client_msg_id, 'threadId': thread_id })
+        _send_cmd(conn, { 'type': 'DM_DELIVERED', 'ok': True, 'clientMsgId': client_msg_id, 'threadId': thread_id,
+                          'messageId': record['id'], 'ts': record['ts'] })
     except Exception as e:
         _send_cmd(conn, { 'type': 'DM_DELIVERED', 'ok': False, 'clientMsgId': client_msg_id, 'error': f'{e}' })
 
 
-def _cmd_load_thread(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Chat.Server.state import socket_to_uid as _s2u  # type: ignore
-        except Exception:
-            from state import socket_to_uid as _s2u  # type: ignore
-        uid = _s2u.get(conn, '') if _s2u else ''
-    peer_uid = (obj.get('peerUid') or '').strip()
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 200
+
+
+def _cursor(obj: dict, ts_key: str, id_key: str) -> tuple[int | None, str]:
+    ts = obj.get(ts_key)
+    if not isinstance(ts, (int, float)) or isinstance(ts, bool) or ts <= 0:
+        ts = None
+    else:
+        ts = int(ts)
+    return ts, obj.get(id_key) if isinstance(obj.get(id_key), str) else ''
+
+
+def _page_params(obj: dict) -> tuple[int, int | None, str, int | None, str]:
+    """(limit, before_ts, before_id, after_ts, after_id) of a history request.
+
+    before/beforeId are the ts and id of the oldest message the client already shows;
+    the page holds the `limit` newest messages strictly older than that. after/afterId
+    are the newest message it has seen (its cursor on reconnect); the page then holds
+    the `limit` oldest messages strictly newer, so only missed messages are replayed.
+    """
     limit = obj.get('limit')
+    if not isinstance(limit, int) or limit <= 0:
+        limit = DEFAULT_HISTORY_LIMIT
+    limit = min(limit, MAX_HISTORY_LIMIT)
+    before, before_id = _cursor(obj, 'before', 'beforeId')
+    after, after_id = _cursor(obj, 'after', 'afterId')
+    return limit, before, before_id, after, after_id
+
+
+def _load_history_page(conversation_id: str, is_group: bool, obj: dict) -> dict:
+    """One page of history from the message store.
+
+    Returns the fields shared by DM_HISTORY and GROUP_HISTORY: messages (ascending),
+    hasMore and the cursor of the next older page, or of the next newer one for an
+    `after` (catch-up) request.
+    """
+    limit, before, before_id, after, after_id = _page_params(obj)
+    if after is not None:
+        messages, has_more = get_message_store().page(conversation_id, is_group, limit,
+                                                      after=after, after_id=after_id)
+        page = { 'messages': messages, 'hasMore': has_more, 'limit': limit, 'after': after, 'afterId': after_id }
+        if messages:
+            page['nextAfter'] = messages[-1]['ts']
+            page['nextAfterId'] = messages[-1]['id']
+        return page
+    messages, has_more = get_message_store().page(conversation_id, is_group, limit, before, before_id)
+    page = { 'messages': messages, 'hasMore': has_more, 'limit': limit }
+    if before is not None:
+        page['before'] = before
+        page['beforeId'] = before_id
+    if messages:
+        page['nextBefore'] = messages[0]['ts']
+        page['nextBeforeId'] = messages[0]['id']
+    return page
+
+
+def _cmd_load_thread(conn, obj: dict, uid: str):
+    peer_uid = (obj.get('peerUid') or '').strip()
     if not uid or not peer_uid:
         _send_cmd(conn, { 'type': 'DM_HISTORY', 'ok': False, 'error': 'missing_params' })
         return
     try:
         init_firebase_if_needed()
         thread_id = _make_thread_id(uid, peer_uid)
-        ref = db.reference(f'/chats/{thread_id}/messages')
-        data = ref.get() or {}
-        messages = []
-        if isinstance(data, dict):
-            for mid, m in data.items():
-                if not isinstance(m, dict):
-                    continue
-                messages.append({
-                    'id': mid,
-                    'senderUid': m.get('senderUid') or '',
-                    'text': m.get('text') or '',
-                    'ts': m.get('ts') or 0,
-                })
-        # Sort by ts asc
-        messages.sort(key=lambda x: x.get('ts') or 0)
-        if isinstance(limit, int) and limit > 0:
-            messages = messages[-limit:]
-        
-        # Load file messages từ Firestore
-        try:
-            from firebase_admin import firestore as admin_firestore
-            db_fs = admin_firestore.client()
-            fs_messages_ref = db_fs.collection("conversations").document(thread_id).collection("messages")
-            fs_messages = fs_messages_ref.order_by("timestamp").limit(limit if isinstance(limit, int) and limit > 0 else 100).stream()
-            
-            for doc in fs_messages:
-                msg_data = doc.to_dict()
-                if msg_data:
-                    # Convert Firestore timestamp to milliseconds
-                    timestamp = msg_data.get('timestamp')
-                    if hasattr(timestamp, 'timestamp'):
-                        ts_ms = int(timestamp.timestamp() * 1000)
-                    else:
-                        ts_ms = 0
-                    
-                    messages.append({
-                        'id': doc.id,
-                        'senderUid': msg_data.get('senderId', ''),
-                        'text': '',  # File message không có text
-                        'ts': ts_ms,
-                        'fileURL': msg_data.get('fileURL', ''),
-                        'fileType': msg_data.get('fileType', 'application'),
-                        'fileName': msg_data.get('fileName', 'Unknown')
-                    })
-        except Exception as e:
-            print(f"[DM_HISTORY] Error loading Firestore messages: {e}")
-        
-        # Sort lại tất cả messages theo timestamp
-        messages.sort(key=lambda x: x.get('ts') or 0)
-        if isinstance(limit, int) and limit > 0:
-            messages = messages[-limit:]
-        
-        _send_cmd(conn, { 'type': 'DM_HISTORY', 'ok': True, 'threadId': thread_id, 'peerUid': peer_uid, 'meUid': uid, 'messages': messages })
+        page = _load_history_page(thread_id, False, obj)
+        _send_cmd(conn, { 'type': 'DM_HISTORY', 'ok': True, 'threadId': thread_id, 'peerUid': peer_uid, 'meUid': uid, **page })
     except Exception as e:
         _send_cmd(conn, { 'type': 'DM_HISTORY', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_send_friend_request(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        # Fallback resolve uid by the label (email) stored at handshake
-        try:
-            label = socket_to_user.get(conn) or ''
-            if label:
-                rec = get_user_by_email(label)
-                if rec and rec.get('uid'):
-                    uid = rec['uid']
-                    try:
-                        conn._chat_uid = uid  
-                    except Exception:
-                        pass
-        except Exception:
-            pass
-    if not uid:
-        try:
-            print(f"[FRIEND] SEND_FRIEND_REQUEST unauthorized: conn has no uid. obj={obj}")
-        except Exception:
-            pass
-        _send_cmd(conn, { 'type': 'FRIEND_REQUEST_SENT', 'ok': False, 'error': 'unauthorized' })
-        return
+def _cmd_send_friend_request(conn, obj: dict, uid: str):
     to_uid = _resolve_uid_from_obj(obj)
     if not to_uid or to_uid == uid:
-        try:
-            print(f"[FRIEND] SEND_FRIEND_REQUEST invalid_target: from={uid}, to_uid={to_uid}, obj={obj}")
-        except Exception:
-            pass
+        _log.info('SEND_FRIEND_REQUEST invalid_target: from=%s to_uid=%s', uid, to_uid)
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_SENT', 'ok': False, 'error': 'invalid_target' })
         return
     try:
         init_firebase_if_needed()
-        try:
-            print(f"[FRIEND] SEND_FRIEND_REQUEST from={uid} to={to_uid}")
-        except Exception:
-            pass
+        _log.info('SEND_FRIEND_REQUEST from=%s to=%s', uid, to_uid)
         # Guard 1: already friends (either direction)
         already_a = bool(db.reference(f'/users/{uid}/friends/{to_uid}').get())
         already_b = bool(db.reference(f'/users/{to_uid}/friends/{uid}').get())
@@ -308,17 +311,7 @@ def _cmd_send_friend_request(conn, obj: dict):
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_SENT', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_accept_request(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '') 
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u  
-        except Exception:
-            from state import socket_to_uid as _s2u  
-        try:
-            uid = _s2u.get(conn, '')
-        except Exception:
-            uid = ''
+def _cmd_accept_request(conn, obj: dict, uid: str):
     from_uid = (obj.get('fromUid') or '').strip()
     if not from_uid:
         from_email = (obj.get('fromEmail') or '').strip()
@@ -327,21 +320,16 @@ def _cmd_accept_request(conn, obj: dict):
             from_uid = (rec or {}).get('uid') or ''
     request_id = (obj.get('requestId') or '').strip()
     if not uid or not from_uid:
-        try:
-            print(f"[FRIEND] ACCEPT_REQUEST missing_params: uid={uid}, from_uid={from_uid}, obj={obj}")
-        except Exception:
-            pass
+        _log.info('ACCEPT_REQUEST missing_params: uid=%s from_uid=%s', uid, from_uid)
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_ACCEPTED', 'ok': False, 'error': 'missing_params' })
         return
     try:
         init_firebase_if_needed()
-        try:
-            print(f"[FRIEND] ACCEPT_REQUEST uid={uid} from_uid={from_uid} request_id={request_id}")
-        except Exception:
-            pass
+        _log.info('ACCEPT_REQUEST uid=%s from_uid=%s request_id=%s', uid, from_uid, request_id)
         # Create friendships both directions under /users
         db.reference(f'/users/{uid}/friends/{from_uid}').set(True)
         db.reference(f'/users/{from_uid}/friends/{uid}').set(True)
+        invalidate_friends(uid, from_uid)
         # Remove request
         db.reference(f'/users/{uid}/incoming_requests/{from_uid}').delete()
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_ACCEPTED', 'ok': True, 'fromUid': from_uid })
@@ -349,17 +337,7 @@ def _cmd_accept_request(conn, obj: dict):
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_ACCEPTED', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_reject_request(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u  
-        except Exception:
-            from state import socket_to_uid as _s2u  
-        try:
-            uid = _s2u.get(conn, '')
-        except Exception:
-            uid = ''
+def _cmd_reject_request(conn, obj: dict, uid: str):
     from_uid = (obj.get('fromUid') or '').strip()
     if not from_uid:
         from_email = (obj.get('fromEmail') or '').strip()
@@ -368,18 +346,12 @@ def _cmd_reject_request(conn, obj: dict):
             from_uid = (rec or {}).get('uid') or ''
     request_id = (obj.get('requestId') or '').strip()
     if not uid or not from_uid:
-        try:
-            print(f"[FRIEND] REJECT_REQUEST missing_params: uid={uid}, from_uid={from_uid}, obj={obj}")
-        except Exception:
-            pass
+        _log.info('REJECT_REQUEST missing_params: uid=%s from_uid=%s', uid, from_uid)
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_REJECTED', 'ok': False, 'error': 'missing_params' })
         return
     try:
         init_firebase_if_needed()
-        try:
-            print(f"[FRIEND] REJECT_REQUEST uid={uid} from_uid={from_uid} request_id={request_id}")
-        except Exception:
-            pass
+        _log.info('REJECT_REQUEST uid=%s from_uid=%s request_id=%s', uid, from_uid, request_id)
         # Remove request under /users
         db.reference(f'/users/{uid}/incoming_requests/{from_uid}').delete()
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_REJECTED', 'ok': True, 'fromUid': from_uid })
@@ -387,62 +359,30 @@ def _cmd_reject_request(conn, obj: dict):
         _send_cmd(conn, { 'type': 'FRIEND_REQUEST_REJECTED', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_friend_requests(conn):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        # Fallback: attempt to fetch uid from state map by socket
-        try:
-            from Chat.Server.state import socket_to_uid as _s2u  # type: ignore
-        except Exception:
-            from state import socket_to_uid as _s2u 
-        try:
-            uid = _s2u.get(conn, '')
-        except Exception:
-            uid = ''
-        if not uid:
-            try:
-                print("[FRIEND] REQUESTS unauthorized: connection has no uid")
-            except Exception:
-                pass
-            _send_cmd(conn, { 'type': 'FRIEND_REQUESTS', 'requests': [], 'error': 'unauthorized' })
-            return
+def _cmd_friend_requests(conn, obj: dict, uid: str):
     try:
         init_firebase_if_needed()
         path = f'/users/{uid}/incoming_requests'
         data = db.reference(path).get() or {}
         requests = []
         if isinstance(data, dict):
+            # Resolve emails for display in one batch
+            try:
+                profiles = get_profiles(data.keys())
+            except Exception:
+                profiles = {}
             for from_uid, r in data.items():
                 created_at = r.get('createdAt') if isinstance(r, dict) else None
-                # Resolve email for display
-                try:
-                    email = get_email_for_uid(from_uid) or ''
-                except Exception:
-                    email = ''
+                email = (profiles.get(from_uid) or {}).get('email') or ''
                 requests.append({ 'requestId': from_uid, 'fromUid': from_uid, 'fromEmail': email, 'createdAt': created_at })
-        try:
-            print(f"[FRIEND] REQUESTS for uid={uid} path={path}: {len(requests)} item(s)")
-        except Exception:
-            pass
+        _log.debug('FRIEND_REQUESTS uid=%s path=%s: %d item(s)', uid, path, len(requests))
         _send_cmd(conn, { 'type': 'FRIEND_REQUESTS', 'requests': requests })
     except Exception as e:
         _send_cmd(conn, { 'type': 'FRIEND_REQUESTS', 'requests': [], 'error': f'{e}' })
 
 
 # Group chat commands
-def _cmd_create_group(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
-    if not uid:
-        _send_cmd(conn, { 'type': 'GROUP_CREATED', 'ok': False, 'error': 'unauthorized' })
-        return
-    
+def _cmd_create_group(conn, obj: dict, uid: str):
     group_name = (obj.get('name') or '').strip()
     member_uids = obj.get('memberUids') or []
     
@@ -501,12 +441,12 @@ def _cmd_create_group(conn, obj: dict):
             'displayName': creator_name or creator_email.split('@')[0] if creator_email else 'Unknown'
         })
         
-        # Create group in database
+        # Create group in database; createdAt is written explicitly so group_index holds the stored value
         group_data = {
             'id': group_id,
             'name': group_name,
             'createdBy': uid,
-            'createdAt': {'.sv': 'timestamp'},
+            'createdAt': int(time.time() * 1000),
             'members': {member['uid']: True for member in members}
         }
         
@@ -516,6 +456,7 @@ def _cmd_create_group(conn, obj: dict):
         # Add group to each member's groups list
         for member in members:
             db.reference(f'/users/{member["uid"]}/groups/{group_id}').set(True)
+        group_index.set_group(group_id, group_data['members'], group_data)
         
         # Send success response
         _send_cmd(conn, {
@@ -526,28 +467,13 @@ def _cmd_create_group(conn, obj: dict):
             'members': members
         })
         
-        try:
-            print(f"[GROUP] Created group {group_name} (id={group_id}) with {len(members)} members")
-        except Exception:
-            pass
+        _log.info('Created group %s (id=%s) with %d members', group_name, group_id, len(members))
             
     except Exception as e:
         _send_cmd(conn, { 'type': 'GROUP_CREATED', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_list_groups(conn):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
-    if not uid:
-        _send_cmd(conn, { 'type': 'GROUPS', 'groups': [], 'error': 'unauthorized' })
-        return
-    
+def _cmd_list_groups(conn, obj: dict, uid: str):
     try:
         init_firebase_if_needed()
         
@@ -555,30 +481,32 @@ def _cmd_list_groups(conn):
         user_groups_ref = db.reference(f'/users/{uid}/groups')
         user_groups = user_groups_ref.get() or {}
         
-        groups = []
+        group_datas = []
         for group_id in user_groups.keys():
             try:
-                # Get group data
-                group_ref = db.reference(f'/groups/{group_id}')
-                group_data = group_ref.get()
-                
-                if not isinstance(group_data, dict):
-                    continue
-                
+                # Group metadata and members from the index (never the messages subtree)
+                info = group_index.info(group_id)
+                if info is not None:
+                    group_datas.append((group_id, { **info, 'members': group_index.members(group_id) }))
+            except Exception:
+                continue
+
+        # Member profiles of every group in one batch
+        try:
+            profiles = get_profiles(m for _, g in group_datas for m in (g.get('members') or {}))
+        except Exception:
+            profiles = {}
+
+        groups = []
+        for group_id, group_data in group_datas:
+            try:
                 # Get member details
                 members = []
-                group_members = group_data.get('members', {})
-                for member_uid in group_members.keys():
+                for member_uid in sorted(group_data['members']):
                     try:
-                        member_email = get_email_for_uid(member_uid) or ''
-                        member_name = ''
-                        try:
-                            user_ref = db.reference(f'/users/{member_uid}')
-                            user_data = user_ref.get()
-                            if isinstance(user_data, dict):
-                                member_name = user_data.get('displayName', '')
-                        except Exception:
-                            pass
+                        prof = profiles.get(member_uid) or {}
+                        member_email = prof.get('email') or ''
+                        member_name = prof.get('displayName') or ''
                         
                         members.append({
                             'uid': member_uid,
@@ -594,9 +522,9 @@ def _cmd_list_groups(conn):
                 
                 groups.append({
                     'groupId': group_id,
-                    'name': group_data.get('name', 'Unknown Group'),
-                    'createdBy': group_data.get('createdBy', ''),
-                    'createdAt': group_data.get('createdAt', 0),
+                    'name': group_data.get('name') or 'Unknown Group',
+                    'createdBy': group_data.get('createdBy') or '',
+                    'createdAt': group_data.get('createdAt') or 0,
                     'members': members
                 })
                 
@@ -605,24 +533,13 @@ def _cmd_list_groups(conn):
         
         _send_cmd(conn, { 'type': 'GROUPS', 'groups': groups })
         
-        try:
-            print(f"[GROUP] LIST_GROUPS for uid={uid}: {len(groups)} groups")
-        except Exception:
-            pass
+        _log.debug('LIST_GROUPS uid=%s: %d groups', uid, len(groups))
             
     except Exception as e:
         _send_cmd(conn, { 'type': 'GROUPS', 'groups': [], 'error': f'{e}' })
 
 
-def _cmd_send_group_message(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
+def _cmd_send_group_message(conn, obj: dict, uid: str):
     group_id = (obj.get('groupId') or '').strip()
     text = (obj.get('text') or '').strip()
     
@@ -634,54 +551,32 @@ def _cmd_send_group_message(conn, obj: dict):
         init_firebase_if_needed()
         
         # Check if user is member of group
-        user_in_group = bool(db.reference(f'/users/{uid}/groups/{group_id}').get())
-        if not user_in_group:
+        if not group_index.is_member(group_id, uid):
             _send_cmd(conn, { 'type': 'GROUP_MESSAGE_DELIVERED', 'ok': False, 'error': 'not_member' })
             return
         
         # Store message in database
-        msg_ref = db.reference(f'/groups/{group_id}/messages').push({
+        record = get_message_store().append(group_id, make_message(uid, text), is_group=True)
+        
+        # Deliver to online members (skip sender)
+        _send_to_group(group_id, {
+            'type': 'GROUP_MESSAGE',
+            'groupId': group_id,
             'senderUid': uid,
             'text': text,
-            'ts': {'.sv': 'timestamp'},
-        })
+            'messageId': record['id'],
+            'ts': record['ts']
+        }, exclude_uid=uid)
         
-        # Get group members and deliver to online members
-        group_data = db.reference(f'/groups/{group_id}').get() or {}
-        group_members = group_data.get('members', {})
-        
-        for member_uid in group_members.keys():
-            if member_uid == uid:  # Skip sender
-                continue
-            try:
-                member_socket = uid_to_socket.get(member_uid)
-                if member_socket is not None:
-                    _send_cmd(member_socket, {
-                        'type': 'GROUP_MESSAGE',
-                        'groupId': group_id,
-                        'senderUid': uid,
-                        'text': text
-                    })
-            except Exception:
-                pass
-        
-        _send_cmd(conn, { 'type': 'GROUP_MESSAGE_DELIVERED', 'ok': True, 'groupId': group_id })
+        _send_cmd(conn, { 'type': 'GROUP_MESSAGE_DELIVERED', 'ok': True, 'groupId': group_id,
+                          'messageId': record['id'], 'ts': record['ts'] })
         
     except Exception as e:
         _send_cmd(conn, { 'type': 'GROUP_MESSAGE_DELIVERED', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_load_group_history(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
+def _cmd_load_group_history(conn, obj: dict, uid: str):
     group_id = (obj.get('groupId') or '').strip()
-    limit = obj.get('limit', 50)
     
     if not uid or not group_id:
         _send_cmd(conn, { 'type': 'GROUP_HISTORY', 'ok': False, 'error': 'missing_params' })
@@ -690,68 +585,13 @@ def _cmd_load_group_history(conn, obj: dict):
     try:
         init_firebase_if_needed()
         # Allow loading history even if user left the group (read-only view)
-        
-        # Get group messages
-        messages_ref = db.reference(f'/groups/{group_id}/messages')
-        data = messages_ref.get() or {}
-        messages = []
-        
-        if isinstance(data, dict):
-            for mid, m in data.items():
-                if not isinstance(m, dict):
-                    continue
-                messages.append({
-                    'id': mid,
-                    'senderUid': m.get('senderUid') or '',
-                    'text': m.get('text') or '',
-                    'ts': m.get('ts') or 0,
-                })
-        
-        # Sort by timestamp ascending
-        messages.sort(key=lambda x: x.get('ts') or 0)
-        
-        # Load file messages từ Firestore
-        try:
-            from firebase_admin import firestore as admin_firestore
-            db_fs = admin_firestore.client()
-            fs_messages_ref = db_fs.collection("conversations").document(group_id).collection("messages")
-            fs_messages = fs_messages_ref.order_by("timestamp").limit(limit if isinstance(limit, int) and limit > 0 else 100).stream()
-            
-            for doc in fs_messages:
-                msg_data = doc.to_dict()
-                if msg_data:
-                    # Convert Firestore timestamp to milliseconds
-                    timestamp = msg_data.get('timestamp')
-                    if hasattr(timestamp, 'timestamp'):
-                        ts_ms = int(timestamp.timestamp() * 1000)
-                    else:
-                        ts_ms = 0
-                    
-                    messages.append({
-                        'id': doc.id,
-                        'senderUid': msg_data.get('senderId', ''),
-                        'text': '',  # File message không có text
-                        'ts': ts_ms,
-                        'fileURL': msg_data.get('fileURL', ''),
-                        'fileType': msg_data.get('fileType', 'application'),
-                        'fileName': msg_data.get('fileName', 'Unknown')
-                    })
-        except Exception as e:
-            print(f"[GROUP_HISTORY] Error loading Firestore messages: {e}")
-        
-        # Sort lại tất cả messages theo timestamp
-        messages.sort(key=lambda x: x.get('ts') or 0)
-        
-        # Apply limit
-        if isinstance(limit, int) and limit > 0:
-            messages = messages[-limit:]
-        
+        page = _load_history_page(group_id, True, obj)
         _send_cmd(conn, {
             'type': 'GROUP_HISTORY',
             'ok': True,
             'groupId': group_id,
             'meUid': uid,  # Thêm meUid để client biết tin nhắn nào là của mình
-            'messages': messages
+            **page
         })
         
     except Exception as e:
@@ -759,22 +599,7 @@ def _cmd_load_group_history(conn, obj: dict):
 
 
 # --- Additional group commands: leave and list members ---
-def _require_uid(conn) -> str:
-    uid = getattr(conn, '_chat_uid', '')
-    if uid:
-        return uid
-    try:
-        from Chat.Server.state import socket_to_uid as _s2u  # type: ignore
-    except Exception:
-        from state import socket_to_uid as _s2u  # type: ignore
-    try:
-        return _s2u.get(conn, '')
-    except Exception:
-        return ''
-
-
-def _cmd_leave_group(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_leave_group(conn, obj: dict, uid: str):
     group_id = (obj.get('groupId') or '').strip()
     if not uid or not group_id:
         _send_cmd(conn, { 'type': 'LEAVE_GROUP_OK', 'ok': False, 'error': 'missing_params' })
@@ -784,6 +609,7 @@ def _cmd_leave_group(conn, obj: dict):
         # Remove from group members and user's group list
         db.reference(f'/groups/{group_id}/members/{uid}').delete()
         db.reference(f'/users/{uid}/groups/{group_id}').delete()
+        group_index.remove_member(group_id, uid)
         # Compose system text and persist as a system message
         try:
             leaver_email = get_email_for_uid(uid) or ''
@@ -791,27 +617,12 @@ def _cmd_leave_group(conn, obj: dict):
             leaver_email = uid
         sys_text = f"{leaver_email} đã rời nhóm"
         try:
-            db.reference(f'/groups/{group_id}/messages').push({
-                'senderUid': '',
-                'system': True,
-                'text': sys_text,
-                'ts': {'.sv': 'timestamp'},
-            })
+            get_message_store().append(group_id, make_message('', sys_text, system=True), is_group=True)
         except Exception:
             pass
         # Notify remaining online members in realtime
         try:
-            mems = db.reference(f'/groups/{group_id}/members').get() or {}
-            if isinstance(mems, dict):
-                for m_uid, linked in mems.items():
-                    if not linked:
-                        continue
-                    try:
-                        peer_socket = uid_to_socket.get(m_uid)
-                        if peer_socket is not None:
-                            _send_cmd(peer_socket, { 'type': 'GROUP_SYSTEM', 'groupId': group_id, 'event': 'member_left', 'uid': uid, 'text': sys_text })
-                    except Exception:
-                        pass
+            _send_to_group(group_id, { 'type': 'GROUP_SYSTEM', 'groupId': group_id, 'event': 'member_left', 'uid': uid, 'text': sys_text })
         except Exception:
             pass
         _send_cmd(conn, { 'type': 'LEAVE_GROUP_OK', 'ok': True, 'groupId': group_id })
@@ -819,8 +630,7 @@ def _cmd_leave_group(conn, obj: dict):
         _send_cmd(conn, { 'type': 'LEAVE_GROUP_OK', 'ok': False, 'error': f'{e}' })
 
 
-def _cmd_list_group_members(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_list_group_members(conn, obj: dict, uid: str):
     group_id = (obj.get('groupId') or '').strip()
     if not uid or not group_id:
         _send_cmd(conn, { 'type': 'GROUP_MEMBERS', 'ok': False, 'members': [], 'error': 'missing_params' })
@@ -828,39 +638,41 @@ def _cmd_list_group_members(conn, obj: dict):
     try:
         init_firebase_if_needed()
         # Require membership to view
-        in_group = bool(db.reference(f'/users/{uid}/groups/{group_id}').get())
-        if not in_group:
+        mems = group_index.members(group_id)
+        if uid not in mems:
             _send_cmd(conn, { 'type': 'GROUP_MEMBERS', 'ok': False, 'members': [], 'error': 'not_member' })
             return
-        mems = db.reference(f'/groups/{group_id}/members').get() or {}
         members: list[dict] = []
-        if isinstance(mems, dict):
-            for m_uid, linked in mems.items():
-                if not linked:
-                    continue
-                try:
-                    email = get_email_for_uid(m_uid) or ''
-                except Exception:
-                    email = ''
+        if mems:
+            try:
+                profiles = get_profiles(mems)
+            except Exception:
+                profiles = {}
+            for m_uid in sorted(mems):
+                email = (profiles.get(m_uid) or {}).get('email') or ''
                 members.append({ 'uid': m_uid, 'email': email })
         _send_cmd(conn, { 'type': 'GROUP_MEMBERS', 'ok': True, 'groupId': group_id, 'members': members })
     except Exception as e:
         _send_cmd(conn, { 'type': 'GROUP_MEMBERS', 'ok': False, 'members': [], 'error': f'{e}' })
 
 
-def _cmd_send_file(conn, obj: dict):
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
-    if not uid:
-        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'error': 'unauthorized' })
-        return
+def _store_file_message(conversation_id: str, is_group: bool, sender_uid: str, file_path: str, file_name: str,
+                        file_obj=None, file_size: int | None = None) -> dict:
+    """Upload file_path (or file_size bytes of file_obj) to Storage and record the file message."""
+    import sys
+    import os
+    lib_path = os.path.join(os.path.dirname(__file__), '..', 'lib')
+    if lib_path not in sys.path:
+        sys.path.insert(0, lib_path)
+    from upload import send_message_file
     
+    # send_message_file trả về record đã lưu (id, ts, fileURL, fileType, fileName)
+    return send_message_file(conversation_id, sender_uid, file_path, file_name,
+                             store=get_message_store(), is_group=is_group,
+                             file_obj=file_obj, file_size=file_size)
+
+
+def _cmd_send_file(conn, obj: dict, uid: str):
     # Lấy file content
     file_content_b64 = obj.get('fileContent', '').strip()
     file_name = obj.get('fileName', '').strip()
@@ -875,45 +687,21 @@ def _cmd_send_file(conn, obj: dict):
         return
     
     # Nếu có fileContent thì dùng fileContent, nếu không thì dùng filePath
-    temp_file_path = None
+    reader = None
     if file_content_b64:
         if not file_name:
             _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'missing_file_name' })
             return
+        # Kiểm tra kích thước trước khi decode; nội dung được decode dần khi upload đọc
+        try:
+            reader = Base64Reader(file_content_b64)
+        except UploadRejected as e:
+            _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': str(e),
+                              'maxSize': MAX_INLINE_FILE_SIZE })
+            return
     
     try:
-        # Import upload functions
-        import sys
         import os
-        import base64
-        import tempfile
-        lib_path = os.path.join(os.path.dirname(__file__), '..', 'lib')
-        if lib_path not in sys.path:
-            sys.path.insert(0, lib_path)
-        from upload import send_message_file
-        
-        # Nếu có fileContent, decode và lưu vào temp file
-        if file_content_b64:
-            temp_file_path_local = None
-            try:
-                file_content = base64.b64decode(file_content_b64)
-                # Tạo temp file
-                temp_fd, temp_file_path_local = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1] if file_name else '')
-                with os.fdopen(temp_fd, 'wb') as temp_file:
-                    temp_file.write(file_content)
-                # Dùng temp file path để upload
-                file_path = temp_file_path_local
-                temp_file_path = temp_file_path_local  # Set the outer scope variable
-            except Exception as e:
-                print(f"[FILE] Error decoding file content: {e}")
-                # Clean up temp file nếu đã được tạo
-                if temp_file_path_local and os.path.exists(temp_file_path_local):
-                    try:
-                        os.remove(temp_file_path_local)
-                    except Exception:
-                        pass
-                _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': f'decode_error: {str(e)}' })
-                return
         
         # Xác định conversation_id
         if group_id:
@@ -925,73 +713,46 @@ def _cmd_send_file(conn, obj: dict):
             conversation_id = _make_thread_id(uid, to_uid)
             is_group = False
         
-        # Upload file và lưu vào Firestore
-        file_url = send_message_file(conversation_id, uid, file_path)
-        
-        # Clean up temp file nếu có
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-            except Exception:
-                pass
-        
-        # Lấy thông tin file từ Firestore để gửi về client
-        try:
-            from firebase_admin import firestore as admin_firestore
-            db_fs = admin_firestore.client()
-            messages_ref = db_fs.collection("conversations").document(conversation_id).collection("messages")
-            # Lấy message mới nhất
-            docs = messages_ref.order_by("timestamp", direction=admin_firestore.Query.DESCENDING).limit(1).stream()
-            file_info = None
-            for doc in docs:
-                file_info = doc.to_dict()
-                break
-        except Exception:
-            file_info = None
+        # Upload file và lưu message vào message store
+        if reader is not None:
+            record = _store_file_message(conversation_id, is_group, uid, file_name, file_name,
+                                         file_obj=reader, file_size=reader.size)
+        else:
+            record = _store_file_message(conversation_id, is_group, uid, file_path, file_name or os.path.basename(file_path))
         
-        file_type = file_info.get('fileType', 'application') if file_info else 'application'
-        # Ưu tiên dùng fileName từ request, nếu không thì lấy từ Firestore, cuối cùng mới dùng basename của file_path
-        file_name = file_name if file_name else (file_info.get('fileName', os.path.basename(file_path)) if file_info else os.path.basename(file_path))
+        file_url = record['fileURL']
+        file_type = record['fileType']
+        file_name = record['fileName']
         
         # Gửi notification cho người nhận nếu là DM
         if not is_group:
             try:
-                peer_socket = uid_to_socket.get(to_uid)
-                if peer_socket is not None:
-                    _send_cmd(peer_socket, {
-                        'type': 'FILE_MESSAGE',
-                        'fromUid': uid,
-                        'fileURL': file_url,
-                        'fileType': file_type,
-                        'fileName': file_name,
-                        'threadId': conversation_id
-                    })
+                _send_to_user(to_uid, {
+                    'type': 'FILE_MESSAGE',
+                    'fromUid': uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'threadId': conversation_id,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                })
             except Exception:
                 pass
         
         # Gửi notification cho các member trong group
         elif is_group:
             try:
-                init_firebase_if_needed()
-                group_data = db.reference(f'/groups/{group_id}').get() or {}
-                group_members = group_data.get('members', {})
-                
-                for member_uid in group_members.keys():
-                    if member_uid == uid:  # Skip sender
-                        continue
-                    try:
-                        member_socket = uid_to_socket.get(member_uid)
-                        if member_socket is not None:
-                            _send_cmd(member_socket, {
-                                'type': 'FILE_MESSAGE',
-                                'groupId': group_id,
-                                'senderUid': uid,
-                                'fileURL': file_url,
-                                'fileType': file_type,
-                                'fileName': file_name
-                            })
-                    except Exception:
-                        pass
+                _send_to_group(group_id, {
+                    'type': 'FILE_MESSAGE',
+                    'groupId': group_id,
+                    'senderUid': uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                }, exclude_uid=uid)
             except Exception:
                 pass
         
@@ -1002,39 +763,26 @@ def _cmd_send_file(conn, obj: dict):
             'fileURL': file_url,
             'fileType': file_type,
             'fileName': file_name,
-            'conversationId': conversation_id
+            'conversationId': conversation_id,
+            'messageId': record.get('id', ''),
+            'ts': record.get('ts', 0)
         })
         
     except Exception as e:
-        print(f"[FILE] SEND_FILE error: {e}")
-        import traceback
-        traceback.print_exc()
-        # Clean up temp file nếu có
-        if 'temp_file_path' in locals() and temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-            except Exception:
-                pass
+        if isinstance(e.__cause__, UploadRejected):
+            # fileContent không phải base64 hợp lệ (phát hiện khi upload đọc tới đó)
+            _log.warning('SEND_FILE: error decoding file content: %s', e.__cause__)
+            _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': str(e.__cause__) })
+            return
+        _log.exception('SEND_FILE error: %s', e)
         _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': str(e) })
 
 
-def _cmd_send_file_url(conn, obj: dict):
+def _cmd_send_file_url(conn, obj: dict, uid: str):
     """
     Xử lý khi client gửi file URL (đã upload lên Firebase Storage).
     Chỉ cần lưu vào Firestore và forward URL cho client khác.
     """
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
-    if not uid:
-        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'error': 'unauthorized' })
-        return
-    
     file_url = obj.get('fileURL', '').strip()
     file_name = obj.get('fileName', '').strip()
     file_type = obj.get('fileType', 'application').strip()
@@ -1055,61 +803,44 @@ def _cmd_send_file_url(conn, obj: dict):
             conversation_id = _make_thread_id(uid, to_uid)
             is_group = False
         
-        # Lưu message vào Firestore
+        # Lưu message vào message store
+        record = {}
         try:
-            from firebase_admin import firestore as admin_firestore
-            db_fs = admin_firestore.client()
-            message_ref = db_fs.collection("conversations").document(conversation_id).collection("messages").document()
-            message_ref.set({
-                "senderId": uid,
-                "fileURL": file_url,
-                "fileType": file_type,
-                "fileName": file_name,
-                "timestamp": admin_firestore.SERVER_TIMESTAMP
-            })
+            record = get_message_store().append(conversation_id, make_message(
+                uid, file_url=file_url, file_type=file_type, file_name=file_name), is_group=is_group)
         except Exception as e:
-            print(f"[FILE_URL] Error saving to Firestore: {e}")
-            # Tiếp tục dù có lỗi Firestore, vẫn forward message
+            _log.warning('SEND_FILE_URL: error saving message: %s', e)
+            # Tiếp tục dù có lỗi khi lưu, vẫn forward message
         
         # Gửi notification cho người nhận nếu là DM
         if not is_group:
             try:
-                peer_socket = uid_to_socket.get(to_uid)
-                if peer_socket is not None:
-                    _send_cmd(peer_socket, {
-                        'type': 'FILE_MESSAGE',
-                        'fromUid': uid,
-                        'fileURL': file_url,
-                        'fileType': file_type,
-                        'fileName': file_name,
-                        'threadId': conversation_id
-                    })
+                _send_to_user(to_uid, {
+                    'type': 'FILE_MESSAGE',
+                    'fromUid': uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'threadId': conversation_id,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                })
             except Exception:
                 pass
         
         # Gửi notification cho các member trong group
         elif is_group:
             try:
-                init_firebase_if_needed()
-                group_data = db.reference(f'/groups/{group_id}').get() or {}
-                group_members = group_data.get('members', {})
-                
-                for member_uid in group_members.keys():
-                    if member_uid == uid:
-                        continue
-                    try:
-                        member_socket = uid_to_socket.get(member_uid)
-                        if member_socket is not None:
-                            _send_cmd(member_socket, {
-                                'type': 'FILE_MESSAGE',
-                                'groupId': group_id,
-                                'senderUid': uid,
-                                'fileURL': file_url,
-                                'fileType': file_type,
-                                'fileName': file_name
-                            })
-                    except Exception:
-                        pass
+                _send_to_group(group_id, {
+                    'type': 'FILE_MESSAGE',
+                    'groupId': group_id,
+                    'senderUid': uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                }, exclude_uid=uid)
             except Exception:
                 pass
         
@@ -1120,197 +851,164 @@ def _cmd_send_file_url(conn, obj: dict):
             'fileURL': file_url,
             'fileType': file_type,
             'fileName': file_name,
-            'conversationId': conversation_id
+            'conversationId': conversation_id,
+            'messageId': record.get('id', ''),
+            'ts': record.get('ts', 0)
         })
         
     except Exception as e:
-        print(f"[FILE_URL] SEND_FILE_URL error: {e}")
-        import traceback
-        traceback.print_exc()
+        _log.exception('SEND_FILE_URL error: %s', e)
         _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': str(e) })
 
 
-def _cmd_send_file_start(conn, obj: dict):
+def _cmd_send_file_start(conn, obj: dict, uid: str):
     """Nhận metadata của file chunking"""
-    uid = getattr(conn, '_chat_uid', '')
-    if not uid:
-        try:
-            from Server.state import socket_to_uid as _s2u
-        except Exception:
-            from state import socket_to_uid as _s2u
-        uid = _s2u.get(conn, '') if _s2u else ''
-    
-    if not uid:
-        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'error': 'unauthorized' })
-        return
-    
     client_msg_id = obj.get('clientMsgId', '').strip()
     file_name = obj.get('fileName', '').strip()
     file_size = obj.get('fileSize', 0)
+    chunk_size = obj.get('chunkSize') or DEFAULT_CHUNK_SIZE
+    sha256 = (obj.get('sha256') or '').strip()
     to_uid = obj.get('toUid', '').strip()
     group_id = obj.get('groupId', '').strip()
     
-    if not client_msg_id or not file_name or file_size <= 0 or (not to_uid and not group_id):
-        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'error': 'missing_params' })
+    if (not client_msg_id or not file_name or not isinstance(file_size, int) or file_size <= 0
+            or not isinstance(chunk_size, int) or (not to_uid and not group_id)):
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'error': 'missing_params' })
         return
     
-    # Khởi tạo storage cho chunks
-    with file_chunks_lock:
-        file_chunks_storage[client_msg_id] = {
-            'chunks': {},  # {chunk_index: chunk_data_b64}
-            'file_name': file_name,
-            'file_size': file_size,
-            'to_uid': to_uid,
-            'group_id': group_id,
-            'conn': conn,
-            'uid': uid
-        }
+    conversation_id = group_id or _make_thread_id(uid, to_uid)
+    
+    # Tạo spool file (đã cấp phát đủ file_size) để ghi chunks trực tiếp,
+    # hoặc tiếp tục upload dở / dùng lại file đã có nếu client gửi sha256
+    try:
+        spool = open_upload(client_msg_id, conn, uid, file_name, file_size, chunk_size, to_uid, group_id,
+                            conversation_id, sha256)
+    except UploadRejected as e:
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'error': str(e) })
+        return
+    except OSError as e:
+        _log.warning('SEND_FILE_START: cannot create spool file: %s', e)
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'error': 'spool_error' })
+        return
     
-    _send_cmd(conn, { 'type': 'FILE_CHUNK_STARTED', 'clientMsgId': client_msg_id })
+    _send_cmd(conn, {
+        'type': 'FILE_CHUNK_STARTED',
+        'clientMsgId': client_msg_id,
+        'chunkSize': spool.chunk_size,
+        'numChunks': spool.num_chunks,
+        'haveChunks': spool.have_chunks(),
+        'dedup': spool.blob is not None
+    })
 
 
-def _cmd_send_file_chunk(conn, obj: dict):
+def _cmd_send_file_chunk(conn, obj: dict, uid: str):
     """Nhận một chunk của file"""
     client_msg_id = obj.get('clientMsgId', '').strip()
     chunk_index = obj.get('chunkIndex', -1)
-    chunk_data_b64 = obj.get('chunkData', '').strip()
+    # Binary frame: raw bytes (chunkBytes); line protocol: base64 (chunkData)
+    chunk_bytes = obj.get('chunkBytes')
+    chunk_data_b64 = obj.get('chunkData', '').strip() if chunk_bytes is None else ''
     
-    if not client_msg_id or chunk_index < 0 or not chunk_data_b64:
-        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'error': 'missing_params' })
+    if (not client_msg_id or not isinstance(chunk_index, int) or chunk_index < 0
+            or (chunk_bytes is None and not chunk_data_b64)):
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'error': 'missing_params' })
         return
     
-    # Lưu chunk vào storage
-    with file_chunks_lock:
-        if client_msg_id not in file_chunks_storage:
-            _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'error': 'no_start_command' })
-            return
-        
-        storage = file_chunks_storage[client_msg_id]
-        storage['chunks'][chunk_index] = chunk_data_b64
+    spool = get_upload(client_msg_id, conn)
+    if spool is None:
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'error': 'no_start_command' })
+        return
+    
+    # Decode và ghi chunk vào spool file tại chunkIndex * chunk_size
+    try:
+        if chunk_bytes is None:
+            import base64
+            chunk_bytes = base64.b64decode(chunk_data_b64)
+        spool.write_chunk(chunk_index, chunk_bytes)
+    except UploadRejected as e:
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'chunkIndex': chunk_index, 'error': str(e) })
+        return
+    except ValueError:
+        _send_cmd(conn, { 'type': 'FILE_CHUNK_ERROR', 'clientMsgId': client_msg_id, 'chunkIndex': chunk_index, 'error': 'decode_error' })
+        return
     
     _send_cmd(conn, { 'type': 'FILE_CHUNK_RECEIVED', 'chunkIndex': chunk_index, 'clientMsgId': client_msg_id })
 
 
-def _cmd_send_file_end(conn, obj: dict):
-    """Kết thúc nhận chunks, ghép lại và upload"""
+def _cmd_send_file_end(conn, obj: dict, uid: str):
+    """Kết thúc nhận chunks và upload spool file"""
     client_msg_id = obj.get('clientMsgId', '').strip()
     
     if not client_msg_id:
         _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'error': 'missing_client_msg_id' })
         return
     
-    # Lấy storage
-    with file_chunks_lock:
-        if client_msg_id not in file_chunks_storage:
-            _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'no_chunks_received' })
-            return
-        
-        storage = file_chunks_storage.pop(client_msg_id)
+    spool = get_upload(client_msg_id, conn)
+    if spool is None:
+        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'no_chunks_received' })
+        return
+    
+    # Upload vẫn mở để client gửi lại các chunk còn thiếu
+    if not spool.complete():
+        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'missing_chunks',
+                          'missing': spool.missing_chunks() })
+        return
     
-    chunks = storage['chunks']
-    if not chunks:
-        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'no_chunks' })
+    spool = take_upload(client_msg_id, conn)
+    if spool is None:
+        _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'no_chunks_received' })
         return
     
     try:
-        import base64
-        sorted_indices = sorted(chunks.keys())
-        file_content_parts = []
-        for i in sorted_indices:
-            chunk_b64 = chunks[i]
-            chunk_data = base64.b64decode(chunk_b64)
-            file_content_parts.append(chunk_data)
-        
-        # Ghép lại tất cả các chunks
-        file_content = b''.join(file_content_parts)
+        conversation_id = spool.conversation_id
+        is_group = bool(spool.group_id)
         
-        # Lưu vào temp file
-        import tempfile
-        import os
-        temp_fd, temp_file_path = tempfile.mkstemp(suffix=os.path.splitext(storage['file_name'])[1] if storage['file_name'] else '')
-        with os.fdopen(temp_fd, 'wb') as temp_file:
-            temp_file.write(file_content)
-        
-        # Import upload functions
-        import sys
-        lib_path = os.path.join(os.path.dirname(__file__), '..', 'lib')
-        if lib_path not in sys.path:
-            sys.path.insert(0, lib_path)
-        from upload import send_message_file
-        
-        # Xác định conversation_id
-        if storage['group_id']:
-            conversation_id = storage['group_id']
-            is_group = True
+        if spool.blob is not None:
+            # Cùng nội dung đã có trên Storage trong conversation này: chỉ lưu message
+            record = get_message_store().append(conversation_id, make_message(
+                spool.uid, file_url=spool.blob['fileURL'], file_type=spool.blob['fileType'],
+                file_name=spool.file_name), is_group=is_group)
         else:
-            conversation_id = _make_thread_id(storage['uid'], storage['to_uid'])
-            is_group = False
-        
-        # Upload file
-        file_url = send_message_file(conversation_id, storage['uid'], temp_file_path)
-        
-        # Clean up temp file
-        if temp_file_path and os.path.exists(temp_file_path):
-            try:
-                os.remove(temp_file_path)
-            except Exception:
-                pass
-        
-        # Lấy thông tin file từ Firestore
-        try:
-            from firebase_admin import firestore as admin_firestore
-            db_fs = admin_firestore.client()
-            messages_ref = db_fs.collection("conversations").document(conversation_id).collection("messages")
-            docs = messages_ref.order_by("timestamp", direction=admin_firestore.Query.DESCENDING).limit(1).stream()
-            file_info = None
-            for doc in docs:
-                file_info = doc.to_dict()
-                break
-        except Exception:
-            file_info = None
+            if not spool.verify():
+                _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': 'hash_mismatch' })
+                return
+            # Upload thẳng từ spool file và lưu message vào message store
+            record = _store_file_message(conversation_id, is_group, spool.uid, spool.seal(), spool.file_name)
+            remember_blob(conversation_id, spool.sha256, record)
         
-        file_type = file_info.get('fileType', 'application') if file_info else 'application'
-        file_name = file_info.get('fileName', storage['file_name']) if file_info else storage['file_name']
+        file_url = record['fileURL']
+        file_type = record['fileType']
+        file_name = record['fileName']
         
         # Gửi notification cho người nhận nếu là DM
         if not is_group:
             try:
-                peer_socket = uid_to_socket.get(storage['to_uid'])
-                if peer_socket is not None:
-                    _send_cmd(peer_socket, {
-                        'type': 'FILE_MESSAGE',
-                        'fromUid': storage['uid'],
-                        'fileURL': file_url,
-                        'fileType': file_type,
-                        'fileName': file_name,
-                        'threadId': conversation_id
-                    })
+                _send_to_user(spool.to_uid, {
+                    'type': 'FILE_MESSAGE',
+                    'fromUid': spool.uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'threadId': conversation_id,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                })
             except Exception:
                 pass
         
         # Gửi notification cho các member trong group
         elif is_group:
             try:
-                init_firebase_if_needed()
-                group_data = db.reference(f'/groups/{storage["group_id"]}').get() or {}
-                group_members = group_data.get('members', {})
-                
-                for member_uid in group_members.keys():
-                    if member_uid == storage['uid']:
-                        continue
-                    try:
-                        member_socket = uid_to_socket.get(member_uid)
-                        if member_socket is not None:
-                            _send_cmd(member_socket, {
-                                'type': 'FILE_MESSAGE',
-                                'groupId': storage['group_id'],
-                                'senderUid': storage['uid'],
-                                'fileURL': file_url,
-                                'fileType': file_type,
-                                'fileName': file_name
-                            })
-                    except Exception:
-                        pass
+                _send_to_group(spool.group_id, {
+                    'type': 'FILE_MESSAGE',
+                    'groupId': spool.group_id,
+                    'senderUid': spool.uid,
+                    'fileURL': file_url,
+                    'fileType': file_type,
+                    'fileName': file_name,
+                    'messageId': record.get('id', ''),
+                    'ts': record.get('ts', 0)
+                }, exclude_uid=spool.uid)
             except Exception:
                 pass
         
@@ -1321,14 +1019,16 @@ def _cmd_send_file_end(conn, obj: dict):
             'fileURL': file_url,
             'fileType': file_type,
             'fileName': file_name,
-            'conversationId': conversation_id
+            'conversationId': conversation_id,
+            'messageId': record.get('id', ''),
+            'ts': record.get('ts', 0)
         })
         
     except Exception as e:
-        print(f"[FILE] SEND_FILE_END error: {e}")
-        import traceback
-        traceback.print_exc()
+        _log.exception('SEND_FILE_END error: %s', e)
         _send_cmd(conn, { 'type': 'FILE_SENT', 'ok': False, 'clientMsgId': client_msg_id, 'error': str(e) })
+    finally:
+        spool.discard()
 
 
 # =====================
@@ -1341,8 +1041,7 @@ def _new_call_id() -> str:
     return uuid.uuid4().hex
 
 
-def _cmd_call_invite(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_call_invite(conn, obj: dict, uid: str):
     to_uid = (obj.get('toUid') or '').strip()
 
     if not uid or not to_uid or uid == to_uid:
@@ -1383,8 +1082,7 @@ def _cmd_call_invite(conn, obj: dict):
     })
 
 
-def _cmd_call_accept(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_call_accept(conn, obj: dict, uid: str):
     call_id = (obj.get("callId") or "").strip()
 
     if not uid or not call_id:
@@ -1434,8 +1132,7 @@ def _cmd_call_accept(conn, obj: dict):
     })
 
 
-def _cmd_call_reject(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_call_reject(conn, obj: dict, uid: str):
     call_id = (obj.get("callId") or "").strip()
     reason = (obj.get("reason") or "").strip()  # ví dụ: "busy"
 
@@ -1489,8 +1186,7 @@ def _cmd_call_reject(conn, obj: dict):
     })
 
 
-def _cmd_call_end(conn, obj: dict):
-    uid = _require_uid(conn)
+def _cmd_call_end(conn, obj: dict, uid: str):
     call_id = (obj.get("callId") or "").strip()
 
     if not uid or not call_id:
@@ -1537,3 +1233,46 @@ def _cmd_call_end(conn, obj: dict):
         "callId": call_id
     })
 
+
+
+def _cmd_binary_upgrade(conn, obj: dict, uid: str):
+    """Client muốn gửi binary frames (lib/framing); nó chuyển sau khi nhận BINARY_OK."""
+    _send_cmd(conn, { 'type': 'BINARY_OK', 'version': BINARY_FRAMES_VERSION })
+
+
+def _cmd_stats(conn, obj: dict, uid: str):
+    if uid not in STATS_ADMIN_UIDS:
+        _send_cmd(conn, { 'type': 'STATS', 'ok': False, 'error': 'forbidden' })
+        return
+    _send_cmd(conn, { 'type': 'STATS', 'ok': True, **metrics.snapshot() })
+
+
+# Command registry: type -> handler + metadata. handle_command_line dispatches through it.
+COMMANDS: dict[str, CommandSpec] = {
+    'FIND_USER': CommandSpec(_cmd_find_user, needs_uid=False, reply='FIND_USER_RESULT'),
+    'LIST_FRIENDS': CommandSpec(_cmd_list_friends, reply='FRIENDS'),
+    'SEND_FRIEND_REQUEST': CommandSpec(_cmd_send_friend_request, io='db_write', reply='FRIEND_REQUEST_SENT'),
+    'ACCEPT_REQUEST': CommandSpec(_cmd_accept_request, io='db_write', reply='FRIEND_REQUEST_ACCEPTED'),
+    'REJECT_REQUEST': CommandSpec(_cmd_reject_request, io='db_write', reply='FRIEND_REQUEST_REJECTED'),
+    'FRIEND_REQUESTS': CommandSpec(_cmd_friend_requests, reply='FRIEND_REQUESTS'),
+    'SEND_DM': CommandSpec(_cmd_send_dm, io='db_write', reply='DM_DELIVERED'),
+    'LOAD_THREAD': CommandSpec(_cmd_load_thread, reply='DM_HISTORY'),
+    'CREATE_GROUP': CommandSpec(_cmd_create_group, io='db_write', reply='GROUP_CREATED'),
+    'LIST_GROUPS': CommandSpec(_cmd_list_groups, reply='GROUPS'),
+    'SEND_GROUP_MESSAGE': CommandSpec(_cmd_send_group_message, io='db_write', reply='GROUP_MESSAGE_DELIVERED'),
+    'LOAD_GROUP_HISTORY': CommandSpec(_cmd_load_group_history, reply='GROUP_HISTORY'),
+    'LEAVE_GROUP': CommandSpec(_cmd_leave_group, io='db_write', reply='LEAVE_GROUP_OK'),
+    'LIST_GROUP_MEMBERS': CommandSpec(_cmd_list_group_members, reply='GROUP_MEMBERS'),
+    'SEND_FILE': CommandSpec(_cmd_send_file, io='storage', reply='FILE_SENT'),
+    'SEND_FILE_URL': CommandSpec(_cmd_send_file_url, io='db_write', reply='FILE_SENT'),
+    # Spool preallocation and chunk write+fsync hit the disk; failures use FILE_CHUNK_ERROR
+    'SEND_FILE_START': CommandSpec(_cmd_send_file_start, io='storage', reply='FILE_CHUNK_ERROR'),
+    'SEND_FILE_CHUNK': CommandSpec(_cmd_send_file_chunk, io='storage', reply='FILE_CHUNK_ERROR'),
+    'SEND_FILE_END': CommandSpec(_cmd_send_file_end, io='storage', reply='FILE_SENT'),
+    'CALL_INVITE': CommandSpec(_cmd_call_invite, io=None, reply='CALL_INVITE_SENT'),
+    'CALL_ACCEPT': CommandSpec(_cmd_call_accept, io=None, reply='CALL_ACCEPT_OK'),
+    'CALL_REJECT': CommandSpec(_cmd_call_reject, io=None, reply='CALL_REJECT_OK'),
+    'CALL_END': CommandSpec(_cmd_call_end, io=None, reply='CALL_END_OK'),
+    'STATS': CommandSpec(_cmd_stats, io=None, reply='STATS'),
+    'BINARY_UPGRADE': CommandSpec(_cmd_binary_upgrade, io=None, reply='BINARY_OK'),
+}
@@ -1,5 +1,10 @@
 import os
 import json
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     from dotenv import load_dotenv, find_dotenv  # type: ignore
@@ -15,6 +20,21 @@ try:
     _FIREBASE_AVAILABLE = True
 except Exception:
     _FIREBASE_AVAILABLE = False
+    firebase_admin = None
+    credentials = None
+    fb_auth = None
+    db = None
+
+try:
+    from Server.log import get_logger
+    from Server.cache import profile_cache, friends_cache, token_cache, revocation_cache
+    from Server import metrics
+except Exception:
+    from log import get_logger
+    from cache import profile_cache, friends_cache, token_cache, revocation_cache
+    import metrics
+
+_log = get_logger('firebase')
 
 _firebase_initialized = False
 
@@ -114,23 +134,163 @@ def init_firebase_if_needed() -> None:
         _firebase_initialized = False
 
 
+# Revocation lookups (fb_auth.get_users calls) allowed at the same time
+AUTH_MAX_INFLIGHT = int(os.environ.get('CHAT_AUTH_MAX_INFLIGHT', '8'))
+# How long a revocation lookup waits for more uids to share its get_users() call
+AUTH_BATCH_WINDOW = float(os.environ.get('CHAT_AUTH_BATCH_WINDOW_MS', '5')) / 1000.0
+# "User not found" is cached only briefly: the account may be created right after
+AUTH_MISSING_TTL = float(os.environ.get('CHAT_AUTH_MISSING_TTL', '10'))
+# Max uids per fb_auth.get_users() call (Admin SDK limit)
+_GET_USERS_BATCH = 100
+
+
+class _PendingLookup:
+    __slots__ = ('event', 'state')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = None
+
+
+class RevocationLookup:
+    """Looks up users' revocation state, coalescing concurrent callers into get_users() batches.
+
+    Callers queue their uid and wait; AUTH_MAX_INFLIGHT worker threads (started on first
+    use) each take up to 100 queued uids per fb_auth.get_users() call. Under a reconnect
+    storm one Auth round trip then answers up to 100 handshakes, and Firebase never sees
+    more than AUTH_MAX_INFLIGHT requests at once.
+    """
+
+    def __init__(self, max_inflight: int = AUTH_MAX_INFLIGHT):
+        self.max_inflight = max(1, max_inflight)
+        self._cond = threading.Condition()
+        self._pending: dict[str, _PendingLookup] = {}
+        self._queue: list[str] = []
+        self._workers: list[threading.Thread] = []
+
+    def get(self, uid: str, timeout: float = 30.0) -> dict | None:
+        """{'valid_after_ms', 'disabled'}, {'missing': True} for unknown users, None on error."""
+        state = revocation_cache.get(uid)
+        if state is not None:
+            return state
+        with self._cond:
+            lookup = self._pending.get(uid)
+            if lookup is None:
+                lookup = self._pending[uid] = _PendingLookup()
+                self._queue.append(uid)
+                if len(self._workers) < self.max_inflight:
+                    worker = threading.Thread(target=self._work, name='auth-revocation', daemon=True)
+                    self._workers.append(worker)
+                    worker.start()
+                self._cond.notify()
+        lookup.event.wait(timeout)
+        return lookup.state
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                if len(self._queue) < _GET_USERS_BATCH and AUTH_BATCH_WINDOW > 0:
+                    # Let more handshakes of a burst join this call
+                    self._cond.wait(AUTH_BATCH_WINDOW)
+                batch = self._queue[:_GET_USERS_BATCH]
+                del self._queue[:_GET_USERS_BATCH]
+            if batch:
+                self._lookup(batch)
+
+    def _lookup(self, batch: list[str]):
+        metrics.incr('auth.revocation_lookups')
+        try:
+            res = fb_auth.get_users([fb_auth.UidIdentifier(u) for u in batch])
+            found = {rec.uid: {'valid_after_ms': rec.tokens_valid_after_timestamp or 0,
+                               'disabled': bool(rec.disabled)} for rec in res.users}
+        except Exception as exc:
+            _log.warning('revocation lookup of %d users failed: %s', len(batch), exc)
+            found = None
+        for uid in batch:
+            state = None
+            if found is not None:
+                state = found.get(uid)
+                if state is not None:
+                    revocation_cache.set(uid, state)
+                else:
+                    state = {'missing': True}
+                    revocation_cache.set(uid, state, ttl=AUTH_MISSING_TTL)
+            with self._cond:
+                lookup = self._pending.pop(uid, None)
+            if lookup is not None:
+                lookup.state = state
+                lookup.event.set()
+
+
+_revocations = RevocationLookup()
+
+
+def revocation_state(uid: str) -> dict | None:
+    """Revocation state of uid from revocation_cache, else via a batched lookup.
+
+    Returns None when it cannot be checked (Firebase unavailable, lookup failed).
+    """
+    state = revocation_cache.get(uid)
+    if state is not None:
+        return state
+    if not _FIREBASE_AVAILABLE:
+        return None
+    init_firebase_if_needed()
+    if not _firebase_initialized:
+        return None
+    return _revocations.get(uid)
+
+
+def _verify_token_signature(id_token: str) -> dict:
+    """Identity of a token whose signature and expiry are valid, from token_cache when possible."""
+    key = hashlib.sha256(id_token.encode('utf-8', errors='replace')).hexdigest()
+    ident = token_cache.get(key)
+    if ident is not None:
+        return ident
+    # Signature, audience and expiry only; keys are cached by the SDK, so no round trip
+    decoded = fb_auth.verify_id_token(id_token, check_revoked=False, clock_skew_seconds=60)
+    email = decoded.get('email') or ''
+    name = decoded.get('name') or ''
+    uid = decoded.get('uid') or 'unknown'
+    ident = {'uid': uid, 'email': email, 'name': name, 'label': email or name or uid,
+             'iat': decoded.get('iat') or 0}
+    token_cache.set(key, ident, ttl=(decoded.get('exp') or 0) - time.time())
+    return ident
+
+
 def verify_id_token(id_token: str) -> tuple[bool, str, str, str, str]:
+    """Check an AUTH token; returns (ok, label or error, uid, email, name).
+
+    Same result as fb_auth.verify_id_token(check_revoked=True), but the signature check is
+    cached per token until it expires and the revocation state per user for
+    CHAT_AUTH_REVOCATION_RECHECK seconds, with concurrent lookups batched (RevocationLookup).
+    """
     if not _FIREBASE_AVAILABLE:
-        return False, 'auth_unavailable'
+        return False, 'auth_unavailable', '', '', ''
     init_firebase_if_needed()
     if not _firebase_initialized:
-        return False, 'auth_not_initialized'
+        return False, 'auth_not_initialized', '', '', ''
     try:
-        decoded = fb_auth.verify_id_token(id_token, check_revoked=True, clock_skew_seconds=60)
-        email = decoded.get('email') or ''
-        name = decoded.get('name') or ''
-        uid = decoded.get('uid') or 'unknown'
-        label = email or name or uid
-        return True, label, uid, email, name
+        ident = _verify_token_signature(id_token)
     except Exception as exc:
         reason = f'invalid_token: {exc}'
-        print(f"[Auth] Token verify failed: {reason}")
+        _log.info('Token verify failed: %s', reason)
         return False, reason, '', '', ''
+    state = _revocations.get(ident['uid'])
+    if state is None:
+        reason = 'invalid_token: revocation check failed'
+    elif state.get('missing'):
+        reason = 'invalid_token: user not found'
+    elif state.get('disabled'):
+        reason = 'invalid_token: user disabled'
+    elif ident['iat'] * 1000 < state.get('valid_after_ms', 0):
+        reason = 'invalid_token: token revoked'
+    else:
+        return True, ident['label'], ident['uid'], ident['email'], ident['name']
+    _log.info('Token verify failed: %s', reason)
+    return False, reason, '', '', ''
 
 
 def get_user_by_email(email: str) -> dict | None:
@@ -163,14 +323,126 @@ def get_user_profile(uid: str) -> dict | None:
         return None
 
 
-def list_friends(uid: str) -> list[dict]:
-    """Return list of friend profiles for uid based on /users/{uid}/friends."""
-    results: list[dict] = []
+# RTDB reads get_profiles() runs at once. The Admin SDK has no multi-path get, so the
+# profiles of a cold friend list are read in parallel, costing about one round trip
+PROFILE_READ_WORKERS = int(os.environ.get('CHAT_PROFILE_READ_WORKERS', '32'))
+_profile_reader: ThreadPoolExecutor | None = None
+_profile_reader_lock = threading.Lock()
+
+
+def _profile_read_pool() -> ThreadPoolExecutor:
+    global _profile_reader
+    if _profile_reader is None:
+        with _profile_reader_lock:
+            if _profile_reader is None:
+                _profile_reader = ThreadPoolExecutor(max_workers=max(1, PROFILE_READ_WORKERS),
+                                                     thread_name_prefix='profile-read')
+    return _profile_reader
+
+
+def _rtdb_display_name(uid: str) -> str:
     try:
-        init_firebase_if_needed()
-        fref = db.reference(f'/users/{uid}/friends')
-        friends = fref.get()
-        # Defensive logging to help debug mismatched RTDB shapes
+        name = db.reference(f'/users/{uid}/displayName').get()
+    except Exception:
+        return ''
+    return name if isinstance(name, str) else ''
+
+
+def get_profiles(uids) -> dict[str, dict]:
+    """Return {uid: {'uid', 'email', 'displayName'}} for every uid, using profile_cache.
+
+    Emails of cache misses come from one fb_auth.get_users() call per 100 uids instead of
+    fb_auth.get_user() per uid. displayName is read from /users/{uid}/displayName first, as
+    users may have renamed themselves there, and Auth's display name is only a fallback.
+    Uids that Auth does not know or that have no email there read the whole RTDB profile.
+    Every miss costs exactly one RTDB read, and those reads run in parallel.
+    """
+    result: dict[str, dict] = {}
+    missing: list[str] = []
+    for uid in dict.fromkeys(u for u in uids if u):
+        cached = profile_cache.get(uid)
+        if cached is not None:
+            result[uid] = cached
+        else:
+            missing.append(uid)
+    if not missing:
+        return result
+    init_firebase_if_needed()
+    fetched: dict[str, dict] = {}
+    if _firebase_initialized:
+        for i in range(0, len(missing), _GET_USERS_BATCH):
+            batch = missing[i:i + _GET_USERS_BATCH]
+            try:
+                res = fb_auth.get_users([fb_auth.UidIdentifier(u) for u in batch])
+            except Exception:
+                continue
+            for rec in res.users:
+                fetched[rec.uid] = {
+                    'uid': rec.uid,
+                    'email': rec.email or '',
+                    'displayName': rec.display_name or '',
+                }
+
+    def read_rtdb(uid: str) -> dict:
+        if (fetched.get(uid) or {}).get('email'):
+            return {'displayName': _rtdb_display_name(uid)}
+        return get_user_profile(uid) or {}
+
+    if len(missing) == 1:
+        rtdb = [read_rtdb(missing[0])]
+    else:
+        rtdb = list(_profile_read_pool().map(read_rtdb, missing))
+    for uid, data in zip(missing, rtdb):
+        auth_prof = fetched.get(uid) or {}
+        prof = {
+            'uid': uid,
+            'email': auth_prof.get('email') or data.get('email') or '',
+            'displayName': data.get('displayName') or auth_prof.get('displayName') or '',
+        }
+        profile_cache.set(uid, prof)
+        result[uid] = prof
+    return result
+
+
+def _parse_friend_ids(friends) -> list[str]:
+    # Support multiple storage shapes: dict {uid: true}, list [uid,...], or dict of dicts
+    ids: list[str] = []
+    if isinstance(friends, dict):
+        for friend_uid, linked in friends.items():
+            # linked can be truthy (True) or a dict/timestamp. Treat truthy values as linked.
+            if not linked:
+                continue
+            # If stored as { uid: { ...profile... } } the dict may carry its own 'uid'
+            if isinstance(linked, dict):
+                ids.append(linked.get('uid') or friend_uid)
+            else:
+                ids.append(friend_uid)
+    elif isinstance(friends, list):
+        for item in friends:
+            if isinstance(item, str):
+                friend_id = item
+            elif isinstance(item, dict):
+                friend_id = item.get('uid') or item.get('id') or ''
+                if not friend_id:
+                    # try to pull a single key
+                    keys = list(item.keys())
+                    friend_id = keys[0] if keys else ''
+            else:
+                continue
+            if friend_id:
+                ids.append(friend_id)
+    return ids
+
+
+def get_friend_ids(uid: str) -> list[str]:
+    """Friend uids of uid from /users/{uid}/friends, cached in friends_cache."""
+    cached = friends_cache.get(uid)
+    if cached is not None:
+        return cached
+    init_firebase_if_needed()
+    friends = db.reference(f'/users/{uid}/friends').get()
+    # Defensive logging to help debug mismatched RTDB shapes
+    if _log.isEnabledFor(logging.DEBUG):
         try:
             ftype = type(friends).__name__
             preview = None
@@ -178,69 +450,42 @@ def list_friends(uid: str) -> list[dict]:
                 preview = list(friends.keys())[:10]
             else:
                 preview = str(friends)[:200]
-            print(f"[FRIEND] list_friends: uid={uid} raw_type={ftype} preview={preview}")
+            _log.debug('list_friends: uid=%s raw_type=%s preview=%s', uid, ftype, preview)
         except Exception:
             pass
+    if friends is None:
+        friends = {}
+    if not isinstance(friends, (dict, list)):
+        # unexpected shape: log and return empty (not cached)
+        _log.warning('list_friends: unexpected data type for /users/%s/friends -> %s', uid, type(friends))
+        return []
+    ids = _parse_friend_ids(friends)
+    friends_cache.set(uid, ids)
+    return ids
 
-        if friends is None:
-            friends = {}
-
-        # Support multiple storage shapes: dict {uid: true}, list [uid,...], or dict of dicts
-        if isinstance(friends, dict):
-            for friend_uid, linked in friends.items():
-                # linked can be truthy (True) or a dict/timestamp. Treat truthy values as linked.
-                if not linked:
-                    continue
-                # If stored as { uid: { ...profile... } } try to extract uid key
-                if isinstance(linked, dict) and not linked is True:
-                    # If the dict itself contains an 'uid' field, use it; otherwise assume key is uid
-                    friend_id = linked.get('uid') or friend_uid
-                else:
-                    friend_id = friend_uid
-                prof = get_user_profile(friend_id) or {'uid': friend_id}
-                email = prof.get('email') or ''
-                if not email:
-                    try:
-                        email = get_email_for_uid(friend_id)
-                    except Exception:
-                        email = ''
-                results.append({
-                    'uid': prof.get('uid') or friend_id,
-                    'email': email,
-                    'displayName': prof.get('displayName') or ''
-                })
-        elif isinstance(friends, list):
-            for item in friends:
-                if isinstance(item, str):
-                    friend_id = item
-                elif isinstance(item, dict):
-                    friend_id = item.get('uid') or item.get('id') or ''
-                    if not friend_id:
-                        # try to pull a single key
-                        keys = list(item.keys())
-                        friend_id = keys[0] if keys else ''
-                else:
-                    continue
-                if not friend_id:
-                    continue
-                prof = get_user_profile(friend_id) or {'uid': friend_id}
-                email = prof.get('email') or ''
-                if not email:
-                    try:
-                        email = get_email_for_uid(friend_id)
-                    except Exception:
-                        email = ''
-                results.append({
-                    'uid': prof.get('uid') or friend_id,
-                    'email': email,
-                    'displayName': prof.get('displayName') or ''
-                })
-        else:
-            # unexpected shape: log and return empty
-            try:
-                print(f"[FRIEND] list_friends: unexpected data type for /users/{uid}/friends -> {type(friends)}")
-            except Exception:
-                pass
+
+def invalidate_friends(*uids: str) -> None:
+    """Drop cached friend lists after the server changed /users/{uid}/friends."""
+    friends_cache.invalidate(*uids)
+
+
+def invalidate_profile(*uids: str) -> None:
+    profile_cache.invalidate(*uids)
+
+
+def list_friends(uid: str) -> list[dict]:
+    """Return list of friend profiles for uid based on /users/{uid}/friends."""
+    results: list[dict] = []
+    try:
+        friend_ids = get_friend_ids(uid)
+        profiles = get_profiles(friend_ids)
+        for friend_id in friend_ids:
+            prof = profiles.get(friend_id) or {'uid': friend_id}
+            results.append({
+                'uid': prof.get('uid') or friend_id,
+                'email': prof.get('email') or '',
+                'displayName': prof.get('displayName') or ''
+            })
     except Exception:
         pass
     return results
@@ -262,6 +507,7 @@ def ensure_user_profile(uid: str, email: str, display_name: str | None = None) -
             updates['displayName'] = display_name
         if updates:
             ref.update(updates)
+            invalidate_profile(uid)
     except Exception:
         pass
 
@@ -269,13 +515,6 @@ def ensure_user_profile(uid: str, email: str, display_name: str | None = None) -
 def get_email_for_uid(uid: str) -> str:
     """Best-effort resolve email for a uid using Admin Auth, fallback RTDB profile."""
     try:
-        init_firebase_if_needed()
-        user_record = fb_auth.get_user(uid)
-        if user_record and getattr(user_record, 'email', None):
-            return user_record.email or ''
+        return (get_profiles([uid]).get(uid) or {}).get('email') or ''
     except Exception:
-        pass
-    prof = get_user_profile(uid) or {}
-    return prof.get('email') or ''
-
-
+        return ''
@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+
+try:
+    from Server.firebase_admin_utils import init_firebase_if_needed, db
+    from Server import metrics
+except Exception:
+    from firebase_admin_utils import init_firebase_if_needed, db
+    import metrics
+
+# Groups kept in memory; the oldest loaded group is evicted (and reloaded on next use)
+MAX_GROUPS = int(os.environ.get('CHAT_GROUP_INDEX_MAX', '10000'))
+# How long a loaded group is trusted before it is read again, so membership changes made
+# outside this server (console, other tools) are picked up
+TTL = float(os.environ.get('CHAT_GROUP_INDEX_TTL', '300'))
+# How long "no such group / no members" is trusted, since it may be created elsewhere
+NEGATIVE_TTL = float(os.environ.get('CHAT_GROUP_INDEX_NEGATIVE_TTL', '30'))
+
+
+class GroupIndex:
+    """In-memory view of /groups/{gid}/members plus the group's name/createdBy/createdAt.
+
+    A group is loaded from RTDB the first time it is needed, reading only its members
+    and metadata children (never the messages subtree). After that CREATE_GROUP and
+    LEAVE_GROUP keep it in sync; entries still expire after ttl (negative_ttl when the
+    group has no members) and at most max_groups groups are kept. Member sets are
+    replaced, never mutated, so callers can iterate the returned frozenset without
+    holding the lock.
+
+    Every change bumps the group's generation; a load that overlapped a change is not
+    stored, so an RTDB snapshot read before LEAVE_GROUP cannot bring the member back.
+    """
+
+    _META_FIELDS = ('name', 'createdBy', 'createdAt')
+    _LOAD_ATTEMPTS = 3
+
+    def __init__(self, max_groups: int = MAX_GROUPS, ttl: float = TTL, negative_ttl: float = NEGATIVE_TTL):
+        self.max_groups = max(1, max_groups)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._members: dict[str, frozenset[str]] = {}
+        self._meta: dict[str, dict] = {}
+        self._expires: dict[str, float] = {}
+        # Only kept for groups that are cached or being loaded
+        self._generation: dict[str, int] = {}
+        self._loading: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.stale_loads = 0
+        metrics.register_gauge('group_index', self.stats)
+
+    def members(self, group_id: str) -> frozenset[str]:
+        with self._lock:
+            cached = self._cached(group_id)
+        if cached is not None:
+            return cached[0]
+        return self._load(group_id)[0]
+
+    def is_member(self, group_id: str, uid: str) -> bool:
+        return uid in self.members(group_id)
+
+    def info(self, group_id: str) -> dict | None:
+        """{'name', 'createdBy', 'createdAt'} of a group, or None if it does not exist."""
+        with self._lock:
+            cached = self._cached(group_id)
+        meta = cached[1] if cached is not None else None
+        if meta is None:
+            meta = self._load(group_id)[1]
+        return meta or None
+
+    def set_group(self, group_id: str, members, meta: dict | None = None):
+        with self._lock:
+            self._bump(group_id)
+            if meta is not None:
+                meta = {k: meta.get(k) for k in self._META_FIELDS}
+            else:
+                meta = self._meta.get(group_id)
+            self._store(group_id, frozenset(members), meta)
+
+    def remove_member(self, group_id: str, uid: str):
+        with self._lock:
+            self._bump(group_id)
+            members = self._members.get(group_id)
+            if members is not None and uid in members:
+                self._members[group_id] = members - {uid}
+
+    def invalidate(self, group_id: str):
+        with self._lock:
+            self._bump(group_id)
+            self._drop(group_id)
+
+    def _bump(self, group_id: str):
+        # Caller holds _lock
+        if group_id in self._members or group_id in self._loading:
+            self._generation[group_id] = self._generation.get(group_id, 0) + 1
+
+    def _cached(self, group_id: str) -> tuple[frozenset[str], dict | None] | None:
+        # Caller holds _lock
+        members = self._members.get(group_id)
+        if members is None:
+            return None
+        if self._expires.get(group_id, 0.0) <= time.monotonic():
+            self._drop(group_id)
+            return None
+        return members, self._meta.get(group_id)
+
+    def _store(self, group_id: str, members: frozenset[str], meta: dict | None):
+        # Caller holds _lock
+        self._members.pop(group_id, None)
+        self._meta.pop(group_id, None)
+        while len(self._members) >= self.max_groups:
+            # dicts keep insertion order, so the first key is the oldest loaded group
+            self._drop(next(iter(self._members)))
+        self._members[group_id] = members
+        if meta is not None:
+            self._meta[group_id] = meta
+        self._expires[group_id] = time.monotonic() + (self.ttl if members else self.negative_ttl)
+
+    def _drop(self, group_id: str):
+        # Caller holds _lock
+        self._members.pop(group_id, None)
+        self._meta.pop(group_id, None)
+        self._expires.pop(group_id, None)
+        if group_id not in self._loading:
+            self._generation.pop(group_id, None)
+
+    def _load(self, group_id: str) -> tuple[frozenset[str], dict]:
+        with self._lock:
+            self._loading[group_id] = self._loading.get(group_id, 0) + 1
+        try:
+            for _ in range(self._LOAD_ATTEMPTS):
+                with self._lock:
+                    generation = self._generation.get(group_id, 0)
+                members, meta = self._read(group_id)
+                with self._lock:
+                    self.loads += 1
+                    if self._generation.get(group_id, 0) == generation:
+                        self._store(group_id, members, meta)
+                        return members, meta
+                    # The group changed while RTDB was read: the snapshot may predate it
+                    self.stale_loads += 1
+                    cached = self._cached(group_id)
+                if cached is not None:
+                    return cached[0], cached[1] or {}
+            # Still changing on every read: answer from the last read without caching it
+            return members, meta
+        finally:
+            with self._lock:
+                self._end_load(group_id)
+
+    def _end_load(self, group_id: str):
+        # Caller holds _lock
+        remaining = self._loading.pop(group_id) - 1
+        if remaining:
+            self._loading[group_id] = remaining
+        elif group_id not in self._members:
+            self._generation.pop(group_id, None)
+
+    def _read(self, group_id: str) -> tuple[frozenset[str], dict]:
+        init_firebase_if_needed()
+        base = f'/groups/{group_id}'
+        # Keys sort as createdAt, createdBy, id, members, messages, name: one key-range read
+        # returns members with createdAt/createdBy and stops before the messages subtree
+        node = db.reference(base).order_by_key().end_at('members').get() or {}
+        if not isinstance(node, dict):
+            node = {}
+        raw = node.get('members') or {}
+        members = frozenset(m for m, linked in raw.items() if linked) if isinstance(raw, dict) else frozenset()
+        meta = {}
+        if members:
+            meta = {'name': db.reference(f'{base}/name').get(),
+                    'createdBy': node.get('createdBy'), 'createdAt': node.get('createdAt')}
+        return members, meta
+
+    def stats(self) -> dict:
+        with self._lock:
+            negative = sum(1 for members in self._members.values() if not members)
+            return {'groups': len(self._members), 'negative': negative, 'loads': self.loads,
+                    'stale_loads': self.stale_loads}
+
+
+group_index = GroupIndex()
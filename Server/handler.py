@@ -1,194 +1,270 @@
 import json
+import os
 import socket
+import sys
+import time
+
+try:
+    from lib.framing import LineFramer, FrameDecoder, LineTooLongError, MAX_LINE
+    from lib.framing import FRAME_TEXT, FRAME_DATA, UPGRADE_LINE, decode_data_frame
+except Exception:
+    _lib_path = os.path.join(os.path.dirname(__file__), '..', 'lib')
+    if _lib_path not in sys.path:
+        sys.path.insert(0, _lib_path)
+    from framing import LineFramer, FrameDecoder, LineTooLongError, MAX_LINE
+    from framing import FRAME_TEXT, FRAME_DATA, UPGRADE_LINE, decode_data_frame
 
 try:
     from Server.firebase_admin_utils import verify_id_token
-    from Server.state import clients, clients_lock, socket_to_user, socket_to_uid, uid_to_socket
+    from Server.session_tickets import issue_ticket, verify_ticket
+    from Server.state import clients, clients_lock, socket_to_user, socket_to_uid, uid_to_socket, delivery_lock
     from Server.commands import handle_command_line as commands_handle
+    from Server.outbound import attach as attach_outbound, detach as detach_outbound, send_bytes
+    from Server.upload_spool import drop_uploads
+    from Server.io_pools import drop as drop_commands
+    from Server.pending_delivery import pending_line
+    from Server.log import get_logger
 except Exception:
     from firebase_admin_utils import verify_id_token
-    from state import clients, clients_lock, socket_to_user, socket_to_uid, uid_to_socket
+    from session_tickets import issue_ticket, verify_ticket
+    from state import clients, clients_lock, socket_to_user, socket_to_uid, uid_to_socket, delivery_lock
     from commands import handle_command_line as commands_handle
+    from outbound import attach as attach_outbound, detach as detach_outbound, send_bytes
+    from upload_spool import drop_uploads
+    from io_pools import drop as drop_commands
+    from pending_delivery import pending_line
+    from log import get_logger
+
+_log = get_logger('conn')
 
 
 def broadcast(message: str, exclude_socket: socket.socket | None = None):
+    # Encode once, snapshot recipients, then enqueue outside clients_lock so a slow
+    # peer can never hold up logins, logouts or other broadcasts.
+    data = (message + "\n").encode('utf-8')
     with clients_lock:
-        dead_clients = []
-        for s in clients:
-            if exclude_socket is not None and s is exclude_socket:
-                continue
-            try:
-                s.sendall((message + "\n").encode('utf-8'))
-            except Exception:
-                dead_clients.append(s)
-        for s in dead_clients:
-            try:
-                clients.remove(s)
-                socket_to_user.pop(s, None)
-            except ValueError:
-                pass
+        targets = [s for s in clients if exclude_socket is None or s is not exclude_socket]
+    # Broadcasts are the only frames a full outbound queue may drop
+    dead_clients = [s for s in targets if not send_bytes(s, data, droppable=True)]
+    if dead_clients:
+        with clients_lock:
+            for s in dead_clients:
+                try:
+                    clients.remove(s)
+                    socket_to_user.pop(s, None)
+                except ValueError:
+                    pass
 
 
-def handle_client(conn: socket.socket, addr):
-    try:
-        conn.settimeout(15.0)
-        buffer = b''
-        while True:
-            chunk = conn.recv(4096)
-            if not chunk:
-                raise ConnectionAbortedError('No data during auth')
-            buffer += chunk
-            nl_index = buffer.find(b"\n")
-            if nl_index == -1:
-                if len(buffer) > 8192:
-                    raise ConnectionAbortedError('Auth line too large')
-                continue
-            line = buffer[:nl_index]
-            buffer = buffer[nl_index + 1:]
-            try:
-                text = line.decode('utf-8', errors='replace')
-            except Exception:
-                text = ''
-            if not text.startswith('AUTH '):
-                conn.sendall(b"AUTH_ERR Invalid handshake\n")
-                raise ConnectionAbortedError('Invalid handshake')
-            id_token = text[5:].strip()
-            ok, label, uid, email, name = verify_id_token(id_token)
-            if not ok:
-                err_line = f"AUTH_ERR {label}\n".encode('utf-8', errors='replace')
-                conn.sendall(err_line)
-                raise ConnectionAbortedError('Auth failed')
-            conn.sendall(b"AUTH_OK\n")
-            break
+def register_client(conn, label: str, uid: str, email: str, name: str, resumed: bool = False):
+    """Map an authenticated connection to its uid, announce it and flush its pending events.
+
+    A resumed session skips ensure_user_profile(); its first AUTH already did that.
+    """
+    attach_outbound(conn)
+    with clients_lock:
+        if conn not in clients:
+            clients.append(conn)
+        socket_to_user[conn] = label
+        try:
+            conn._chat_uid = uid
+        except Exception:
+            pass
+        try:
+            socket_to_uid[conn] = uid
+        except Exception:
+            pass
+    if not resumed:
+        try:
+            from Server.firebase_admin_utils import ensure_user_profile as _ensure
+        except Exception:
+            from firebase_admin_utils import ensure_user_profile as _ensure
+        try:
+            _ensure(uid, email, name)
+        except Exception:
+            pass
+
+    welcome = f"[Server] Welcome {label} joined"
+    _log.info('%s', welcome)
+    broadcast(welcome, exclude_socket=None)
+
+    # Events queued while the user was offline, as one PENDING command. Publishing the uid
+    # and taking the batch under delivery_lock means no push can be queued after the take
+    # or overtake the batch on the wire.
+    with delivery_lock:
+        uid_to_socket[uid] = conn
+        pending = pending_line(uid)
+        if pending:
+            send_bytes(conn, pending)
 
-        conn.settimeout(None)
 
+def unregister_client(conn, addr):
+    """Close the connection, drop every mapping that points at it and announce the leave."""
+    detach_outbound(conn)
+    drop_commands(conn)
+    drop_uploads(conn)
+    try:
+        conn.close()
+    finally:
+        name = socket_to_user.get(conn)
         with clients_lock:
-            if conn not in clients:
-                clients.append(conn)
-            socket_to_user[conn] = label
+            while True:
+                try:
+                    clients.remove(conn)
+                except ValueError:
+                    break
+            socket_to_user.pop(conn, None)
             try:
-                conn._chat_uid = uid  
+                socket_to_uid.pop(conn, None)
             except Exception:
                 pass
             try:
-                socket_to_uid[conn] = uid
-                uid_to_socket[uid] = conn
+                # Remove by value if matching
+                for k, v in list(uid_to_socket.items()):
+                    if v is conn:
+                        uid_to_socket.pop(k, None)
+
             except Exception:
                 pass
+        left = f"[Server] {(name or str(addr))} left"
+        _log.info('%s', left)
+        broadcast(left, exclude_socket=None)
+
+
+def handle_line(conn, addr, text: str) -> bool:
+    """Process one decoded protocol line. Returns False when the client asked to exit."""
+    if text.startswith('CMD '):
         try:
-            from Server.firebase_admin_utils import ensure_user_profile as _ensure
+            obj = json.loads(text[4:])
         except Exception:
-            from firebase_admin_utils import ensure_user_profile as _ensure
+            obj = None
+        if not isinstance(obj, dict):
+            send_bytes(conn, b'CMD {"type":"ERROR","message":"invalid_json"}\n')
+            return True
+        # Handler errors are answered by the dispatcher, on the pool thread that ran it
+        commands_handle(conn, obj)
+        return True
+    if text.lower() == 'exit':
+        return False
+    sender = socket_to_user.get(conn, str(addr))
+    _log.debug('%s: %s', sender, text)
+    broadcast(f"{sender}: {text}", exclude_socket=conn)
+    return True
+
+
+def handle_frame(conn, addr, frame_type: int, payload: bytes) -> bool:
+    """Process one binary frame (see lib/framing). Returns False when the client asked to exit."""
+    if frame_type == FRAME_TEXT:
+        return handle_line(conn, addr, payload.decode('utf-8', errors='replace'))
+    if frame_type != FRAME_DATA:
+        send_bytes(conn, b'CMD {"type":"ERROR","message":"bad_frame"}\n')
+        return True
+    try:
+        obj, data = decode_data_frame(payload)
+    except Exception:
+        send_bytes(conn, b'CMD {"type":"ERROR","message":"invalid_json"}\n')
+        return True
+    # Raw bytes ride along with the command instead of a base64 field
+    obj['chunkBytes'] = data
+    commands_handle(conn, obj)
+    return True
+
+
+AUTH_LINE_LIMIT = 8192
+
+
+def authenticate(text: str) -> tuple[bool, str, str, str, str, float, bool]:
+    """Check the handshake line, "AUTH <id token>" or "RESUME <session ticket>".
+
+    Returns (ok, label or error, uid, email, name, auth_at, resumed); auth_at is when
+    the user last passed a full AUTH and goes into the next ticket.
+    """
+    if text.startswith('AUTH '):
+        ok, label, uid, email, name = verify_id_token(text[5:].strip())
+        return ok, label, uid, email, name, time.time(), False
+    if text.startswith('RESUME '):
+        ok, label, uid, email, name, auth_at = verify_ticket(text[7:].strip())
+        return ok, label, uid, email, name, auth_at, True
+    return False, 'Invalid handshake', '', '', '', 0.0, False
+
+
+def session_line(uid: str, email: str, name: str, auth_at: float, resumed: bool) -> bytes:
+    """CMD SESSION sent right after AUTH_OK: the ticket for the next reconnect."""
+    ticket, expires_in = issue_ticket(uid, email, name, auth_at)
+    msg = {'type': 'SESSION', 'ticket': ticket, 'expiresIn': expires_in, 'resumed': resumed}
+    return ("CMD " + json.dumps(msg) + "\n").encode('utf-8')
+
+
+def _serve_frames(conn, addr, buffered: bytes):
+    """Rest of a connection that switched to binary frames."""
+    decoder = FrameDecoder(max_line=MAX_LINE)
+    frames = decoder.feed(buffered)
+    while True:
+        for frame_type, payload in frames:
+            if not handle_frame(conn, addr, frame_type, payload):
+                raise ConnectionAbortedError('Client requested exit')
         try:
-            _ensure(uid, email, name)
-        except Exception:
-            pass
+            frames = decoder.recv_from(conn)
+        except LineTooLongError:
+            send_bytes(conn, b'CMD {"type":"ERROR","message":"line_too_long"}\n')
+            raise ConnectionAbortedError('Frame too long')
+        if frames is None:
+            return
+
 
-        welcome = f"[Server] Welcome {label} joined"
-        print(welcome)
-        broadcast(welcome, exclude_socket=None)
-        buffer = buffer if isinstance(buffer, (bytes, bytearray)) else b''
+def handle_client(conn: socket.socket, addr):
+    try:
+        conn.settimeout(15.0)
+        framer = LineFramer(max_line=AUTH_LINE_LIMIT)
+        framer.stop_line = UPGRADE_LINE
+        # Only the AUTH line is held to AUTH_LINE_LIMIT; bytes pipelined after it wait
+        framer.one_line = True
+        try:
+            lines = []
+            while not lines:
+                lines = framer.recv_from(conn)
+                if lines is None:
+                    raise ConnectionAbortedError('No data during auth')
+        except LineTooLongError:
+            raise ConnectionAbortedError('Auth line too large')
+        text = lines[0].decode('utf-8', errors='replace')
+        ok, label, uid, email, name, auth_at, resumed = authenticate(text)
+        if not ok:
+            err_line = f"AUTH_ERR {label}\n".encode('utf-8', errors='replace')
+            conn.sendall(err_line)
+            raise ConnectionAbortedError('Auth failed')
+        conn.sendall(b"AUTH_OK\n" + session_line(uid, email, name, auth_at, resumed))
+
+        conn.settimeout(None)
+        framer.max_line = MAX_LINE
+        framer.one_line = False
+
+        register_client(conn, label, uid, email, name, resumed)
+        # Lines that arrived in the same recv() as AUTH, split now with the full limit
+        try:
+            lines = framer.feed(b'')
+        except LineTooLongError:
+            send_bytes(conn, b'CMD {"type":"ERROR","message":"line_too_long"}\n')
+            raise ConnectionAbortedError('Line too long')
         while True:
-            chunk = conn.recv(4096)
-            if not chunk:
+            for line in lines:
+                if line == UPGRADE_LINE:
+                    # feed() stopped right after this line; the rest of the buffer is frames
+                    _serve_frames(conn, addr, framer.take_pending())
+                    return
+                text = line.decode('utf-8', errors='replace')
+                if not handle_line(conn, addr, text):
+                    raise ConnectionAbortedError('Client requested exit')
+            try:
+                lines = framer.recv_from(conn)
+            except LineTooLongError:
+                send_bytes(conn, b'CMD {"type":"ERROR","message":"line_too_long"}\n')
+                raise ConnectionAbortedError('Line too long')
+            if lines is None:
                 break
-            buffer += chunk
-
-            while True:
-                nl_index = buffer.find(b"\n")
-                if nl_index != -1:
-                    line = buffer[:nl_index]
-                    buffer = buffer[nl_index + 1:]
-                    try:
-                        text = line.decode('utf-8', errors='replace')
-                    except Exception:
-                        text = '[binary data]'
-                    if text.startswith('CMD '):
-                        try:
-                            obj = json.loads(text[4:])
-                        except Exception as e:
-                            try:
-                                conn.sendall(("CMD {\"type\":\"ERROR\",\"message\":\"invalid_json\"}\n").encode('utf-8'))
-                            except Exception:
-                                pass
-                            continue
-                        
-                        try:
-                            print(f"[CMD] raw line={text}")
-                        except Exception:
-                            pass
-                        
-                        try:
-                            commands_handle(conn, obj)
-                        except Exception as e:
-                            try:
-                                err = { 'type': 'ERROR', 'message': f'cmd_failed: {e}' }
-                                conn.sendall(("CMD " + json.dumps(err) + "\n").encode('utf-8'))
-                            except Exception:
-                                pass
-                        continue
-                    if text.lower() == 'exit':
-                        raise ConnectionAbortedError('Client requested exit')
-                    sender = socket_to_user.get(conn, str(addr))
-                    print(f"{sender}: {text}")
-                    broadcast(f"{sender}: {text}", exclude_socket=conn)
-                    continue
-                else:
-                    if len(buffer) >= 1024:
-                        try:
-                            text = buffer.decode('utf-8', errors='replace')
-                        except Exception:
-                            text = ''
-                        if text:
-                            if text.startswith('CMD '):
-                                try:
-                                    obj = json.loads(text[4:])
-                                    commands_handle(conn, obj)
-                                except Exception as e:
-                                    try:
-                                        err = { 'type': 'ERROR', 'message': f'cmd_failed: {e}' }
-                                        conn.sendall(("CMD " + json.dumps(err) + "\n").encode('utf-8'))
-                                    except Exception:
-                                        pass
-                                buffer = b''
-                                continue
-                            sender = socket_to_user.get(conn, str(addr))
-                            print(f"{sender}: {text}")
-                            broadcast(f"{sender}: {text}", exclude_socket=conn)
-                            buffer = b''
-                            continue
-                    break
     except ConnectionAbortedError:
         pass
     except Exception as exc:
-        print(f"Error with {addr}: {exc}")
+        _log.warning('Error with %s: %s', addr, exc)
     finally:
-        try:
-            conn.close()
-        finally:
-            name = socket_to_user.get(conn)
-            with clients_lock:
-                while True:
-                    try:
-                        clients.remove(conn)
-                    except ValueError:
-                        break
-                socket_to_user.pop(conn, None)
-                try:
-                    socket_to_uid.pop(conn, None)
-                except Exception:
-                    pass
-                try:
-                    # Remove by value if matching
-                    for k, v in list(uid_to_socket.items()):
-                        if v is conn:
-                            uid_to_socket.pop(k, None)
-                    
-                except Exception:
-                    pass
-            left = f"[Server] {(name or str(addr))} left"
-            print(left)
-            broadcast(left, exclude_socket=None)
-
-
+        unregister_client(conn, addr)
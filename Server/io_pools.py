@@ -0,0 +1,189 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from Server.log import get_logger
+    from Server import metrics
+except Exception:
+    from log import get_logger
+    import metrics
+
+_log = get_logger('pools')
+
+# Workers and queue cap of each pool, by CommandSpec.io. A command is refused (busy) when
+# its pool already has that many commands waiting or running.
+POOL_CONFIG = {
+    'db_read': (int(os.environ.get('CHAT_POOL_DB_READ_WORKERS', '16')),
+                int(os.environ.get('CHAT_POOL_DB_READ_QUEUE', '512'))),
+    'db_write': (int(os.environ.get('CHAT_POOL_DB_WRITE_WORKERS', '8')),
+                 int(os.environ.get('CHAT_POOL_DB_WRITE_QUEUE', '512'))),
+    'storage': (int(os.environ.get('CHAT_POOL_STORAGE_WORKERS', '4')),
+                int(os.environ.get('CHAT_POOL_STORAGE_QUEUE', '32'))),
+}
+# Commands one connection may have waiting before its reader stops reading (TCP backpressure)
+MAX_PENDING_PER_CONN = int(os.environ.get('CHAT_CONN_MAX_PENDING', '32'))
+
+
+class Pool:
+    """ThreadPoolExecutor plus a count of accepted commands, so the queue is bounded."""
+
+    def __init__(self, name: str, workers: int, max_queued: int):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.depth = 0        # accepted and not finished (waiting in a lane, queued or running)
+        self.running = 0
+        self.rejected = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.depth >= self.max_queued:
+                self.rejected += 1
+                return False
+            self.depth += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.depth -= 1
+
+    def submit(self, fn):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'chat-{self.name}')
+            executor = self._executor
+        executor.submit(fn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'workers': self.workers, 'depth': self.depth, 'running': self.running,
+                    'max_queued': self.max_queued, 'rejected': self.rejected}
+
+
+class Lane:
+    """Commands of one connection, run one at a time in arrival order.
+
+    Only the head of the lane is ever handed to a pool; when it finishes the next one is
+    dispatched, so replies leave in the order the commands came in even though they run
+    on different pools. Memory-only commands (io=None) run on whichever thread finishes
+    the command before them, or inline when the lane is idle.
+    """
+
+    __slots__ = ('pending', 'running', 'closed', 'cond')
+
+    def __init__(self):
+        self.pending: deque = deque()   # (pool or None, fn)
+        self.running = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+
+_pools = {name: Pool(name, workers, max_queued) for name, (workers, max_queued) in POOL_CONFIG.items()}
+_lanes: dict = {}
+_lanes_lock = threading.Lock()
+
+
+def _lane(conn) -> Lane:
+    with _lanes_lock:
+        lane = _lanes.get(conn)
+        if lane is None:
+            lane = _lanes[conn] = Lane()
+        return lane
+
+
+def submit(conn, io: str | None, fn) -> bool:
+    """Run fn() for conn on the pool for `io`, after conn's earlier commands.
+
+    Returns False (nothing queued) when that pool is full. Blocks the caller - the
+    connection's reader - while conn already has MAX_PENDING_PER_CONN commands waiting.
+    """
+    pool = _pools.get(io) if io else None
+    if pool is not None and not pool.try_acquire():
+        metrics.incr(f'pool.{io}.busy')
+        return False
+    lane = _lane(conn)
+    with lane.cond:
+        while len(lane.pending) >= MAX_PENDING_PER_CONN and not lane.closed:
+            lane.cond.wait()
+        if lane.closed:
+            if pool is not None:
+                pool.release()
+            return True
+        if lane.running or lane.pending:
+            lane.pending.append((pool, fn))
+            return True
+        lane.running = True
+    _dispatch(lane, pool, fn)
+    return True
+
+
+def _dispatch(lane: Lane, pool: Pool | None, fn):
+    while True:
+        if pool is not None:
+            pool.submit(lambda: _run_pooled(lane, pool, fn))
+            return
+        _run(fn)
+        nxt = _next(lane)
+        if nxt is None:
+            return
+        pool, fn = nxt
+
+
+def _run(fn):
+    try:
+        fn()
+    except Exception as e:
+        _log.exception('command failed: %s', e)
+
+
+def _run_pooled(lane: Lane, pool: Pool, fn):
+    with pool._lock:
+        pool.running += 1
+    try:
+        _run(fn)
+    finally:
+        with pool._lock:
+            pool.running -= 1
+        pool.release()
+    nxt = _next(lane)
+    if nxt is not None:
+        _dispatch(lane, *nxt)
+
+
+def _next(lane: Lane):
+    with lane.cond:
+        if not lane.pending or lane.closed:
+            lane.running = False
+            return None
+        nxt = lane.pending.popleft()
+        lane.cond.notify()
+        return nxt
+
+
+def drop(conn):
+    """Connection closed: forget its waiting commands (a running one finishes)."""
+    with _lanes_lock:
+        lane = _lanes.pop(conn, None)
+    if lane is None:
+        return
+    with lane.cond:
+        lane.closed = True
+        dropped = list(lane.pending)
+        lane.pending.clear()
+        lane.cond.notify_all()
+    for pool, _ in dropped:
+        if pool is not None:
+            pool.release()
+
+
+def stats() -> dict:
+    with _lanes_lock:
+        lanes = len(_lanes)
+    return {'connections': lanes, **{name: pool.stats() for name, pool in _pools.items()}}
+
+
+metrics.register_gauge('pools', stats)
@@ -0,0 +1,22 @@
+import logging
+import os
+
+# CHAT_LOG_LEVEL=DEBUG also logs every command and chat line; the default INFO only logs
+# connections, state changes and errors.
+LOG_LEVEL = os.environ.get('CHAT_LOG_LEVEL', 'INFO').strip().upper()
+
+logger = logging.getLogger('chat.server')
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(name)s] %(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Child of the server logger, e.g. get_logger('cmd') -> chat.server.cmd.
+
+    Pass payloads as %-style arguments so they are only formatted when the level is enabled.
+    """
+    return logger.getChild(name)
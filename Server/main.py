@@ -1,29 +1,35 @@
+import argparse
+import os
 import socket
 import threading
 
 try:
     from Server.handler import handle_client
     from Server.state import clients, clients_lock
+    from Server.log import get_logger
 except Exception:
     from handler import handle_client
     from state import clients, clients_lock
+    from log import get_logger
+
+_log = get_logger('main')
 
 # Server Configuration
-def run_server(host: str = '0.0.0.0', port: int = 8080):
+def run_server(host: str = '0.0.0.0', port: int = 8080, backlog: int = 128):
     host_Server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # Dòng lệnh TCP
     host_Server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     host_Server.bind((host, port))
-    host_Server.listen(5)
+    host_Server.listen(backlog)
 
-    print(f"Server is listening on port {port}...")
+    _log.info('Server is listening on port %d...', port)
 
     try:
         while True:
             conn, addr = host_Server.accept() # Accept a connection from a client / Hướng kết nối từ client
-            print(f"Connection from {addr} has been established!")
+            _log.info('Connection from %s has been established!', addr)
             threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
     except KeyboardInterrupt:
-        print("Shutting down server...")
+        _log.info('Shutting down server...')
     finally:
         with clients_lock:
             for c in clients:
@@ -35,7 +41,27 @@ def run_server(host: str = '0.0.0.0', port: int = 8080):
         host_Server.close()
 
 
-if __name__ == '__main__':
-    run_server()
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat socket server')
+    parser.add_argument('--host', default=os.environ.get('CHAT_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('CHAT_PORT', '8080')))
+    parser.add_argument('--mode', choices=('threaded', 'asyncio'), default=os.environ.get('CHAT_SERVER_MODE', 'threaded'),
+                        help='threaded: one thread per client; asyncio: one event loop + bounded executor')
+    parser.add_argument('--backlog', type=int, default=int(os.environ.get('CHAT_BACKLOG', '128')),
+                        help='listen() accept backlog')
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('CHAT_WORKERS', '32')),
+                        help='asyncio mode: max threads for blocking Firebase calls')
+    args = parser.parse_args(argv)
 
+    if args.mode == 'asyncio':
+        try:
+            from Server.async_server import run_async_server
+        except Exception:
+            from async_server import run_async_server
+        run_async_server(args.host, args.port, backlog=args.backlog, workers=args.workers)
+    else:
+        run_server(args.host, args.port, backlog=args.backlog)
 
+
+if __name__ == '__main__':
+    main()
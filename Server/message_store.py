@@ -0,0 +1,351 @@
+import abc
+import heapq
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+try:
+    from Server.firebase_admin_utils import init_firebase_if_needed, db
+    from Server.log import get_logger
+except Exception:
+    from firebase_admin_utils import init_firebase_if_needed, db
+    from log import get_logger
+
+_log = get_logger('store')
+
+# split    - text in RTDB, files in Firestore (layout of existing deployments)
+# rtdb     - everything in RTDB /chats|/groups/{id}/messages
+# firestore- everything in Firestore conversations/{id}/messages
+# sqlite   - local file (CHAT_SQLITE_PATH), for tests and self-hosting
+MESSAGE_STORE = os.environ.get('CHAT_MESSAGE_STORE', 'split').strip().lower()
+SQLITE_PATH = os.environ.get('CHAT_SQLITE_PATH', os.path.join(os.path.dirname(__file__), 'chat_messages.db'))
+
+_FILE_FIELDS = ('fileURL', 'fileType', 'fileName')
+
+
+def make_message(sender_uid: str, text: str = '', *, system: bool = False,
+                 file_url: str = '', file_type: str = '', file_name: str = '') -> dict:
+    """Canonical message record: id, senderUid, ts (ms), text, [system], [fileURL, fileType, fileName].
+
+    id and ts are filled in by MessageStore.append().
+    """
+    msg = {'id': '', 'senderUid': sender_uid or '', 'text': text or '', 'ts': 0}
+    if system:
+        msg['system'] = True
+    if file_url:
+        msg['fileURL'] = file_url
+        msg['fileType'] = file_type or 'application'
+        msg['fileName'] = file_name or 'Unknown'
+    return msg
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _older_than(msg: dict, before: int | None, before_id: str) -> bool:
+    if before is None:
+        return True
+    return (msg['ts'], msg['id']) < (before, before_id)
+
+
+def _newer_than(msg: dict, after: int | None, after_id: str) -> bool:
+    if after is None:
+        return True
+    return (msg['ts'], msg['id']) > (after, after_id)
+
+
+class MessageStore(abc.ABC):
+    """Where chat messages of one conversation (DM thread id or group id) live.
+
+    Every backend stores the canonical record from make_message() and answers page()
+    with one range scan ordered by (ts, id), backwards from `before` for older history or
+    forwards from `after` to catch up on what a client missed.
+    """
+
+    @abc.abstractmethod
+    def append(self, conversation_id: str, message: dict, is_group: bool = False) -> dict:
+        """Persist message and return it with id and ts set, ts being the value stored."""
+
+    @abc.abstractmethod
+    def page(self, conversation_id: str, is_group: bool, limit: int,
+             before: int | None = None, before_id: str = '',
+             after: int | None = None, after_id: str = '') -> tuple[list[dict], bool]:
+        """Newest `limit` messages older than (before, before_id), ascending, plus has_more.
+
+        With `after` set instead: the oldest `limit` messages newer than (after, after_id),
+        ascending; has_more then means there are still newer ones.
+        """
+
+
+class RTDBMessageStore(MessageStore):
+    """/chats/{thread_id}/messages and /groups/{group_id}/messages in the Realtime Database."""
+
+    @staticmethod
+    def _path(conversation_id: str, is_group: bool) -> str:
+        return f'/groups/{conversation_id}/messages' if is_group else f'/chats/{conversation_id}/messages'
+
+    def append(self, conversation_id: str, message: dict, is_group: bool = False) -> dict:
+        init_firebase_if_needed()
+        # ts is written explicitly (not {'.sv': 'timestamp'}) so the returned record is the
+        # stored one and can be used as a history cursor
+        ts = message.get('ts') or _now_ms()
+        data = {k: v for k, v in message.items() if k not in ('id', 'ts')}
+        data['ts'] = ts
+        ref = db.reference(self._path(conversation_id, is_group)).push(data)
+        return {**message, 'id': ref.key, 'ts': ts}
+
+    def page(self, conversation_id: str, is_group: bool, limit: int,
+             before: int | None = None, before_id: str = '',
+             after: int | None = None, after_id: str = '') -> tuple[list[dict], bool]:
+        """Uses order_by_child('ts').limit_to_last() so only one page is transferred.
+
+        That query needs ".indexOn": "ts" on the messages node; without it we fall back to
+        a full read. start_at/end_at are inclusive of the cursor's ts, so rows at that ts
+        already shown (the cursor itself included) are filtered out afterwards; the query
+        is widened until the filtered list has limit + 1 rows or the node is exhausted.
+        """
+        init_firebase_if_needed()
+        path = self._path(conversation_id, is_group)
+        ref = db.reference(path)
+        fetch = limit + 2
+        while True:
+            try:
+                query = ref.order_by_child('ts')
+                if after is not None:
+                    data = query.start_at(after).limit_to_first(fetch).get() or {}
+                else:
+                    if before is not None:
+                        query = query.end_at(before)
+                    data = query.limit_to_last(fetch).get() or {}
+                full_read = False
+            except Exception as e:
+                _log.warning('history query on %s failed (%s), reading whole node; add ".indexOn": "ts"', path, e)
+                data = ref.get() or {}
+                full_read = True
+            messages = self._messages(data)
+            raw_count = len(messages)
+            if after is not None:
+                messages = [m for m in messages if _newer_than(m, after, after_id)]
+            else:
+                messages = [m for m in messages if _older_than(m, before, before_id)]
+            if full_read or len(messages) > limit or raw_count < fetch:
+                break
+            fetch *= 2
+        messages.sort(key=lambda x: (x['ts'], x['id']))
+        has_more = len(messages) > limit
+        if after is not None:
+            return messages[:limit], has_more
+        return messages[-limit:], has_more
+
+    @staticmethod
+    def _messages(data) -> list[dict]:
+        messages = []
+        if isinstance(data, dict):
+            for mid, m in data.items():
+                if not isinstance(m, dict):
+                    continue
+                msg = make_message(m.get('senderUid') or '', m.get('text') or '', system=bool(m.get('system')),
+                                   file_url=m.get('fileURL') or '', file_type=m.get('fileType') or '',
+                                   file_name=m.get('fileName') or '')
+                msg['id'] = mid
+                msg['ts'] = m.get('ts') or 0
+                messages.append(msg)
+        return messages
+
+
+class FirestoreMessageStore(MessageStore):
+    """conversations/{conversation_id}/messages in Firestore (the schema lib/upload.py writes)."""
+
+    @staticmethod
+    def _collection(conversation_id: str):
+        from firebase_admin import firestore as admin_firestore
+        init_firebase_if_needed()
+        return admin_firestore.client().collection("conversations").document(conversation_id).collection("messages")
+
+    def append(self, conversation_id: str, message: dict, is_group: bool = False) -> dict:
+        ts = message.get('ts') or _now_ms()
+        # Millisecond datetime rather than SERVER_TIMESTAMP, so page() reads back exactly ts
+        doc = {"senderId": message.get('senderUid', ''), "timestamp": datetime.fromtimestamp(ts / 1000.0, tz=timezone.utc)}
+        if message.get('text'):
+            doc["text"] = message['text']
+        if message.get('system'):
+            doc["system"] = True
+        for key in _FILE_FIELDS:
+            if message.get(key):
+                doc[key] = message[key]
+        ref = self._collection(conversation_id).document()
+        ref.set(doc)
+        return {**message, 'id': ref.id, 'ts': ts}
+
+    def page(self, conversation_id: str, is_group: bool, limit: int,
+             before: int | None = None, before_id: str = '',
+             after: int | None = None, after_id: str = '') -> tuple[list[dict], bool]:
+        from firebase_admin import firestore as admin_firestore
+        collection = self._collection(conversation_id)
+        # The cursor row and rows tied with it at the cursor ms match the range below and
+        # are filtered out afterwards, so the query is widened until the filtered list has
+        # limit + 1 rows or the collection is exhausted
+        fetch = limit + 2
+        while True:
+            if after is not None:
+                # Everything that truncates to >= after ms; the tie-break is applied below
+                query = collection.where("timestamp", ">=", datetime.fromtimestamp(after / 1000.0, tz=timezone.utc))
+                query = query.order_by("timestamp").limit(fetch)
+            else:
+                query = collection
+                if before is not None:
+                    # Firestore keeps microseconds; everything that truncates to <= before ms, then
+                    # the (ts, id) tie-break is applied below since document ids are random
+                    query = query.where("timestamp", "<", datetime.fromtimestamp((before + 1) / 1000.0, tz=timezone.utc))
+                query = query.order_by("timestamp", direction=admin_firestore.Query.DESCENDING).limit(fetch)
+            messages = []
+            raw_count = 0
+            for doc in query.stream():
+                raw_count += 1
+                msg_data = doc.to_dict()
+                if not msg_data:
+                    continue
+                # Convert Firestore timestamp to milliseconds
+                timestamp = msg_data.get('timestamp')
+                ts_ms = int(timestamp.timestamp() * 1000) if hasattr(timestamp, 'timestamp') else 0
+                msg = make_message(msg_data.get('senderId', ''), msg_data.get('text', ''),
+                                   system=bool(msg_data.get('system')),
+                                   file_url=msg_data.get('fileURL', ''), file_type=msg_data.get('fileType', 'application'),
+                                   file_name=msg_data.get('fileName', 'Unknown'))
+                msg['id'] = doc.id
+                msg['ts'] = ts_ms
+                if _older_than(msg, before, before_id) and _newer_than(msg, after, after_id):
+                    messages.append(msg)
+            if len(messages) > limit or raw_count < fetch:
+                break
+            fetch *= 2
+        messages.sort(key=lambda x: (x['ts'], x['id']))
+        has_more = len(messages) > limit
+        if after is not None:
+            return messages[:limit], has_more
+        return messages[-limit:], has_more
+
+
+class SplitMessageStore(MessageStore):
+    """Text and system messages in RTDB, file messages in Firestore; pages are merged by ts."""
+
+    def __init__(self, text_store: MessageStore | None = None, file_store: MessageStore | None = None):
+        self.text_store = text_store or RTDBMessageStore()
+        self.file_store = file_store or FirestoreMessageStore()
+
+    def append(self, conversation_id: str, message: dict, is_group: bool = False) -> dict:
+        store = self.file_store if message.get('fileURL') else self.text_store
+        return store.append(conversation_id, message, is_group)
+
+    def page(self, conversation_id: str, is_group: bool, limit: int,
+             before: int | None = None, before_id: str = '',
+             after: int | None = None, after_id: str = '') -> tuple[list[dict], bool]:
+        texts, more_texts = self.text_store.page(conversation_id, is_group, limit, before, before_id, after, after_id)
+        try:
+            files, more_files = self.file_store.page(conversation_id, is_group, limit, before, before_id,
+                                                     after, after_id)
+        except Exception as e:
+            _log.warning('loading Firestore messages of %s failed: %s', conversation_id, e)
+            files, more_files = [], False
+        # Both lists are already sorted; k-way merge instead of concatenate + sort
+        merged = list(heapq.merge(texts, files, key=lambda x: (x['ts'], x['id'])))
+        page = merged[:limit] if after is not None else merged[-limit:]
+        return page, more_texts or more_files or len(merged) > limit
+
+
+class SQLiteMessageStore(MessageStore):
+    """Single-file store; history is one range scan on the (conversation_id, ts, id) primary key."""
+
+    def __init__(self, path: str = SQLITE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            ' conversation_id TEXT NOT NULL, ts INTEGER NOT NULL, id TEXT NOT NULL,'
+            ' is_group INTEGER NOT NULL DEFAULT 0, sender_uid TEXT NOT NULL DEFAULT \'\','
+            ' text TEXT NOT NULL DEFAULT \'\', system INTEGER NOT NULL DEFAULT 0,'
+            ' file_url TEXT, file_type TEXT, file_name TEXT,'
+            ' PRIMARY KEY (conversation_id, ts, id)) WITHOUT ROWID'
+        )
+        self._conn.commit()
+
+    def append(self, conversation_id: str, message: dict, is_group: bool = False) -> dict:
+        record = {**message, 'id': message.get('id') or uuid.uuid4().hex, 'ts': message.get('ts') or _now_ms()}
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (conversation_id, record['ts'], record['id'], int(is_group), record.get('senderUid', ''),
+                 record.get('text', ''), int(bool(record.get('system'))),
+                 record.get('fileURL'), record.get('fileType'), record.get('fileName')),
+            )
+            self._conn.commit()
+        return record
+
+    def page(self, conversation_id: str, is_group: bool, limit: int,
+             before: int | None = None, before_id: str = '',
+             after: int | None = None, after_id: str = '') -> tuple[list[dict], bool]:
+        sql = 'SELECT ts, id, sender_uid, text, system, file_url, file_type, file_name FROM messages WHERE conversation_id = ?'
+        args: list = [conversation_id]
+        if after is not None:
+            sql += ' AND (ts > ? OR (ts = ? AND id > ?)) ORDER BY ts, id LIMIT ?'
+            args += [after, after, after_id, limit + 1]
+        else:
+            if before is not None:
+                sql += ' AND (ts < ? OR (ts = ? AND id < ?))'
+                args += [before, before, before_id]
+            sql += ' ORDER BY ts DESC, id DESC LIMIT ?'
+            args.append(limit + 1)
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        messages = []
+        for ts, mid, sender_uid, text, system, file_url, file_type, file_name in rows[:limit]:
+            msg = make_message(sender_uid, text, system=bool(system),
+                               file_url=file_url or '', file_type=file_type or '', file_name=file_name or '')
+            msg['id'] = mid
+            msg['ts'] = ts
+            messages.append(msg)
+        if after is None:
+            messages.reverse()
+        return messages, len(rows) > limit
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_BACKENDS = {
+    'split': SplitMessageStore,
+    'rtdb': RTDBMessageStore,
+    'firestore': FirestoreMessageStore,
+    'sqlite': SQLiteMessageStore,
+}
+_store: MessageStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_message_store() -> MessageStore:
+    """The process-wide store selected by CHAT_MESSAGE_STORE (created on first use)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = _BACKENDS.get(MESSAGE_STORE)
+                if backend is None:
+                    _log.warning('unknown CHAT_MESSAGE_STORE=%s, using split', MESSAGE_STORE)
+                    backend = SplitMessageStore
+                _store = backend()
+    return _store
+
+
+def set_message_store(store: MessageStore | None):
+    """Replace the process-wide store (tests, benchmarks)."""
+    global _store
+    with _store_lock:
+        _store = store
@@ -0,0 +1,95 @@
+import threading
+import time
+from typing import Callable
+
+# Upper bounds (ms) of the latency histogram buckets; the last bucket is "slower than that".
+LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class CommandStats:
+    """Count, error count and latency histogram of one command type."""
+
+    __slots__ = ('count', 'errors', 'total_ms', 'max_ms', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, elapsed_ms: float, ok: bool):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.total_ms += elapsed_ms
+        if elapsed_ms > self.max_ms:
+            self.max_ms = elapsed_ms
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if elapsed_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'avg_ms': round(self.total_ms / self.count, 3) if self.count else 0.0,
+            'max_ms': round(self.max_ms, 3),
+            'histogram': {
+                **{f'le_{b}ms': n for b, n in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                'inf': self.buckets[-1],
+            },
+        }
+
+
+_commands: dict[str, CommandStats] = {}
+_counters: dict[str, int] = {}
+_gauges: dict[str, Callable[[], dict | int | float]] = {}
+_lock = threading.Lock()
+_started = time.time()
+
+
+def record_command(cmd_type: str, elapsed_s: float, ok: bool = True):
+    with _lock:
+        stats = _commands.get(cmd_type)
+        if stats is None:
+            stats = _commands[cmd_type] = CommandStats()
+        stats.add(elapsed_s * 1000.0, ok)
+
+
+def incr(name: str, n: int = 1):
+    """Bump a free-form counter (cache hits/misses, dropped frames, ...)."""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def register_gauge(name: str, fn: Callable[[], dict | int | float]):
+    """Report fn() under 'gauges' in every snapshot (cache hit ratios, queue depths, ...)."""
+    with _lock:
+        _gauges[name] = fn
+
+
+def snapshot() -> dict:
+    with _lock:
+        snap = {
+            'uptime_s': round(time.time() - _started, 1),
+            'commands': {name: s.to_dict() for name, s in sorted(_commands.items())},
+            'counters': dict(_counters),
+        }
+        gauges = list(_gauges.items())
+    snap['gauges'] = {}
+    for name, fn in gauges:
+        try:
+            snap['gauges'][name] = fn()
+        except Exception:
+            pass
+    return snap
+
+
+def reset():
+    with _lock:
+        _commands.clear()
+        _counters.clear()
@@ -0,0 +1,182 @@
+import os
+import socket
+import threading
+from collections import deque
+
+try:
+    from Server.state import outbound_queues, outbound_lock
+except Exception:
+    from state import outbound_queues, outbound_lock
+
+# Per-connection cap on bytes waiting to be written, and what to do when a slow peer hits it:
+#   drop_oldest - discard the oldest droppable frames (broadcasts) until the new one fits;
+#                 if only command replies and pushed events are left, close the connection
+#   disconnect  - close the connection
+MAX_QUEUED_BYTES = int(os.environ.get('CHAT_OUTBOUND_MAX_BYTES', str(8 * 1024 * 1024)))
+OVERFLOW_POLICY = os.environ.get('CHAT_OUTBOUND_POLICY', 'drop_oldest').strip().lower()
+
+
+_MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+def drop_droppable(frames: deque, need: int, keep_head: bool = False) -> tuple[int, int]:
+    """Remove the oldest droppable (data, droppable) frames until `need` bytes are freed.
+
+    Replies and pushed events are never dropped; a client waiting for FILE_SENT or
+    DM_HISTORY would hang. keep_head protects a partially sent head frame. Returns
+    (bytes freed, frames dropped).
+    """
+    kept = deque()
+    freed = dropped = 0
+    for i, (data, droppable) in enumerate(frames):
+        if freed < need and droppable and not (keep_head and i == 0):
+            freed += len(data)
+            dropped += 1
+        else:
+            kept.append((data, droppable))
+    if dropped:
+        frames.clear()
+        frames.extend(kept)
+    return freed, dropped
+
+
+class OutboundQueue:
+    """Bounded queue of pre-encoded frames drained by a writer thread per socket.
+
+    put() never blocks, so broadcast() and command handlers are not held up by a
+    peer whose TCP window is full. While the queue is empty the frame is first tried
+    with a non-blocking send() from the caller; the writer thread is only started
+    the first time a peer falls behind.
+    """
+
+    def __init__(self, conn: socket.socket, max_bytes: int = MAX_QUEUED_BYTES, policy: str = OVERFLOW_POLICY):
+        self.conn = conn
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.dropped = 0
+        self._frames: deque[tuple[bytes, bool]] = deque()   # (data, droppable)
+        self._queued_bytes = 0
+        self._sending = False
+        # Head frame is the tail of a partially sent line and must not be dropped
+        self._head_partial = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, data: bytes, droppable: bool = False) -> bool:
+        """Queue a frame. Returns False if the connection is closed or was dropped for overflow.
+
+        droppable frames (broadcasts) may be discarded to make room; a droppable frame that
+        does not fit is itself discarded (and still reported as sent).
+        """
+        with self._cond:
+            if self._closed:
+                return False
+            if not self._frames and not self._sending and _MSG_DONTWAIT:
+                try:
+                    sent = self.conn.send(data, _MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except Exception:
+                    self._closed = True
+                    _kill(self.conn)
+                    return False
+                if sent == len(data):
+                    return True
+                if sent:
+                    data = data[sent:]
+                    self._head_partial = True
+            excess = self._queued_bytes + len(data) - self.max_bytes
+            if excess > 0 and self.policy != 'disconnect':
+                freed, dropped = drop_droppable(self._frames, excess, keep_head=self._head_partial)
+                self._queued_bytes -= freed
+                self.dropped += dropped
+                excess -= freed
+                if excess > 0 and droppable:
+                    self.dropped += 1
+                    return True
+            if excess > 0:
+                self._closed = True
+                self._cond.notify()
+                _kill(self.conn)
+                return False
+            self._frames.append((data, droppable))
+            self._queued_bytes += len(data)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+            return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._frames.clear()
+            self._queued_bytes = 0
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._sending = False
+                while not self._frames and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                # Coalesce everything queued so far into one sendall
+                batch = b''.join(data for data, _ in self._frames)
+                self._frames.clear()
+                self._queued_bytes = 0
+                self._head_partial = False
+                self._sending = True
+            try:
+                self.conn.sendall(batch)
+            except Exception:
+                with self._cond:
+                    self._closed = True
+                _kill(self.conn)
+                return
+
+
+def _kill(conn):
+    # shutdown() wakes the reader blocked in recv() so the normal cleanup path runs
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def attach(conn):
+    """Give an authenticated connection its outbound queue.
+
+    Connections that already buffer without blocking (asyncio engine) expose their own
+    put() and are registered as-is.
+    """
+    queue = conn if hasattr(conn, 'put') else OutboundQueue(conn)
+    with outbound_lock:
+        outbound_queues[conn] = queue
+
+
+def detach(conn):
+    with outbound_lock:
+        queue = outbound_queues.pop(conn, None)
+    if queue is not None and queue is not conn:
+        queue.close()
+
+
+def send_bytes(conn, data: bytes, droppable: bool = False) -> bool:
+    """Send pre-encoded bytes through the connection's queue (direct sendall before AUTH).
+
+    Only broadcasts pass droppable=True; see OutboundQueue.put.
+    """
+    queue = outbound_queues.get(conn)
+    if queue is not None:
+        return queue.put(data, droppable)
+    try:
+        conn.sendall(data)
+        return True
+    except Exception:
+        return False
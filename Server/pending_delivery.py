@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    from Server.log import get_logger
+    from Server import metrics
+except Exception:
+    from log import get_logger
+    import metrics
+
+_log = get_logger('pending')
+
+PENDING_PATH = os.environ.get('CHAT_PENDING_PATH', os.path.join(os.path.dirname(__file__), 'pending_delivery.db'))
+# Events kept per offline user; older ones are dropped and the batch is marked truncated,
+# so the client knows to reload instead of trusting the delta
+MAX_PER_USER = int(os.environ.get('CHAT_PENDING_MAX_PER_USER', '500'))
+# Events older than this are dropped at delivery (and the batch marked truncated)
+MAX_AGE = float(os.environ.get('CHAT_PENDING_MAX_AGE', str(7 * 24 * 3600)))
+
+
+class PendingQueue:
+    """Realtime events (DM, FILE_MESSAGE, GROUP_MESSAGE) for users who were offline.
+
+    Events are stored as the already-encoded JSON of the push, in a SQLite file so they
+    survive a restart, and handed out once as a single PENDING command after AUTH_OK.
+    """
+
+    def __init__(self, path: str = PENDING_PATH, max_per_user: int = MAX_PER_USER, max_age: float = MAX_AGE):
+        self.path = path
+        self.max_per_user = max(1, max_per_user)
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ':memory:':
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS pending ('
+            ' seq INTEGER PRIMARY KEY AUTOINCREMENT, uid TEXT NOT NULL,'
+            ' created REAL NOT NULL, payload TEXT NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pending_uid ON pending (uid, seq)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS pending_overflow (uid TEXT PRIMARY KEY)')
+        self._conn.commit()
+
+    def add(self, uids, payload: str):
+        """Queue one encoded event for every uid (one transaction for a whole group fan-out)."""
+        uids = [u for u in uids if u]
+        if not uids:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany('INSERT INTO pending (uid, created, payload) VALUES (?, ?, ?)',
+                                   [(u, now, payload) for u in uids])
+            for uid in uids:
+                cur = self._conn.execute(
+                    'DELETE FROM pending WHERE uid = ? AND seq <= '
+                    '(SELECT seq FROM pending WHERE uid = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                    (uid, uid, self.max_per_user))
+                if cur.rowcount > 0:
+                    self._conn.execute('INSERT OR IGNORE INTO pending_overflow (uid) VALUES (?)', (uid,))
+                    metrics.incr('pending.dropped', cur.rowcount)
+            self._conn.commit()
+        metrics.incr('pending.queued', len(uids))
+
+    def take(self, uid: str) -> tuple[list[str], bool]:
+        """Remove and return uid's queued events (oldest first) and whether some were dropped."""
+        with self._lock:
+            rows = self._conn.execute('SELECT created, payload FROM pending WHERE uid = ? ORDER BY seq',
+                                      (uid,)).fetchall()
+            truncated = self._conn.execute('DELETE FROM pending_overflow WHERE uid = ?', (uid,)).rowcount > 0
+            if rows:
+                self._conn.execute('DELETE FROM pending WHERE uid = ?', (uid,))
+            if rows or truncated:
+                self._conn.commit()
+        cutoff = time.time() - self.max_age
+        events = [payload for created, payload in rows if created >= cutoff]
+        if len(events) < len(rows):
+            truncated = True
+        if events:
+            metrics.incr('pending.delivered', len(events))
+        return events, truncated
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_queue: PendingQueue | None = None
+_queue_lock = threading.Lock()
+
+
+def get_pending_queue() -> PendingQueue:
+    """The process-wide queue at CHAT_PENDING_PATH (created on first use)."""
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = PendingQueue()
+    return _queue
+
+
+def set_pending_queue(queue: PendingQueue | None):
+    """Replace the process-wide queue (tests, benchmarks)."""
+    global _queue
+    with _queue_lock:
+        _queue = queue
+
+
+def pending_line(uid: str) -> bytes | None:
+    """CMD PENDING with everything queued for uid, or None when there is nothing.
+
+    The stored payloads are spliced in as they are, so a long backlog is not decoded and
+    re-encoded.
+    """
+    try:
+        events, truncated = get_pending_queue().take(uid)
+    except Exception as e:
+        _log.warning('reading pending events of %s failed: %s', uid, e)
+        return None
+    if not events and not truncated:
+        return None
+    head = '{"type": "PENDING", "truncated": %s, "events": [' % ('true' if truncated else 'false')
+    return ('CMD ' + head + ', '.join(events) + ']}\n').encode('utf-8')
@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+try:
+    from Server.firebase_admin_utils import revocation_state
+    from Server.log import get_logger
+    from Server import metrics
+except Exception:
+    from firebase_admin_utils import revocation_state
+    from log import get_logger
+    import metrics
+
+_log = get_logger('auth')
+
+# Tickets are signed with this key; without CHAT_SESSION_SECRET every restart picks a new
+# one, so tickets from before a restart fall back to a full AUTH (and several server
+# processes behind one address need the same secret)
+SESSION_SECRET = os.environ.get('CHAT_SESSION_SECRET', '').encode('utf-8') or secrets.token_bytes(32)
+# How long a ticket can be presented after it was issued
+TICKET_TTL = float(os.environ.get('CHAT_SESSION_TICKET_TTL', '600'))
+# How long resumed sessions may chain from one full AUTH before the ID token is checked again
+SESSION_MAX_AGE = float(os.environ.get('CHAT_SESSION_MAX_AGE', '3600'))
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(payload: str) -> str:
+    return _b64(hmac.new(SESSION_SECRET, payload.encode('ascii'), hashlib.sha256).digest())
+
+
+def issue_ticket(uid: str, email: str, name: str, auth_at: float | None = None) -> tuple[str, int]:
+    """Ticket for RESUME and its lifetime in seconds.
+
+    auth_at is when the user last passed a full AUTH; a resumed session keeps it, so
+    tickets cannot be renewed past SESSION_MAX_AGE without a fresh ID token.
+    """
+    now = time.time()
+    auth_at = now if auth_at is None else auth_at
+    expires = min(now + TICKET_TTL, auth_at + SESSION_MAX_AGE)
+    body = json.dumps({'uid': uid, 'email': email, 'name': name, 'auth': int(auth_at), 'exp': int(expires)},
+                      separators=(',', ':'))
+    payload = _b64(body.encode('utf-8'))
+    return f'{payload}.{_sign(payload)}', max(0, int(expires - now))
+
+
+def verify_ticket(ticket: str) -> tuple[bool, str, str, str, str, float]:
+    """Check a RESUME ticket; returns (ok, label or error, uid, email, name, auth_at).
+
+    Checks the signature and expiry, then the user's revocation state (a user revoked,
+    disabled or deleted after the ticket's AUTH is refused). That state comes from
+    revocation_cache, so a resume within CHAT_AUTH_REVOCATION_RECHECK of the last check
+    costs no Firebase round trip; otherwise it goes through the same batched lookup as
+    AUTH, and a failed lookup refuses the ticket.
+    """
+    payload, _, sig = ticket.strip().partition('.')
+    try:
+        if not hmac.compare_digest(sig.encode('ascii'), _sign(payload).encode('ascii')):
+            metrics.incr('auth.resume_rejected')
+            return False, 'invalid_ticket: bad signature', '', '', '', 0.0
+        data = json.loads(_unb64(payload))
+        uid = data['uid']
+        auth_at = float(data['auth'])
+        expires = float(data['exp'])
+    except (ValueError, KeyError, TypeError):
+        metrics.incr('auth.resume_rejected')
+        return False, 'invalid_ticket: malformed', '', '', '', 0.0
+    if expires <= time.time():
+        reason = 'invalid_ticket: expired'
+    else:
+        state = revocation_state(uid)
+        if state is None:
+            reason = 'invalid_ticket: revocation check failed'
+        elif state.get('missing') or state.get('disabled'):
+            reason = 'invalid_ticket: user disabled'
+        elif auth_at * 1000 < state.get('valid_after_ms', 0):
+            reason = 'invalid_ticket: token revoked'
+        else:
+            metrics.incr('auth.resumed')
+            email = data.get('email') or ''
+            name = data.get('name') or ''
+            return True, email or name or uid, uid, email, name, auth_at
+    metrics.incr('auth.resume_rejected')
+    _log.info('RESUME refused for %s: %s', uid, reason)
+    return False, reason, '', '', '', 0.0
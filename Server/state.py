@@ -5,8 +5,12 @@ clients_lock = threading.Lock()
 socket_to_user = {}  # email/uid/displayName
 socket_to_uid = {}   # socket/uid
 uid_to_socket = {}   # uid/socket
+# Held while a realtime event is pushed to uid_to_socket or queued for an offline user, and
+# while register_client publishes a uid and flushes its PENDING batch, so an event is
+# either in that batch or sent after it
+delivery_lock = threading.Lock()
 
-# File upload (chunked) state
+# File upload (chunked) state: clientMsgId -> upload_spool.UploadSpool
 file_chunks_storage = {}
 file_chunks_lock = threading.Lock()
 
@@ -14,3 +18,7 @@ file_chunks_lock = threading.Lock()
 active_calls = {}
 active_calls_lock = threading.Lock()
 
+
+# Per-connection outbound queues (see outbound.py)
+outbound_queues = {}
+outbound_lock = threading.Lock()
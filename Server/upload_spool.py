@@ -0,0 +1,426 @@
+import base64
+import binascii
+import hashlib
+import io
+import os
+import re
+import tempfile
+import threading
+import time
+
+try:
+    from Server.state import file_chunks_storage, file_chunks_lock
+    from Server.cache import blob_cache
+    from Server.log import get_logger
+    from Server import metrics
+except Exception:
+    from state import file_chunks_storage, file_chunks_lock
+    from cache import blob_cache
+    from log import get_logger
+    import metrics
+
+_log = get_logger('upload')
+
+# Chunk size the client uses when SEND_FILE_START does not say (Client/ui_chat._send_file_chunked)
+DEFAULT_CHUNK_SIZE = 500 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Bytes reserved on disk by chunked uploads that have not finished yet
+MAX_INFLIGHT_PER_USER = int(os.environ.get('CHAT_UPLOAD_MAX_INFLIGHT_PER_USER', str(256 * 1024 * 1024)))
+MAX_INFLIGHT_TOTAL = int(os.environ.get('CHAT_UPLOAD_MAX_INFLIGHT_TOTAL', str(1024 * 1024 * 1024)))
+SPOOL_DIR = os.environ.get('CHAT_UPLOAD_SPOOL_DIR', '').strip() or None
+# How long the chunks of a hashed upload survive a dropped connection
+RESUME_TTL = float(os.environ.get('CHAT_UPLOAD_RESUME_TTL', '900'))
+# How often parked uploads are checked for expiry while any are parked
+SWEEP_INTERVAL = float(os.environ.get('CHAT_UPLOAD_SWEEP_INTERVAL', '60'))
+# Largest file accepted inline (base64 fileContent) by single-shot SEND_FILE
+MAX_INLINE_FILE_SIZE = int(os.environ.get('CHAT_MAX_INLINE_FILE_SIZE', str(8 * 1024 * 1024)))
+
+_SHA256_RE = re.compile(r'[0-9a-f]{64}')
+
+
+class UploadRejected(Exception):
+    """SEND_FILE_START/SEND_FILE_CHUNK refused; str(e) is the error code sent to the client."""
+
+
+def inline_file_size(text: str) -> int:
+    """Decoded size of SEND_FILE's base64 fileContent, checked against MAX_INLINE_FILE_SIZE.
+
+    Only looks at the length and padding, so oversized payloads are refused before decoding.
+    """
+    if len(text) > (MAX_INLINE_FILE_SIZE + 2) // 3 * 4:
+        raise UploadRejected('too_large')
+    if len(text) % 4:
+        raise UploadRejected('decode_error')
+    size = len(text) // 4 * 3 - (2 if text.endswith('==') else 1 if text.endswith('=') else 0)
+    if size > MAX_INLINE_FILE_SIZE:
+        raise UploadRejected('too_large')
+    return size
+
+
+class Base64Reader(io.RawIOBase):
+    """Read-only file object over base64 text that decodes only as much as each read() asks for.
+
+    Lets the Storage upload pull SEND_FILE's fileContent without materialising the decoded
+    file in a temp file first. Malformed input raises UploadRejected('decode_error').
+    """
+
+    def __init__(self, text: str):
+        super().__init__()
+        self.size = inline_file_size(text)
+        self._text = text
+        self._pos = 0          # next base64 character
+        self._offset = 0       # decoded bytes handed out
+        self._pending = b''    # decoded but not yet read
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._offset
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self._offset
+        need = size - len(self._pending)
+        if need > 0 and self._pos < len(self._text):
+            end = self._pos + (need + 2) // 3 * 4
+            try:
+                self._pending += base64.b64decode(self._text[self._pos:end], validate=True)
+            except (binascii.Error, ValueError):
+                raise UploadRejected('decode_error')
+            self._pos = end
+        data, self._pending = self._pending[:size], self._pending[size:]
+        self._offset += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class UploadSpool:
+    """One chunked upload, written straight into a pre-sized temp file.
+
+    Chunk i lands at offset i * chunk_size as soon as it arrives, so chunks may come in
+    any order and memory use is one decoded chunk instead of the whole file. Which chunks
+    are present is a one-byte-per-chunk bitmap.
+
+    When `blob` is given the same content is already in Storage for this conversation:
+    there is no spool file and every chunk counts as received.
+    """
+
+    def __init__(self, client_msg_id: str, conn, uid: str, file_name: str, file_size: int,
+                 chunk_size: int, to_uid: str = '', group_id: str = '', conversation_id: str = '',
+                 sha256: str = '', blob: dict | None = None):
+        self.client_msg_id = client_msg_id
+        self.conn = conn
+        self.uid = uid
+        self.file_name = file_name
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.to_uid = to_uid
+        self.group_id = group_id
+        self.conversation_id = conversation_id
+        self.sha256 = sha256
+        self.blob = blob
+        self.num_chunks = (file_size + chunk_size - 1) // chunk_size
+        self.closed = False
+        self.parked_at = 0.0
+        self._lock = threading.Lock()
+        if blob is not None:
+            self.received = bytearray(b'\x01') * self.num_chunks
+            self.missing = 0
+            self.reserved = 0
+            self.path = None
+            self._file = None
+            return
+        self.received = bytearray(self.num_chunks)
+        self.missing = self.num_chunks
+        self.reserved = file_size
+        fd, self.path = tempfile.mkstemp(suffix=os.path.splitext(file_name)[1], dir=SPOOL_DIR)
+        try:
+            os.ftruncate(fd, file_size)
+        except Exception:
+            os.close(fd)
+            os.remove(self.path)
+            raise
+        self._file = os.fdopen(fd, 'r+b')
+
+    def expected_size(self, index: int) -> int:
+        if index == self.num_chunks - 1:
+            return self.file_size - index * self.chunk_size
+        return self.chunk_size
+
+    def write_chunk(self, index: int, data: bytes) -> bool:
+        """Store chunk `index`; returns False if it had already been received."""
+        if not 0 <= index < self.num_chunks:
+            raise UploadRejected('bad_chunk_index')
+        if len(data) != self.expected_size(index):
+            raise UploadRejected('bad_chunk_size')
+        with self._lock:
+            if self.closed:
+                raise UploadRejected('no_start_command')
+            if self.received[index]:
+                return False
+            self._file.seek(index * self.chunk_size)
+            self._file.write(data)
+            self.received[index] = 1
+            self.missing -= 1
+        return True
+
+    def complete(self) -> bool:
+        return self.missing == 0
+
+    def have_chunks(self) -> list[int]:
+        return [i for i, have in enumerate(self.received) if have]
+
+    def missing_chunks(self, limit: int = 1000) -> list[int]:
+        out = []
+        for i, have in enumerate(self.received):
+            if not have:
+                out.append(i)
+                if len(out) >= limit:
+                    break
+        return out
+
+    def seal(self) -> str:
+        """Flush the spool file and return its path for the Storage upload."""
+        with self._lock:
+            self._file.flush()
+        return self.path
+
+    def verify(self) -> bool:
+        """True when no hash was announced or the spooled bytes match it."""
+        if not self.sha256:
+            return True
+        digest = hashlib.sha256()
+        with open(self.seal(), 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest() == self.sha256
+
+    def discard(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self._file is not None:
+                try:
+                    self._file.close()
+                except Exception:
+                    pass
+        if self.path:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        _release(self)
+
+
+_inflight_total = 0
+_inflight_by_uid: dict[str, int] = {}
+# (uid, conversation_id, sha256) -> spool whose connection dropped before SEND_FILE_END
+_parked: dict[tuple, UploadSpool] = {}
+_sweeper: threading.Thread | None = None
+
+
+def _reserve(uid: str, nbytes: int):
+    global _inflight_total
+    with file_chunks_lock:
+        if (_inflight_by_uid.get(uid, 0) + nbytes > MAX_INFLIGHT_PER_USER
+                or _inflight_total + nbytes > MAX_INFLIGHT_TOTAL):
+            metrics.incr('upload.rejected_busy')
+            raise UploadRejected('upload_busy')
+        _inflight_total += nbytes
+        _inflight_by_uid[uid] = _inflight_by_uid.get(uid, 0) + nbytes
+
+
+def _unreserve(uid: str, nbytes: int):
+    """Caller holds file_chunks_lock."""
+    global _inflight_total
+    _inflight_total -= nbytes
+    left = _inflight_by_uid.get(uid, 0) - nbytes
+    if left > 0:
+        _inflight_by_uid[uid] = left
+    else:
+        _inflight_by_uid.pop(uid, None)
+
+
+def _release(spool: UploadSpool):
+    with file_chunks_lock:
+        if file_chunks_storage.get(spool.client_msg_id) is spool:
+            del file_chunks_storage[spool.client_msg_id]
+        key = (spool.uid, spool.conversation_id, spool.sha256)
+        if _parked.get(key) is spool:
+            del _parked[key]
+        _unreserve(spool.uid, spool.reserved)
+
+
+def _expire_parked():
+    now = time.monotonic()
+    with file_chunks_lock:
+        expired = [s for s in _parked.values() if now - s.parked_at > RESUME_TTL]
+    for spool in expired:
+        spool.discard()
+
+
+def _start_sweeper():
+    """Caller holds file_chunks_lock."""
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep, name='upload-sweeper', daemon=True)
+        _sweeper.start()
+
+
+def _sweep():
+    # Expired spools release their disk and byte reservation even if no upload starts;
+    # the thread exits once nothing is parked and drop_uploads starts it again
+    global _sweeper
+    while True:
+        time.sleep(max(1.0, min(SWEEP_INTERVAL, RESUME_TTL)))
+        _expire_parked()
+        with file_chunks_lock:
+            if not _parked:
+                _sweeper = None
+                return
+
+
+def _same_file(spool: UploadSpool, file_size: int, chunk_size: int, sha256: str) -> bool:
+    return (spool.sha256 == sha256 and spool.file_size == file_size
+            and spool.chunk_size == chunk_size and not spool.closed)
+
+
+def open_upload(client_msg_id: str, conn, uid: str, file_name: str, file_size: int,
+                chunk_size: int = DEFAULT_CHUNK_SIZE, to_uid: str = '', group_id: str = '',
+                conversation_id: str = '', sha256: str = '') -> UploadSpool:
+    """Start (or resume) a chunked upload.
+
+    With a sha256 the upload is resumable: an unfinished spool of the same user, conversation
+    and content - left by a dropped connection or an earlier SEND_FILE_START with the same
+    clientMsgId - is picked up again, and content already uploaded to this conversation is
+    not stored twice. Otherwise file_size bytes are reserved against the per-user and global
+    caps and a new spool file is created.
+    """
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+        raise UploadRejected('bad_chunk_size')
+    sha256 = (sha256 or '').lower()
+    if sha256 and not _SHA256_RE.fullmatch(sha256):
+        raise UploadRejected('bad_hash')
+    if file_size > MAX_INFLIGHT_PER_USER or file_size > MAX_INFLIGHT_TOTAL:
+        raise UploadRejected('too_large')
+    _expire_parked()
+
+    with file_chunks_lock:
+        previous = file_chunks_storage.get(client_msg_id)
+    if previous is not None:
+        if previous.conn is not conn:
+            raise UploadRejected('duplicate_client_msg_id')
+        if sha256 and _same_file(previous, file_size, chunk_size, sha256):
+            return previous
+        # Client restarted the same upload with different content
+        previous.discard()
+
+    if sha256:
+        blob = blob_cache.get(f'{conversation_id}:{sha256}')
+        if blob is not None:
+            metrics.incr('upload.dedup_hits')
+            spool = UploadSpool(client_msg_id, conn, uid, file_name, file_size, chunk_size,
+                                to_uid, group_id, conversation_id, sha256, blob=blob)
+            with file_chunks_lock:
+                file_chunks_storage[client_msg_id] = spool
+            return spool
+        with file_chunks_lock:
+            parked = _parked.pop((uid, conversation_id, sha256), None)
+        if parked is not None:
+            if _same_file(parked, file_size, chunk_size, sha256):
+                metrics.incr('upload.resumed')
+                parked.conn = conn
+                parked.client_msg_id = client_msg_id
+                parked.file_name = file_name
+                with file_chunks_lock:
+                    file_chunks_storage[client_msg_id] = parked
+                return parked
+            parked.discard()
+
+    _reserve(uid, file_size)
+    try:
+        spool = UploadSpool(client_msg_id, conn, uid, file_name, file_size, chunk_size,
+                            to_uid, group_id, conversation_id, sha256)
+    except Exception:
+        with file_chunks_lock:
+            _unreserve(uid, file_size)
+        raise
+    with file_chunks_lock:
+        file_chunks_storage[client_msg_id] = spool
+    return spool
+
+
+def get_upload(client_msg_id: str, conn) -> UploadSpool | None:
+    """The open upload with this id, if it belongs to conn."""
+    with file_chunks_lock:
+        spool = file_chunks_storage.get(client_msg_id)
+    if spool is None or spool.conn is not conn:
+        return None
+    return spool
+
+
+def take_upload(client_msg_id: str, conn) -> UploadSpool | None:
+    """Like get_upload, but no further chunks are accepted under this id afterwards.
+
+    The byte reservation is kept until the caller discard()s the spool.
+    """
+    with file_chunks_lock:
+        spool = file_chunks_storage.get(client_msg_id)
+        if spool is None or spool.conn is not conn:
+            return None
+        del file_chunks_storage[client_msg_id]
+    return spool
+
+
+def remember_blob(conversation_id: str, sha256: str, record: dict):
+    """Let later uploads of the same content to this conversation reuse record's Storage file."""
+    if sha256 and record.get('fileURL'):
+        blob_cache.set(f'{conversation_id}:{sha256}',
+                       {'fileURL': record['fileURL'], 'fileType': record.get('fileType') or 'application'})
+
+
+def drop_uploads(conn):
+    """Connection went away: park resumable uploads, discard the rest."""
+    _expire_parked()
+    with file_chunks_lock:
+        spools = [s for s in file_chunks_storage.values() if s.conn is conn]
+    for spool in spools:
+        resumable = spool.sha256 and spool.blob is None and spool.missing < spool.num_chunks
+        if not resumable:
+            _log.info('dropping unfinished upload %s (%d/%d chunks)', spool.client_msg_id,
+                      spool.num_chunks - spool.missing, spool.num_chunks)
+            spool.discard()
+            continue
+        key = (spool.uid, spool.conversation_id, spool.sha256)
+        with file_chunks_lock:
+            if file_chunks_storage.get(spool.client_msg_id) is spool:
+                del file_chunks_storage[spool.client_msg_id]
+            replaced = _parked.get(key)
+            spool.conn = None
+            spool.parked_at = time.monotonic()
+            _parked[key] = spool
+            _start_sweeper()
+        if replaced is not None and replaced is not spool:
+            replaced.discard()
+        _log.info('parked upload %s for resume (%d/%d chunks)', spool.client_msg_id,
+                  spool.num_chunks - spool.missing, spool.num_chunks)
+
+
+def stats() -> dict:
+    _expire_parked()
+    with file_chunks_lock:
+        return {
+            'active': len(file_chunks_storage),
+            'parked': len(_parked),
+            'inflight_bytes': _inflight_total,
+            'users': len(_inflight_by_uid),
+        }
+
+
+metrics.register_gauge('uploads', stats)
@@ -0,0 +1,115 @@
+"""Benchmark: AUTH handshakes of a reconnect storm against a simulated Firebase Auth.
+
+Every get_user()/get_users() call costs --latency-ms; verifying a token signature costs
+--verify-ms of CPU. Compares the old fb_auth.verify_id_token(check_revoked=True) per
+handshake with Server.firebase_admin_utils.verify_id_token (token cache + batched,
+bounded revocation lookups), for a cold start and for a second storm within
+CHAT_AUTH_REVOCATION_RECHECK.
+
+    python benchmarks/bench_auth.py --clients 10000 --threads 64 --latency-ms 50
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import Server.firebase_admin_utils as fau
+from Server.cache import token_cache, revocation_cache
+
+
+class FakeUser:
+    def __init__(self, uid):
+        self.uid = uid
+        self.tokens_valid_after_timestamp = 0
+        self.disabled = False
+
+
+class FakeGetUsersResult:
+    def __init__(self, users):
+        self.users = users
+
+
+class FakeAuth:
+    """The parts of firebase_admin.auth that token verification uses."""
+
+    def __init__(self, latency: float, verify_cost: float):
+        self.latency = latency
+        self.verify_cost = verify_cost
+        self.calls = 0
+        self.max_concurrent = 0
+        self._concurrent = 0
+        self._lock = threading.Lock()
+
+    UidIdentifier = staticmethod(lambda uid: uid)
+
+    def _round_trip(self):
+        with self._lock:
+            self.calls += 1
+            self._concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self._concurrent)
+        time.sleep(self.latency)
+        with self._lock:
+            self._concurrent -= 1
+
+    def verify_id_token(self, token, check_revoked=False, clock_skew_seconds=0):
+        end = time.perf_counter() + self.verify_cost
+        while time.perf_counter() < end:
+            pass
+        decoded = {'uid': token, 'email': f'{token}@example.com', 'iat': int(time.time()) - 10,
+                   'exp': int(time.time()) + 3600}
+        if check_revoked:
+            self.get_user(token)
+        return decoded
+
+    def get_user(self, uid):
+        self._round_trip()
+        return FakeUser(uid)
+
+    def get_users(self, identifiers):
+        self._round_trip()
+        return FakeGetUsersResult([FakeUser(uid) for uid in identifiers])
+
+
+def legacy_verify(token):
+    decoded = fau.fb_auth.verify_id_token(token, check_revoked=True, clock_skew_seconds=60)
+    return True, decoded['email'], decoded['uid'], decoded['email'], ''
+
+
+def storm(name, fn, tokens, threads, fake):
+    fake.calls = fake.max_concurrent = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(fn, tokens))
+    elapsed = time.perf_counter() - start
+    assert all(r[0] for r in results), name
+    print(f"{name:<28} {elapsed:8.2f} s  {len(tokens) / elapsed:9.0f} auth/s  "
+          f"{fake.calls:6d} Auth calls  (max {fake.max_concurrent} at once)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=64, help='handshakes verified at the same time')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Auth API round trip')
+    parser.add_argument('--verify-ms', type=float, default=0.1, help='CPU cost of one signature check')
+    args = parser.parse_args()
+
+    fake = FakeAuth(args.latency_ms / 1000.0, args.verify_ms / 1000.0)
+    fau.fb_auth = fake
+    fau._FIREBASE_AVAILABLE = True
+    fau._firebase_initialized = True
+    tokens = [f'user{i}' for i in range(args.clients)]
+
+    storm('check_revoked=True', legacy_verify, tokens, args.threads, fake)
+    token_cache.clear()
+    revocation_cache.clear()
+    storm('cached+batched, cold', fau.verify_id_token, tokens, args.threads, fake)
+    storm('cached+batched, reconnect', fau.verify_id_token, tokens, args.threads, fake)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Micro-benchmark: line framing of multi-megabyte lines fed in small recv() pieces.
+
+Compares the old `buffer += chunk; buffer.find(b"\\n"); buffer = buffer[nl+1:]` loop
+with lib.framing.LineFramer, then the cost of moving file chunks as base64 inside
+`CMD {json}` lines versus binary FRAME_DATA frames (bytes on the wire and decode time).
+
+    python benchmarks/bench_framing.py --line-mb 4 --chunk 4096
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.framing import LineFramer, FrameDecoder, encode_data_frame, decode_data_frame
+
+
+def legacy_frame(chunks):
+    lines = 0
+    buffer = b''
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            nl_index = buffer.find(b"\n")
+            if nl_index == -1:
+                break
+            line = buffer[:nl_index]
+            buffer = buffer[nl_index + 1:]
+            lines += 1
+    return lines
+
+
+def framer_frame(chunks):
+    lines = 0
+    framer = LineFramer(max_line=1 << 30)
+    for chunk in chunks:
+        lines += len(framer.feed(chunk))
+    return lines
+
+
+def encode_lines(file_chunks) -> bytes:
+    return b''.join(
+        b'CMD ' + json.dumps({'type': 'SEND_FILE_CHUNK', 'clientMsgId': 'm', 'chunkIndex': i,
+                              'chunkData': base64.b64encode(c).decode('ascii')}).encode('utf-8') + b'\n'
+        for i, c in enumerate(file_chunks))
+
+
+def decode_lines(pieces) -> int:
+    received = 0
+    framer = LineFramer(max_line=1 << 30)
+    for piece in pieces:
+        for line in framer.feed(piece):
+            received += len(base64.b64decode(json.loads(line[4:])['chunkData']))
+    return received
+
+
+def encode_frames(file_chunks) -> bytes:
+    return b''.join(encode_data_frame({'type': 'SEND_FILE_CHUNK', 'clientMsgId': 'm', 'chunkIndex': i}, c)
+                    for i, c in enumerate(file_chunks))
+
+
+def decode_frames(pieces) -> int:
+    received = 0
+    decoder = FrameDecoder(max_line=1 << 30)
+    for piece in pieces:
+        for _, payload in decoder.feed(piece):
+            received += len(decode_data_frame(payload)[1])
+    return received
+
+
+def _chunks(payload: bytes, size: int):
+    return [payload[i:i + size] for i in range(0, len(payload), size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--line-mb', type=float, default=4.0, help='size of each line in MB')
+    parser.add_argument('--lines', type=int, default=3)
+    parser.add_argument('--chunk', type=int, default=4096, help='bytes per simulated recv()')
+    parser.add_argument('--file-chunks', type=int, default=40, help='file chunks for the transport comparison')
+    parser.add_argument('--file-chunk-kb', type=int, default=500)
+    args = parser.parse_args()
+
+    line = b'CMD ' + b'A' * int(args.line_mb * 1024 * 1024) + b'\n'
+    chunks = _chunks(line * args.lines, args.chunk)
+    total_mb = len(line) * args.lines / (1024 * 1024)
+
+    for name, fn in (('legacy bytes +=', legacy_frame), ('LineFramer', framer_frame)):
+        start = time.perf_counter()
+        n = fn(chunks)
+        elapsed = time.perf_counter() - start
+        assert n == args.lines, (name, n)
+        print(f"{name:<16} {elapsed * 1000:10.1f} ms  {total_mb / elapsed:10.1f} MB/s")
+
+    file_chunks = [os.urandom(args.file_chunk_kb * 1024) for _ in range(args.file_chunks)]
+    file_mb = sum(map(len, file_chunks)) / (1024 * 1024)
+    for name, encode, decode in (('base64 CMD line', encode_lines, decode_lines),
+                                 ('binary frame', encode_frames, decode_frames)):
+        wire = encode(file_chunks)
+        pieces = _chunks(wire, 65536)
+        start = time.perf_counter()
+        n = decode(pieces)
+        elapsed = time.perf_counter() - start
+        assert n == sum(map(len, file_chunks)), (name, n)
+        print(f"{name:<16} {elapsed * 1000:10.1f} ms  {file_mb / elapsed:10.1f} MB/s  "
+              f"wire {len(wire) / (1024 * 1024):.1f} MB for {file_mb:.1f} MB of file")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""Load benchmark: threaded vs asyncio connection engine.
+
+Starts the server in a subprocess (Firebase token check replaced by an accept-all stub),
+opens N authenticated connections and reports connections/sec plus the server's RSS
+growth per idle connection.
+
+    python benchmarks/bench_server.py --connections 1000 --concurrency 100
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def _serve(mode: str, port: int, backlog: int):
+    sys.path.insert(0, PROJECT_ROOT)
+    import Server.firebase_admin_utils as fau
+
+    def _fake_verify(token):
+        return True, token, token, '', ''
+
+    fau.verify_id_token = _fake_verify
+    fau.ensure_user_profile = lambda *a, **kw: None
+    from Server.main import main
+    main(['--mode', mode, '--host', '127.0.0.1', '--port', str(port), '--backlog', str(backlog)])
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f'/proc/{pid}/status', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _wait_port(port: int, timeout: float = 10.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('server did not start')
+
+
+async def _open_clients(port: int, count: int, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+    conns = []
+
+    async def one(i):
+        async with sem:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f"AUTH bench-{i}\n".encode())
+            await writer.drain()
+            line = await reader.readline()
+            if not line.startswith(b'AUTH_OK'):
+                raise RuntimeError(f'auth failed: {line!r}')
+            conns.append((reader, writer))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.perf_counter() - start
+    return conns, elapsed
+
+
+async def _drain_forever(conns):
+    # Keep reading join/leave broadcasts so the server never blocks on a full socket buffer
+    async def drain(reader):
+        try:
+            while await reader.read(65536):
+                pass
+        except Exception:
+            pass
+    return [asyncio.ensure_future(drain(r)) for r, _ in conns]
+
+
+async def _run_mode(mode: str, port: int, count: int, concurrency: int, backlog: int):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve', mode, '--port', str(port), '--backlog', str(backlog)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_port(port)
+        await asyncio.sleep(0.5)
+        base_rss = _rss_kb(proc.pid)
+        conns, elapsed = await _open_clients(port, count, concurrency)
+        drains = await _drain_forever(conns)
+        await asyncio.sleep(1.0)
+        loaded_rss = _rss_kb(proc.pid)
+        for _, w in conns:
+            w.close()
+        for d in drains:
+            d.cancel()
+        return {
+            'mode': mode,
+            'connections': count,
+            'conn_per_sec': count / elapsed if elapsed else 0.0,
+            'rss_base_kb': base_rss,
+            'rss_loaded_kb': loaded_rss,
+            'kb_per_conn': (loaded_rss - base_rss) / count if count else 0.0,
+        }
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--serve', choices=('threaded', 'asyncio'), help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--backlog', type=int, default=1024)
+    parser.add_argument('--connections', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--modes', default='threaded,asyncio')
+    args = parser.parse_args()
+
+    if args.serve:
+        _serve(args.serve, args.port, args.backlog)
+        return
+
+    print(f"{'mode':<10} {'conns':>6} {'conn/s':>10} {'rss base':>10} {'rss loaded':>11} {'KB/conn':>8}")
+    for i, mode in enumerate(args.modes.split(',')):
+        r = asyncio.run(_run_mode(mode, args.port + i, args.connections, args.concurrency, args.backlog))
+        print(f"{r['mode']:<10} {r['connections']:>6} {r['conn_per_sec']:>10.1f} "
+              f"{r['rss_base_kb']:>9}K {r['rss_loaded_kb']:>10}K {r['kb_per_conn']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
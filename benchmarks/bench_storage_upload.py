@@ -0,0 +1,97 @@
+"""Benchmark: Storage upload of one file against lib.fake_storage, offline.
+
+Compares the old `upload_from_filename()` + `make_public()` with
+lib.resumable_upload.upload_blob (ACL set at creation, resumable chunks above the
+threshold): requests, bytes sent and wall time, for a clean upload, a connection drop
+part-way through, and an app restart part-way through (session URI from the session file).
+
+    python benchmarks/bench_storage_upload.py --file-mb 64 --latency-ms 80 --mbps 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.fake_storage import FakeBucket
+from lib.resumable_upload import SessionStore, upload_blob
+
+
+class AppClosed(Exception):
+    pass
+
+
+def legacy_upload(bucket, blob_path, file_path, content_type, sessions, chunk_size, progress=None):
+    blob = bucket.blob(blob_path)
+    blob.upload_from_filename(file_path, content_type=content_type)
+    blob.make_public()
+    return blob.public_url
+
+
+def resumable(bucket, blob_path, file_path, content_type, sessions, chunk_size, progress=None):
+    return upload_blob(bucket, blob_path, file_path, content_type, chunk_size=chunk_size, sessions=sessions,
+                       progress=progress)
+
+
+def run(name, fn, file_path, size, args, scenario):
+    bucket = FakeBucket(latency=args.latency_ms / 1000.0, bandwidth=args.mbps * 1024 * 1024 / 8)
+    session_file = os.path.join(tempfile.mkdtemp(), 'sessions.json')
+    blob_path = 'chat_files/bench/file.bin'
+    content_type = 'application/octet-stream'
+    cut = int(size * 0.7)
+    chunk_size = int(args.chunk_mb * 1024 * 1024)
+    start = time.perf_counter()
+    if scenario == 'drop':
+        bucket.fail_after = cut
+    if scenario == 'drop' and fn is legacy_upload:
+        # The SDK call fails as a whole; the caller uploads again from the start
+        try:
+            fn(bucket, blob_path, file_path, content_type, SessionStore(session_file), chunk_size)
+        except ConnectionResetError:
+            pass
+    if scenario == 'restart':
+        def close_app(sent, total):
+            if sent >= cut:
+                raise AppClosed()
+        try:
+            if fn is legacy_upload:
+                bucket.fail_after = cut
+                fn(bucket, blob_path, file_path, content_type, SessionStore(session_file), chunk_size)
+            else:
+                fn(bucket, blob_path, file_path, content_type, SessionStore(session_file),
+                   chunk_size, progress=close_app)
+        except (AppClosed, ConnectionResetError):
+            pass
+    # A new SessionStore reads the session file like a freshly started client
+    fn(bucket, blob_path, file_path, content_type, SessionStore(session_file), chunk_size)
+    elapsed = time.perf_counter() - start
+    stored = bucket.objects[blob_path]
+    assert len(stored['data']) == size and stored['acl'] == 'publicRead', name
+    print(f"{scenario:<8} {name:<22} {elapsed:8.2f} s  {bucket.requests:5d} requests  "
+          f"{bucket.bytes_received / (1024 * 1024):8.1f} MB sent")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-mb', type=float, default=64.0)
+    parser.add_argument('--chunk-mb', type=float, default=8.0, help='resumable chunk size (multiple of 0.25)')
+    parser.add_argument('--latency-ms', type=float, default=80.0, help='round trip per request')
+    parser.add_argument('--mbps', type=float, default=200.0, help='upload bandwidth in Mbit/s')
+    args = parser.parse_args()
+
+    size = int(args.file_mb * 1024 * 1024)
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(os.urandom(size))
+        file_path = f.name
+    try:
+        for scenario in ('clean', 'drop', 'restart'):
+            for name, fn in (('upload + make_public', legacy_upload), ('resumable upload_blob', resumable)):
+                run(name, fn, file_path, size, args, scenario)
+    finally:
+        os.remove(file_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""In-process stand-in for a Cloud Storage bucket, for benchmarks and offline tests.
+
+Implements the parts lib/upload.py, Client/client_upload.py and lib/resumable_upload.py use:
+Bucket.blob(), Blob.upload_from_filename(), Blob.upload_from_file(), Blob.make_public(),
+Blob.create_resumable_upload_session(), Blob.public_url, and an `http` object speaking the
+resumable upload protocol (PUT with Content-Range, 308 + Range while incomplete).
+
+Every request costs `latency` seconds plus len(body) / `bandwidth`; `fail_after` makes the
+connection drop once that many body bytes have been received, to exercise resume.
+"""
+import threading
+import time
+import uuid
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers: dict | None = None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakeHTTP:
+    """put(url, data, headers, timeout) against the bucket's resumable sessions."""
+
+    def __init__(self, bucket: 'FakeBucket'):
+        self.bucket = bucket
+
+    def put(self, url, data=b'', headers=None, timeout=None):
+        bucket = self.bucket
+        bucket._request(len(data))
+        with bucket._lock:
+            session = bucket.sessions.get(url)
+        if session is None:
+            return FakeResponse(404)
+        content_range = (headers or {}).get('Content-Range', '')
+        spec, total = content_range[len('bytes '):].split('/')
+        total = int(total)
+        if spec != '*':
+            start, end = (int(x) for x in spec.split('-'))
+            if start != len(session['data']) or end - start + 1 != len(data):
+                return self._status(session, total)
+            session['data'] += data
+            if len(session['data']) == total:
+                bucket._store(session['name'], bytes(session['data']), session['content_type'], session['acl'])
+                with bucket._lock:
+                    bucket.sessions.pop(url, None)
+                return FakeResponse(200)
+        return self._status(session, total)
+
+    @staticmethod
+    def _status(session, total):
+        have = len(session['data'])
+        if have == total:
+            return FakeResponse(200)
+        return FakeResponse(308, {'Range': f'bytes=0-{have - 1}'} if have else {})
+
+
+class FakeBlob:
+    def __init__(self, bucket: 'FakeBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+
+    @property
+    def public_url(self) -> str:
+        return f'https://storage.fake/{self.bucket.name}/{self.name}'
+
+    def upload_from_filename(self, filename, content_type=None, predefined_acl=None, **kwargs):
+        with open(filename, 'rb') as f:
+            self.upload_from_file(f, content_type=content_type, predefined_acl=predefined_acl)
+
+    def upload_from_file(self, file_obj, content_type=None, predefined_acl=None, size=None, **kwargs):
+        data = file_obj.read() if size is None else file_obj.read(size)
+        self.bucket._request(len(data))
+        self.bucket._store(self.name, data, content_type, predefined_acl)
+
+    def make_public(self, **kwargs):
+        self.bucket._request(0)
+        with self.bucket._lock:
+            self.bucket.objects[self.name]['acl'] = 'publicRead'
+
+    def create_resumable_upload_session(self, content_type=None, size=None, predefined_acl=None, **kwargs):
+        self.bucket._request(0)
+        uri = f'https://storage.fake/upload/{uuid.uuid4().hex}'
+        with self.bucket._lock:
+            self.bucket.sessions[uri] = {'name': self.name, 'data': bytearray(), 'content_type': content_type,
+                                         'acl': predefined_acl}
+        return uri
+
+
+class FakeBucket:
+    def __init__(self, name: str = 'fake-bucket', latency: float = 0.0, bandwidth: float = 0.0,
+                 fail_after: int | None = None):
+        self.name = name
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fail_after = fail_after
+        self.objects: dict[str, dict] = {}
+        self.sessions: dict[str, dict] = {}
+        self.requests = 0
+        self.bytes_received = 0
+        self.http = FakeHTTP(self)
+        self._lock = threading.Lock()
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def _request(self, nbytes: int):
+        dropped = False
+        with self._lock:
+            self.requests += 1
+            if self.fail_after is not None and self.bytes_received + nbytes > self.fail_after:
+                # The part sent before the drop is counted (and paid for) but not kept
+                nbytes = self.fail_after - self.bytes_received
+                self.fail_after = None
+                dropped = True
+            self.bytes_received += nbytes
+        delay = self.latency + (nbytes / self.bandwidth if self.bandwidth else 0.0)
+        if delay:
+            time.sleep(delay)
+        if dropped:
+            raise ConnectionResetError('fake storage dropped the connection')
+
+    def _store(self, name, data, content_type, acl):
+        with self._lock:
+            self.objects[name] = {'data': data, 'content_type': content_type, 'acl': acl}
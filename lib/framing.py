@@ -0,0 +1,163 @@
+import json
+import os
+import struct
+
+# Largest accepted protocol line. A 500 KB file chunk is ~670 KB once base64'd into a CMD line.
+MAX_LINE = int(os.environ.get('CHAT_MAX_LINE', str(16 * 1024 * 1024)))
+MIN_RECV = 4096
+MAX_RECV = 1024 * 1024
+
+# Binary frames (client -> server, after BINARY_UPGRADE / BINARY_OK):
+#   1 byte type | 4 byte big-endian payload length | payload
+# FRAME_TEXT carries one protocol line ("CMD {...}" or chat text) without the newline.
+# FRAME_DATA carries a 2 byte header length, a JSON command header and raw bytes
+# (file chunks, instead of base64 inside JSON).
+FRAME_TEXT = 1
+FRAME_DATA = 2
+FRAME_HEADER = struct.Struct('>BI')
+DATA_HEADER = struct.Struct('>H')
+# Line the client sends once it got BINARY_OK; every byte after it is frames
+UPGRADE_LINE = b'CMD {"type":"BINARY_FRAMES"}'
+
+
+class LineTooLongError(ValueError):
+    """Raised when a peer sends more than max_line bytes without a newline."""
+
+
+class LineFramer:
+    """Split a TCP byte stream into newline-terminated lines.
+
+    Received bytes are appended to one growable bytearray; a read offset marks where the
+    next line starts and a scan offset remembers how far we already looked for b"\\n", so
+    every byte is scanned once no matter how many recv() calls a long line takes. The
+    consumed prefix is only compacted once it is at least half the buffer, which keeps
+    compaction amortised O(1) per byte.
+
+    Used by both Server/handler.handle_client and Client/ui_chat.NetworkWorker.
+    """
+
+    def __init__(self, max_line: int = MAX_LINE, min_recv: int = MIN_RECV, max_recv: int = MAX_RECV):
+        self.max_line = max_line
+        self.min_recv = min_recv
+        self.max_recv = max_recv
+        self.recv_size = min_recv
+        self._buf = bytearray()
+        self._start = 0
+        self._scan = 0
+        self._scratch = memoryview(bytearray(min_recv))
+        # feed() stops after this line and leaves the rest buffered (see take_pending)
+        self.stop_line: bytes | None = None
+        # feed() returns at most one line and leaves the rest buffered, e.g. while the
+        # AUTH line is read with a small max_line; feed(b'') splits the rest later
+        self.one_line = False
+
+    def pending(self) -> int:
+        """Number of buffered bytes that do not form a complete line yet."""
+        return len(self._buf) - self._start
+
+    def feed(self, data) -> list[bytes]:
+        """Append received bytes and return every complete line (without the newline)."""
+        buf = self._buf
+        buf += data
+        lines = []
+        while True:
+            nl = buf.find(b"\n", self._scan)
+            if nl == -1:
+                self._scan = len(buf)
+                if self._scan - self._start > self.max_line:
+                    raise LineTooLongError(f'line exceeds {self.max_line} bytes')
+                break
+            if nl - self._start > self.max_line:
+                raise LineTooLongError(f'line exceeds {self.max_line} bytes')
+            line = bytes(buf[self._start:nl])
+            lines.append(line)
+            self._start = self._scan = nl + 1
+            if line == self.stop_line or self.one_line:
+                break
+        if self._start == len(buf):
+            buf.clear()
+            self._start = self._scan = 0
+        elif self._start and self._start * 2 >= len(buf):
+            del buf[:self._start]
+            self._scan -= self._start
+            self._start = 0
+        return lines
+
+    def take_pending(self) -> bytes:
+        """Remove and return the buffered bytes that were not returned as lines."""
+        data = bytes(self._buf[self._start:])
+        self._buf.clear()
+        self._start = self._scan = 0
+        return data
+
+    def recv_from(self, sock) -> list[bytes] | None:
+        """recv() once from sock and return the completed lines, or None on EOF.
+
+        The read size doubles while reads keep filling it (bulk transfer, e.g. file chunks)
+        and shrinks back when traffic is small chat lines.
+        """
+        size = self.recv_size
+        if len(self._scratch) != size:
+            self._scratch = memoryview(bytearray(size))
+        n = sock.recv_into(self._scratch, size)
+        if not n:
+            return None
+        lines = self.feed(self._scratch[:n])
+        if n == size and size < self.max_recv:
+            self.recv_size = min(size * 2, self.max_recv)
+        elif n < size // 4 and size > self.min_recv:
+            self.recv_size = max(size // 2, self.min_recv)
+        return lines
+
+
+def encode_frame(frame_type: int, payload: bytes) -> bytes:
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_data_frame(header: dict, data: bytes) -> bytes:
+    """FRAME_DATA with a JSON command header (e.g. SEND_FILE_CHUNK) and raw data."""
+    head = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    return b''.join((FRAME_HEADER.pack(FRAME_DATA, DATA_HEADER.size + len(head) + len(data)),
+                     DATA_HEADER.pack(len(head)), head, data))
+
+
+def decode_data_frame(payload: bytes) -> tuple[dict, memoryview]:
+    """Split a FRAME_DATA payload into its JSON header and a view of the raw data."""
+    (head_len,) = DATA_HEADER.unpack_from(payload)
+    start = DATA_HEADER.size + head_len
+    if start > len(payload):
+        raise ValueError('data frame header exceeds frame')
+    header = json.loads(bytes(payload[DATA_HEADER.size:start]))
+    if not isinstance(header, dict):
+        raise ValueError('data frame header is not an object')
+    return header, memoryview(payload)[start:]
+
+
+class FrameDecoder(LineFramer):
+    """Split a byte stream into (frame_type, payload) tuples.
+
+    Same buffer management and adaptive recv size as LineFramer; max_line bounds the
+    payload of a single frame.
+    """
+
+    def feed(self, data) -> list[tuple[int, bytes]]:
+        buf = self._buf
+        buf += data
+        frames = []
+        header_size = FRAME_HEADER.size
+        while len(buf) - self._start >= header_size:
+            frame_type, length = FRAME_HEADER.unpack_from(buf, self._start)
+            if length > self.max_line:
+                raise LineTooLongError(f'frame exceeds {self.max_line} bytes')
+            end = self._start + header_size + length
+            if end > len(buf):
+                break
+            frames.append((frame_type, bytes(buf[self._start + header_size:end])))
+            self._start = end
+        if self._start == len(buf):
+            buf.clear()
+            self._start = 0
+        elif self._start and self._start * 2 >= len(buf):
+            del buf[:self._start]
+            self._start = 0
+        return frames
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Files up to this size go up in one request (multipart upload); larger ones use a
+# resumable session so an interrupted upload continues where it stopped.
+RESUMABLE_THRESHOLD = int(os.environ.get('CHAT_RESUMABLE_THRESHOLD', str(8 * 1024 * 1024)))
+# Resumable chunks must be a multiple of 256 KiB (except the last one)
+_CHUNK_QUANTUM = 256 * 1024
+CHUNK_SIZE = max(_CHUNK_QUANTUM, int(os.environ.get('CHAT_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+                 // _CHUNK_QUANTUM * _CHUNK_QUANTUM)
+# Set when the object is created, so there is no separate make_public() request
+PREDEFINED_ACL = 'publicRead'
+SESSION_FILE = os.environ.get('CHAT_UPLOAD_SESSION_FILE', '').strip() or \
+    os.path.join(os.path.expanduser('~'), '.qt5chat', 'upload_sessions.json')
+# GCS keeps a resumable session for a week; forget ours a bit earlier
+SESSION_MAX_AGE = 6 * 24 * 3600
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 120
+
+
+class SessionStore:
+    """Resumable session URIs persisted to a JSON file, keyed by blob and file identity.
+
+    A session URI is a capability on its own (no auth header needed), so after a crash or
+    restart the next upload of the same unchanged file to the same blob resumes it.
+    """
+
+    def __init__(self, path: str = SESSION_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(bucket_name: str, blob_path: str, file_path: str) -> str:
+        st = os.stat(file_path)
+        ident = f'{bucket_name}\0{blob_path}\0{os.path.abspath(file_path)}\0{st.st_size}\0{st.st_mtime_ns}'
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, data: dict):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._load().get(key)
+        if not entry or time.time() - entry.get('created', 0) > SESSION_MAX_AGE:
+            return None
+        return entry.get('uri')
+
+    def put(self, key: str, uri: str):
+        with self._lock:
+            data = self._load()
+            now = time.time()
+            data = {k: v for k, v in data.items() if now - v.get('created', 0) <= SESSION_MAX_AGE}
+            data[key] = {'uri': uri, 'created': now}
+            self._save(data)
+
+    def remove(self, key: str):
+        with self._lock:
+            data = self._load()
+            if data.pop(key, None) is not None:
+                self._save(data)
+
+
+_default_sessions = None
+_default_http = None
+
+
+def _sessions() -> SessionStore:
+    global _default_sessions
+    if _default_sessions is None:
+        _default_sessions = SessionStore()
+    return _default_sessions
+
+
+def _http():
+    global _default_http
+    if _default_http is None:
+        import requests
+        _default_http = requests.Session()
+    return _default_http
+
+
+def _committed(resp) -> int:
+    """Bytes the server has, from the Range header of a 308 reply ("bytes=0-N")."""
+    rng = resp.headers.get('Range') or resp.headers.get('range')
+    if not rng:
+        return 0
+    return int(rng.rsplit('-', 1)[1]) + 1
+
+
+def _query_offset(http, session_uri: str, size: int) -> int | None:
+    """Where to continue an existing session; None if it is gone."""
+    resp = http.put(session_uri, data=b'', headers={'Content-Range': f'bytes */{size}'}, timeout=REQUEST_TIMEOUT)
+    if resp.status_code in (200, 201):
+        return size
+    if resp.status_code == 308:
+        return _committed(resp)
+    return None
+
+
+def upload_blob(bucket, blob_path: str, file_path: str, content_type: str, chunk_size: int = CHUNK_SIZE,
+                sessions: SessionStore | None = None, http=None, progress=None) -> str:
+    """Upload file_path to bucket/blob_path readable by everyone and return its public URL.
+
+    `bucket` is a google.cloud.storage Bucket (or lib.fake_storage.FakeBucket), `http`
+    anything with requests' put(); `progress(sent, total)` is called after every chunk.
+    """
+    size = os.path.getsize(file_path)
+    blob = bucket.blob(blob_path)
+    if size <= RESUMABLE_THRESHOLD:
+        blob.upload_from_filename(file_path, content_type=content_type, predefined_acl=PREDEFINED_ACL)
+        if progress:
+            progress(size, size)
+        return blob.public_url
+
+    sessions = sessions or _sessions()
+    http = http or getattr(bucket, 'http', None) or _http()
+    chunk_size = max(_CHUNK_QUANTUM, chunk_size // _CHUNK_QUANTUM * _CHUNK_QUANTUM)
+    key = SessionStore.key(bucket.name, blob_path, file_path)
+
+    offset = None
+    session_uri = sessions.get(key)
+    if session_uri:
+        try:
+            offset = _query_offset(http, session_uri, size)
+        except Exception:
+            offset = None
+        if offset is not None:
+            print(f"[Upload] Resuming {blob_path} at {offset}/{size} bytes")
+    if offset is None:
+        session_uri = blob.create_resumable_upload_session(content_type=content_type, size=size,
+                                                           predefined_acl=PREDEFINED_ACL)
+        sessions.put(key, session_uri)
+        offset = 0
+
+    retries = 0
+    with open(file_path, 'rb') as f:
+        while offset < size:
+            f.seek(offset)
+            data = f.read(chunk_size)
+            headers = {'Content-Range': f'bytes {offset}-{offset + len(data) - 1}/{size}'}
+            try:
+                resp = http.put(session_uri, data=data, headers=headers, timeout=REQUEST_TIMEOUT)
+                status = resp.status_code
+            except (OSError, IOError) as e:
+                resp, status = None, f'{type(e).__name__}: {e}'
+            if status in (200, 201):
+                offset = size
+            elif status == 308:
+                offset = _committed(resp)
+                retries = 0
+            elif status in (404, 410):
+                # Session expired: start over next time
+                sessions.remove(key)
+                raise RuntimeError(f"Resumable upload session for {blob_path} expired")
+            elif resp is not None and status < 500 and status != 429:
+                raise RuntimeError(f"Resumable upload of {blob_path} failed: HTTP {status}")
+            else:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    # The session stays in SessionStore; uploading the same file again resumes it
+                    raise RuntimeError(f"Resumable upload of {blob_path} interrupted at {offset}/{size}: {status}")
+                time.sleep(min(0.5 * 2 ** (retries - 1), 8.0))
+                try:
+                    offset = _query_offset(http, session_uri, size) or 0
+                except Exception:
+                    pass
+                continue
+            if progress:
+                progress(offset, size)
+
+    sessions.remove(key)
+    return blob.public_url
+
+
+def upload_stream(bucket, blob_path: str, file_obj, size: int, content_type: str) -> str:
+    """Upload `size` bytes read from file_obj (no temp file) with the same ACL; return the public URL."""
+    blob = bucket.blob(blob_path)
+    blob.upload_from_file(file_obj, size=size, content_type=content_type, predefined_acl=PREDEFINED_ACL)
+    return blob.public_url
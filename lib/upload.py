@@ -3,6 +3,8 @@ import sys
 import json
 import mimetypes
 import re
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 
 try:
@@ -14,6 +16,11 @@ except ImportError:
     storage = None
     GoogleCloudError = Exception
 
+try:
+    from lib.resumable_upload import upload_blob, upload_stream
+except Exception:
+    from resumable_upload import upload_blob, upload_stream
+
 try:
     import firebase_admin
     from firebase_admin import firestore as admin_firestore
@@ -152,8 +159,14 @@ def _sanitize_filename(filename: str) -> str:
     return sanitized if sanitized else "file"
 
 
-def upload_file(file_path: str, conversation_id: str) -> tuple[str, str]:
-    if not os.path.isfile(file_path):
+def upload_file(file_path: str, conversation_id: str, progress=None,
+                file_obj=None, file_size: int | None = None) -> tuple[str, str]:
+    """Upload lên Storage, trả về (public_url, content_type).
+
+    Với file_obj (đối tượng có read(), ví dụ upload_spool.Base64Reader) thì nội dung được
+    đọc từ đó (file_size byte) và file_path chỉ dùng để lấy tên / content type.
+    """
+    if file_obj is None and not os.path.isfile(file_path):
         raise FileNotFoundError(f"File not found: {file_path}")
     
     if not conversation_id or not conversation_id.strip():
@@ -188,26 +201,24 @@ def upload_file(file_path: str, conversation_id: str) -> tuple[str, str]:
         
         # Tạo blob path
         blob_path = f"chat_files/{conversation_id}/{file_name}"
-        blob = bucket.blob(blob_path)
         
         print(f"[Upload SDK] Đang upload: {file_name} ({content_type})...")
         
-        # Upload file - SDK tự xử lý mọi thứ
-        blob.upload_from_filename(file_path, content_type=content_type)
-        
-        # Đặt file là public
-        blob.make_public()
-        
-        # Lấy public URL
-        public_url = blob.public_url
+        # File nhỏ: một request; file lớn: resumable session theo chunk.
+        # ACL public được đặt ngay khi tạo object (không cần make_public)
+        if file_obj is not None:
+            # Đọc thẳng từ stream, không cần file tạm
+            public_url = upload_stream(bucket, blob_path, file_obj, file_size, content_type)
+        else:
+            public_url = upload_blob(bucket, blob_path, file_path, content_type, progress=progress)
         
         print(f"[Upload SDK] Thành công: {public_url}")
         return public_url, content_type
     
     except GoogleCloudError as e:
-        raise RuntimeError(f"Failed to upload file to Google Cloud Storage: {e}")
+        raise RuntimeError(f"Failed to upload file to Google Cloud Storage: {e}") from e
     except Exception as e:
-        raise RuntimeError(f"Unexpected error during file upload: {e}")
+        raise RuntimeError(f"Unexpected error during file upload: {e}") from e
 
 
 def _get_firestore_client():
@@ -245,20 +256,29 @@ def _get_firestore_client():
         raise RuntimeError(f"Failed to initialize Firestore client: {e}")
 
 
-def send_message_file(conversation_id: str, sender_id: str, file_path: str) -> str:
+def send_message_file(conversation_id: str, sender_id: str, file_path: str, file_name: str = '',
+                      store=None, is_group: bool = False, progress=None,
+                      file_obj=None, file_size: int | None = None) -> dict:
     """
-    Gửi message kèm file vào Firestore.
+    Gửi message kèm file.
     
-    Upload file lên Google Cloud Storage và lưu thông tin message vào Firestore
-    với cấu trúc: conversations/{conversation_id}/messages/{message_id}
+    Upload file lên Google Cloud Storage rồi lưu message: vào `store` (MessageStore của
+    server) nếu có, nếu không thì thẳng vào Firestore với cấu trúc
+    conversations/{conversation_id}/messages/{message_id}
     
     Args:
         conversation_id: ID của conversation
         sender_id: ID của người gửi (senderId)
         file_path: Đường dẫn đến file cần upload
+        file_name: Tên hiển thị (mặc định là tên file trong file_path)
+        store: Server.message_store.MessageStore hoặc None
+        is_group: conversation_id là group id
+        progress: callback(sent_bytes, total_bytes) trong lúc upload
+        file_obj, file_size: đọc nội dung từ stream thay vì file_path (xem upload_file)
     
     Returns:
-        str: Public URL của file đã upload
+        dict: message đã lưu - id, senderUid, ts (ms), text, fileURL, fileType, fileName
+        (cùng dạng với make_message), đủ để gửi FILE_MESSAGE mà không cần đọc lại
     
     Raises:
         FileNotFoundError: Nếu file không tồn tại
@@ -276,14 +296,28 @@ def send_message_file(conversation_id: str, sender_id: str, file_path: str) -> s
     sender_id = sender_id.strip()
     
     # Lấy tên file gốc (để lưu trong Firestore)
-    original_file_name = Path(file_path).name
+    original_file_name = file_name or Path(file_path).name
     
     # Upload file lên Storage (sẽ tự động sanitize file name trong upload_file)
-    file_url, content_type = upload_file(file_path, conversation_id)
+    file_url, content_type = upload_file(file_path, conversation_id, progress=progress,
+                                         file_obj=file_obj, file_size=file_size)
     
     # Xác định fileType (phần đầu của content_type, ví dụ: "image" từ "image/png")
     file_type = content_type.split("/")[0] if "/" in content_type else "application"
     
+    record = {
+        'id': '',
+        'senderUid': sender_id,
+        'text': '',
+        'ts': 0,
+        'fileURL': file_url,
+        'fileType': file_type,  # "image", "audio", "video", "application"
+        'fileName': original_file_name,  # Lưu tên file gốc
+    }
+    if store is not None:
+        # MessageStore.append điền id và ts
+        return store.append(conversation_id, record, is_group=is_group)
+    
     try:
         # Khởi tạo Firestore client
         db = _get_firestore_client()
@@ -294,20 +328,22 @@ def send_message_file(conversation_id: str, sender_id: str, file_path: str) -> s
             .collection("messages")\
             .document()
         
-        # Lưu message vào Firestore
+        # Ghi timestamp (ms) tường minh để record trả về trùng với giá trị đã lưu
+        ts = int(time.time() * 1000)
         message_ref.set({
             "senderId": sender_id,
             "fileURL": file_url,
-            "fileType": file_type,  # "image", "audio", "video", "application"
-            "fileName": original_file_name,  # Lưu tên file gốc
-            "timestamp": admin_firestore.SERVER_TIMESTAMP
+            "fileType": file_type,
+            "fileName": original_file_name,
+            "timestamp": datetime.fromtimestamp(ts / 1000.0, tz=timezone.utc)
         })
         
-        return file_url
+        record['id'] = message_ref.id
+        record['ts'] = ts
+        return record
     
     except RuntimeError:
         # Re-raise RuntimeError từ _get_firestore_client hoặc upload_file
         raise
     except Exception as e:
         raise RuntimeError(f"Failed to save message to Firestore: {e}")
-
@@ -0,0 +1,95 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import async_server
+
+
+class FakeTransport:
+
+    def __init__(self, buffered=0):
+        self.buffered = buffered
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+class FakeWriter:
+
+    def __init__(self, buffered=0):
+        self.transport = FakeTransport(buffered)
+        self.written = []
+        self.closed = False
+
+    def is_closing(self):
+        return self.closed
+
+    def writelines(self, frames):
+        self.written.extend(frames)
+
+    def close(self):
+        self.closed = True
+
+
+class AsyncConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def connection(self, buffered=0):
+        writer = FakeWriter(buffered)
+        return async_server.AsyncConnection(writer, self.loop, max_bytes=10, policy='drop_oldest'), writer
+
+    def run_pending(self):
+        self.loop.run_until_complete(asyncio.sleep(0))
+
+    def test_put_does_not_touch_transport(self):
+        conn, writer = self.connection()
+        writer.transport = None   # an off-loop read would fail here
+        self.assertTrue(conn.put(b'abc'))
+        self.assertTrue(conn.put(b'def', droppable=True))
+        self.assertEqual(list(conn._pending), [(b'abc', False), (b'def', True)])
+
+    def test_flush_drops_broadcasts_behind_transport_buffer(self):
+        conn, writer = self.connection(buffered=6)
+        conn.put(b'bcast', droppable=True)
+        conn.put(b'ok')
+        self.run_pending()
+        self.assertEqual(writer.written, [b'ok'])
+        self.assertEqual(conn.dropped, 1)
+        self.assertFalse(writer.closed)
+
+    def test_flush_closes_when_replies_do_not_fit(self):
+        conn, writer = self.connection(buffered=8)
+        conn.put(b'reply')
+        self.run_pending()
+        self.run_pending()
+        self.assertEqual(writer.written, [])
+        self.assertTrue(writer.closed)
+
+
+class HandshakeLimitTest(unittest.TestCase):
+
+    def test_oversized_auth_line_is_refused(self):
+        async def scenario():
+            server = await asyncio.start_server(
+                lambda r, w: async_server._handle_connection(r, w, None),
+                '127.0.0.1', 0, limit=async_server.MAX_LINE)
+            port = server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'AUTH ' + b'x' * (async_server.AUTH_LINE_LIMIT * 4) + b'\n')
+            data = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return data
+
+        self.assertEqual(asyncio.run(scenario()), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import commands
+
+
+class RecordingConn:
+
+    def __init__(self, uid=''):
+        self._chat_uid = uid
+        self.replies = []
+
+    def sendall(self, data):
+        self.replies.append(json.loads(data[4:]))
+
+
+class StatsCommandTest(unittest.TestCase):
+
+    def test_stats_requires_admin_uid(self):
+        conn = RecordingConn('u1')
+        with mock.patch.object(commands, 'STATS_ADMIN_UIDS', frozenset({'admin'})):
+            commands._cmd_stats(conn, {}, 'u1')
+            commands._cmd_stats(conn, {}, 'admin')
+        self.assertEqual(conn.replies[0], {'type': 'STATS', 'ok': False, 'error': 'forbidden'})
+        self.assertTrue(conn.replies[1]['ok'])
+        self.assertIn('commands', conn.replies[1])
+
+
+class DispatchTest(unittest.TestCase):
+
+    def test_handler_receives_connection_uid(self):
+        seen = []
+        spec = commands.CommandSpec(lambda conn, obj, uid: seen.append(uid), io=None)
+        conn = RecordingConn('u1')
+        with mock.patch.dict(commands.COMMANDS, {'PING': spec}), \
+                mock.patch.object(commands.io_pools, 'submit', lambda conn, io, fn: fn() or True):
+            commands.handle_command_line(conn, {'type': 'PING'})
+            commands.handle_command_line(RecordingConn(), {'type': 'PING'})
+        self.assertEqual(seen, ['u1'])
+
+    def test_file_chunks_run_on_the_storage_pool(self):
+        for cmd_type in ('SEND_FILE_START', 'SEND_FILE_CHUNK', 'SEND_FILE_END'):
+            self.assertEqual(commands.COMMANDS[cmd_type].io, 'storage')
+
+    def test_busy_chunk_reply_names_the_chunk(self):
+        conn = RecordingConn('u1')
+
+        def submit(conn, io, fn):
+            if io is not None:
+                return False
+            fn()
+            return True
+
+        with mock.patch.object(commands.io_pools, 'submit', submit):
+            commands.handle_command_line(conn, {'type': 'SEND_FILE_CHUNK', 'clientMsgId': 'c1', 'chunkIndex': 3})
+        self.assertEqual(conn.replies, [{'type': 'FILE_CHUNK_ERROR', 'ok': False, 'error': 'busy',
+                                         'retryAfterMs': commands.BUSY_RETRY_AFTER_MS,
+                                         'clientMsgId': 'c1', 'chunkIndex': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import socket
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from lib.framing import LineFramer, LineTooLongError
+from Server import handler
+
+
+class LineFramerTest(unittest.TestCase):
+
+    def test_one_line_keeps_the_rest_buffered(self):
+        framer = LineFramer(max_line=8)
+        framer.one_line = True
+        self.assertEqual(framer.feed(b'AUTH x\n' + b'y' * 20 + b'\nz'), [b'AUTH x'])
+        framer.max_line = 64
+        framer.one_line = False
+        self.assertEqual(framer.feed(b''), [b'y' * 20])
+        self.assertEqual(framer.feed(b'\n'), [b'z'])
+
+    def test_long_first_line_is_refused(self):
+        framer = LineFramer(max_line=8)
+        framer.one_line = True
+        with self.assertRaises(LineTooLongError):
+            framer.feed(b'x' * 20)
+
+
+class PipelinedAuthTest(unittest.TestCase):
+
+    def test_long_command_pipelined_after_auth(self):
+        handled = []
+        server, client = socket.socketpair()
+        self.addCleanup(client.close)
+        command = 'CMD {"type":"SEND_DM","text":"%s"}' % ('a' * (handler.AUTH_LINE_LIMIT * 2))
+        patches = (
+            mock.patch.object(handler, 'authenticate', return_value=(True, 'u1', 'u1', '', '', 0.0, False)),
+            mock.patch.object(handler, 'session_line', return_value=b''),
+            mock.patch.object(handler, 'register_client'),
+            mock.patch.object(handler, 'unregister_client'),
+            mock.patch.object(handler, 'handle_line', side_effect=lambda conn, addr, text: handled.append(text) or True),
+        )
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        thread = threading.Thread(target=handler.handle_client, args=(server, 'test'))
+        thread.start()
+        client.sendall(b'AUTH token\n' + command.encode('utf-8') + b'\n')
+        self.assertEqual(client.recv(64), b'AUTH_OK\n')
+        client.shutdown(socket.SHUT_WR)
+        thread.join(5)
+        server.close()
+        self.assertEqual(handled, [command])
+
+
+if __name__ == '__main__':
+    unittest.main()
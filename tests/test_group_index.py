@@ -0,0 +1,117 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import group_index as group_index_module
+from Server.group_index import GroupIndex
+
+
+class GroupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.groups = {}
+        self.reads = []
+        self.on_read = None
+        db = mock.Mock()
+        db.reference.side_effect = self.reference
+        for name, value in (('db', db), ('init_firebase_if_needed', lambda: None)):
+            patcher = mock.patch.object(group_index_module, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def reference(self, path):
+        parts = path.strip('/').split('/')
+        node = self.groups.get(parts[1], {})
+        ref = mock.Mock()
+        if len(parts) == 3:
+            ref.get.side_effect = lambda: self.read(path, node.get(parts[2]))
+        else:
+            ref.order_by_key.return_value.end_at.side_effect = lambda key: mock.Mock(get=lambda: self.read(
+                path, {k: v for k, v in node.items() if k <= key}))
+        return ref
+
+    def read(self, path, value):
+        self.reads.append(path)
+        if self.on_read is not None:
+            self.on_read()
+        return value
+
+    def test_created_group_keeps_metadata(self):
+        index = GroupIndex()
+        index.set_group('g1', {'u1': True, 'u2': True},
+                        {'id': 'g1', 'name': 'G', 'createdBy': 'u1', 'createdAt': 5, 'members': {}})
+        self.assertEqual(index.info('g1'), {'name': 'G', 'createdBy': 'u1', 'createdAt': 5})
+        self.assertEqual(index.members('g1'), frozenset({'u1', 'u2'}))
+        self.assertEqual(index.loads, 0)
+
+    def test_missing_group_expires(self):
+        index = GroupIndex(negative_ttl=60)
+        self.assertEqual(index.members('g1'), frozenset())
+        self.groups['g1'] = {'members': {'u1': True}, 'name': 'G'}
+        self.assertEqual(index.members('g1'), frozenset())
+        with mock.patch.object(group_index_module.time, 'monotonic', return_value=group_index_module.time.monotonic() + 61):
+            self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.assertEqual(index.info('g1')['name'], 'G')
+        self.assertEqual(index.loads, 2)
+
+    def test_load_reads_members_and_metadata_without_messages(self):
+        self.groups['g1'] = {'createdAt': 5, 'createdBy': 'u1', 'id': 'g1', 'members': {'u1': True, 'u2': False},
+                             'messages': {'m1': {'text': 'big'}}, 'name': 'G'}
+        index = GroupIndex()
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.assertEqual(index.info('g1'), {'name': 'G', 'createdBy': 'u1', 'createdAt': 5})
+        self.assertEqual(self.reads, ['/groups/g1', '/groups/g1/name'])
+
+    def test_positive_entries_expire(self):
+        index = GroupIndex(ttl=60)
+        self.groups['g1'] = {'members': {'u1': True}}
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.groups['g1'] = {'members': {'u1': True, 'u2': True}}
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        with mock.patch.object(group_index_module.time, 'monotonic', return_value=group_index_module.time.monotonic() + 61):
+            self.assertEqual(index.members('g1'), frozenset({'u1', 'u2'}))
+
+    def test_change_during_load_is_not_overwritten(self):
+        index = GroupIndex()
+        index.set_group('g1', {'u1', 'u2'})
+        index.invalidate('g1')
+        self.groups['g1'] = {'members': {'u1': True, 'u2': True}, 'name': 'G'}
+
+        def leave_during_read():
+            # LEAVE_GROUP lands while the snapshot (still listing u2) is on its way
+            self.on_read = None
+            index.set_group('g1', {'u1'})
+
+        self.on_read = leave_during_read
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.assertEqual(index.stats()['stale_loads'], 1)
+
+    def test_removal_during_load_of_uncached_group(self):
+        index = GroupIndex()
+        self.groups['g1'] = {'members': {'u1': True, 'u2': True}}
+
+        def leave_during_read():
+            self.on_read = None
+            self.groups['g1'] = {'members': {'u1': True}}
+            index.remove_member('g1', 'u2')
+
+        self.on_read = leave_during_read
+        # The stale snapshot is discarded and the group read again
+        self.assertEqual(index.members('g1'), frozenset({'u1'}))
+        self.assertEqual(index.loads, 2)
+
+    def test_bounded(self):
+        index = GroupIndex(max_groups=2)
+        for group_id in ('g1', 'g2', 'g3'):
+            index.set_group(group_id, {'u1'})
+        self.assertEqual(index.stats()['groups'], 2)
+        self.groups['g1'] = {'members': {'u9': True}}
+        self.assertEqual(index.members('g1'), frozenset({'u9'}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import os
+import stat
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Client.message_cache import MessageCache, conversation_key
+
+
+@unittest.skipIf(os.name != 'posix', 'POSIX permissions only')
+class MessageCachePermissionsTest(unittest.TestCase):
+
+    def test_database_and_wal_files_are_private(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        cache_dir = os.path.join(root.name, 'messages')
+        old_umask = os.umask(0o022)
+        try:
+            cache = MessageCache('me@example.com', cache_dir=cache_dir)
+            self.addCleanup(cache.close)
+            cache.store_page(conversation_key('u2', False),
+                             {'messages': [{'id': 'm1', 'ts': 1000, 'text': 'hi'}], 'hasMore': False})
+        finally:
+            os.umask(old_umask)
+        self.assertEqual(stat.S_IMODE(os.stat(cache_dir).st_mode), 0o700)
+        for suffix in ('', '-wal', '-shm'):
+            path = cache.path + suffix
+            self.assertTrue(os.path.exists(path), path)
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
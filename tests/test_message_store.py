@@ -0,0 +1,217 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import message_store
+from Server.message_store import make_message
+
+
+class FakeRef:
+    """Just enough of firebase_admin.db.Reference for RTDBMessageStore."""
+
+    def __init__(self, node):
+        self.node = node
+        self.key = None
+        self.fetches = []
+
+    def order_by_child(self, child):
+        return FakeQuery(self, sorted(self.node.items(), key=lambda item: (item[1]['ts'], item[0])))
+
+    def get(self):
+        return dict(self.node)
+
+    def push(self, data):
+        ref = FakeRef(self.node)
+        ref.key = f'k{len(self.node):04d}'
+        self.node[ref.key] = data
+        return ref
+
+
+class FakeQuery:
+
+    def __init__(self, ref, items):
+        self.ref = ref
+        self.items = items
+
+    def start_at(self, ts):
+        return FakeQuery(self.ref, [item for item in self.items if item[1]['ts'] >= ts])
+
+    def end_at(self, ts):
+        return FakeQuery(self.ref, [item for item in self.items if item[1]['ts'] <= ts])
+
+    def limit_to_first(self, n):
+        self.ref.fetches.append(n)
+        return FakeQuery(self.ref, self.items[:n])
+
+    def limit_to_last(self, n):
+        self.ref.fetches.append(n)
+        return FakeQuery(self.ref, self.items[-n:])
+
+    def get(self):
+        return dict(self.items)
+
+
+class FakeDoc:
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeCollection:
+    """Just enough of a Firestore collection/query for FirestoreMessageStore.page."""
+
+    DESCENDING = 'DESCENDING'
+
+    def __init__(self, docs, fetches=None):
+        self.docs = docs
+        self.fetches = [] if fetches is None else fetches
+
+    def where(self, field, op, value):
+        compare = {'>=': lambda a: a >= value, '<': lambda a: a < value}[op]
+        return FakeCollection([d for d in self.docs if compare(d.to_dict()[field])], self.fetches)
+
+    def order_by(self, field, direction=None):
+        # Ties are returned in arbitrary (here: reverse id) order, like random document ids
+        docs = sorted(self.docs, key=lambda d: d.id, reverse=True)
+        docs = sorted(docs, key=lambda d: d.to_dict()[field], reverse=direction == self.DESCENDING)
+        return FakeCollection(docs, self.fetches)
+
+    def limit(self, n):
+        self.fetches.append(n)
+        return FakeCollection(self.docs[:n], self.fetches)
+
+    def stream(self):
+        return iter(self.docs)
+
+
+class MessageStoreInterfaceTest(unittest.TestCase):
+
+    def test_backend_must_implement_interface(self):
+        class Incomplete(message_store.MessageStore):
+            def append(self, conversation_id, message, is_group=False):
+                return message
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+class RTDBMessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.node = {}
+        self.db = mock.Mock()
+        self.ref = FakeRef(self.node)
+        self.db.reference.return_value = self.ref
+        for name, value in (('db', self.db), ('init_firebase_if_needed', lambda: None)):
+            patcher = mock.patch.object(message_store, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.store = message_store.RTDBMessageStore()
+
+    def test_append_returns_stored_ts(self):
+        record = self.store.append('t1', make_message('u1', 'hi'))
+        self.assertEqual(self.node[record['id']]['ts'], record['ts'])
+        self.assertGreater(record['ts'], 0)
+
+    def add(self, *timestamps):
+        return [self.store.append('t1', {**make_message('u1', f'm{i}'), 'ts': ts}) for i, ts in enumerate(timestamps)]
+
+    def test_has_more_ignores_the_cursor_row(self):
+        records = self.add(1000, 1001, 1002, 1003)
+        cursor = records[2]
+        page, has_more = self.store.page('t1', False, 2, before=cursor['ts'], before_id=cursor['id'])
+        self.assertEqual([m['text'] for m in page], ['m0', 'm1'])
+        self.assertFalse(has_more)
+        page, has_more = self.store.page('t1', False, 1, after=records[1]['ts'], after_id=records[1]['id'])
+        self.assertEqual([m['text'] for m in page], ['m2'])
+        self.assertTrue(has_more)
+        page, has_more = self.store.page('t1', False, 2, after=records[1]['ts'], after_id=records[1]['id'])
+        self.assertEqual([m['text'] for m in page], ['m2', 'm3'])
+        self.assertFalse(has_more)
+
+    def test_query_widens_past_rows_sharing_the_cursor_ts(self):
+        records = self.add(900, 1000, 1000, 1000, 1000, 1000)
+        cursor = records[2]
+        page, has_more = self.store.page('t1', False, 1, before=cursor['ts'], before_id=cursor['id'])
+        self.assertEqual(page, [records[1]])
+        self.assertTrue(has_more)
+        self.assertGreater(len(self.ref.fetches), 1)
+
+
+class FirestoreMessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = FakeCollection([])
+        firestore = mock.Mock()
+        firestore.Query.DESCENDING = FakeCollection.DESCENDING
+        firebase_admin = mock.Mock(firestore=firestore)
+        patcher = mock.patch.dict(sys.modules, {'firebase_admin': firebase_admin,
+                                                'firebase_admin.firestore': firestore})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(message_store.FirestoreMessageStore, '_collection',
+                                    staticmethod(lambda conversation_id: self.collection))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = message_store.FirestoreMessageStore()
+
+    def add(self, *timestamps):
+        records = []
+        for i, ts in enumerate(timestamps):
+            doc = FakeDoc(f'd{i}', {'senderId': 'u1', 'text': f'm{i}',
+                                    'timestamp': datetime.fromtimestamp(ts / 1000.0, tz=timezone.utc)})
+            self.collection.docs.append(doc)
+            records.append({'id': doc.id, 'ts': ts})
+        return records
+
+    def test_has_more_ignores_the_cursor_row(self):
+        records = self.add(1000, 1001, 1002, 1003)
+        cursor = records[2]
+        page, has_more = self.store.page('t1', False, 2, before=cursor['ts'], before_id=cursor['id'])
+        self.assertEqual([m['text'] for m in page], ['m0', 'm1'])
+        self.assertFalse(has_more)
+        page, has_more = self.store.page('t1', False, 1, after=records[1]['ts'], after_id=records[1]['id'])
+        self.assertEqual([m['text'] for m in page], ['m2'])
+        self.assertTrue(has_more)
+        page, has_more = self.store.page('t1', False, 2, after=records[1]['ts'], after_id=records[1]['id'])
+        self.assertEqual([m['text'] for m in page], ['m2', 'm3'])
+        self.assertFalse(has_more)
+
+    def test_query_widens_past_rows_sharing_the_cursor_ts(self):
+        records = self.add(900, 1000, 1000, 1000, 1000, 1000)
+        cursor = records[2]
+        page, has_more = self.store.page('t1', False, 1, before=cursor['ts'], before_id=cursor['id'])
+        self.assertEqual([m['id'] for m in page], [records[1]['id']])
+        self.assertTrue(has_more)
+        self.assertGreater(len(self.collection.fetches), 1)
+        page, has_more = self.store.page('t1', False, 1, after=records[2]['ts'], after_id=records[2]['id'])
+        self.assertEqual([m['id'] for m in page], [records[3]['id']])
+        self.assertTrue(has_more)
+
+
+class SQLiteMessageStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = message_store.SQLiteMessageStore(':memory:')
+        self.addCleanup(self.store.close)
+
+    def test_append_and_page(self):
+        records = [self.store.append('t1', {**make_message('u1', f'm{i}'), 'ts': 1000 + i}) for i in range(5)]
+        page, has_more = self.store.page('t1', False, 3)
+        self.assertEqual([m['text'] for m in page], ['m2', 'm3', 'm4'])
+        self.assertTrue(has_more)
+        page, has_more = self.store.page('t1', False, 3, before=records[2]['ts'], before_id=records[2]['id'])
+        self.assertEqual([m['text'] for m in page], ['m0', 'm1'])
+        self.assertFalse(has_more)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import outbound
+
+
+class StalledConn:
+    """Peer whose TCP window is full: every send would block."""
+
+    def __init__(self):
+        self.killed = False
+
+    def send(self, data, flags=0):
+        raise BlockingIOError
+
+    def shutdown(self, how):
+        self.killed = True
+
+
+class DropDroppableTest(unittest.TestCase):
+
+    def test_drops_only_droppable_oldest_first(self):
+        frames = deque([(b'aa', True), (b'reply', False), (b'bb', True), (b'cc', True)])
+        freed, dropped = outbound.drop_droppable(frames, 3)
+        self.assertEqual((freed, dropped), (4, 2))
+        self.assertEqual(list(frames), [(b'reply', False), (b'cc', True)])
+
+    def test_keeps_partial_head(self):
+        frames = deque([(b'aa', True), (b'bb', True)])
+        self.assertEqual(outbound.drop_droppable(frames, 10, keep_head=True), (2, 1))
+        self.assertEqual(list(frames), [(b'aa', True)])
+
+
+class OutboundQueueOverflowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = StalledConn()
+        self.queue = outbound.OutboundQueue(self.conn, max_bytes=10, policy='drop_oldest')
+        # Keep the writer thread from draining the queue during the test
+        self.queue._thread = object()
+
+    def test_reply_evicts_broadcasts(self):
+        self.assertTrue(self.queue.put(b'12345', droppable=True))
+        self.assertTrue(self.queue.put(b'abcd'))
+        self.assertTrue(self.queue.put(b'xyz'))
+        self.assertEqual(list(self.queue._frames), [(b'abcd', False), (b'xyz', False)])
+        self.assertEqual(self.queue.dropped, 1)
+        self.assertFalse(self.conn.killed)
+
+    def test_broadcast_that_does_not_fit_is_dropped(self):
+        self.assertTrue(self.queue.put(b'12345678'))
+        self.assertTrue(self.queue.put(b'abcd', droppable=True))
+        self.assertEqual(list(self.queue._frames), [(b'12345678', False)])
+        self.assertEqual(self.queue.dropped, 1)
+        self.assertFalse(self.conn.killed)
+
+    def test_disconnects_when_only_replies_are_queued(self):
+        self.assertTrue(self.queue.put(b'12345678'))
+        self.assertFalse(self.queue.put(b'abcd'))
+        self.assertTrue(self.conn.killed)
+        self.assertFalse(self.queue.put(b'x', droppable=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
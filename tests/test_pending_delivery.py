@@ -0,0 +1,72 @@
+import json
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import commands, handler, pending_delivery
+from Server.state import uid_to_socket
+
+
+class RecordingConn:
+
+    def __init__(self):
+        self.lines = []
+
+    def send(self, data, flags=0):
+        self.lines.extend(json.loads(line[4:]) for line in data.splitlines() if line.startswith(b'CMD '))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class PendingDeliveryTest(unittest.TestCase):
+
+    def setUp(self):
+        pending_delivery.set_pending_queue(pending_delivery.PendingQueue(':memory:'))
+        self.addCleanup(pending_delivery.set_pending_queue, None)
+        self.conn = RecordingConn()
+        self.addCleanup(handler.unregister_client, self.conn, 'test')
+
+    def test_queued_events_arrive_before_live_pushes(self):
+        commands._send_to_user('u1', {'type': 'DM', 'text': 'offline'})
+        handler.register_client(self.conn, 'u1', 'u1', '', '', resumed=True)
+        commands._send_to_user('u1', {'type': 'DM', 'text': 'live'})
+        self.assertEqual([line['type'] for line in self.conn.lines], ['PENDING', 'DM'])
+        self.assertEqual(self.conn.lines[0]['events'], [{'type': 'DM', 'text': 'offline'}])
+        self.assertEqual(self.conn.lines[1]['text'], 'live')
+
+    def test_uid_is_published_with_the_batch(self):
+        seen = []
+        pushers = []
+        take = pending_delivery.PendingQueue.take
+
+        def take_and_push(queue, uid):
+            # A push racing with the login must wait for the batch instead of being queued
+            # behind the take or overtaking it
+            pusher = threading.Thread(target=commands._send_to_user, args=(uid, {'type': 'DM', 'text': 'racing'}))
+            pusher.start()
+            pusher.join(0.1)
+            seen.append(pusher.is_alive())
+            pushers.append(pusher)
+            return take(queue, uid)
+
+        commands._send_to_user('u1', {'type': 'DM', 'text': 'offline'})
+        pending_delivery.PendingQueue.take = take_and_push
+        try:
+            handler.register_client(self.conn, 'u1', 'u1', '', '', resumed=True)
+        finally:
+            pending_delivery.PendingQueue.take = take
+        for pusher in pushers:
+            pusher.join()
+        self.assertEqual(seen, [True])
+        self.assertEqual([line['type'] for line in self.conn.lines], ['PENDING', 'DM'])
+        self.assertEqual(self.conn.lines[1]['text'], 'racing')
+        self.assertIs(uid_to_socket.get('u1'), self.conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
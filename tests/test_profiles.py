@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import firebase_admin_utils as fau
+from Server.cache import profile_cache
+
+
+class GetProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.users = {
+            'u1': {'email': 'old@x', 'displayName': 'Renamed'},
+            'u2': {'email': 'u2@x'},
+            'u3': {'email': 'u3@x', 'displayName': 'Three'},
+        }
+        fb_auth = mock.Mock()
+        fb_auth.get_users.return_value = mock.Mock(users=[
+            mock.Mock(uid='u1', email='u1@x', display_name='Auth One'),
+            mock.Mock(uid='u2', email='u2@x', display_name='Auth Two'),
+        ])
+        self.fb_auth = fb_auth
+        self.reads = []
+        self.read_delay = 0.0
+        self.reads_lock = threading.Lock()
+        db = mock.Mock()
+        db.reference.side_effect = self.reference
+        for name, value in (('fb_auth', fb_auth), ('db', db), ('init_firebase_if_needed', lambda: None),
+                            ('_firebase_initialized', True)):
+            patcher = mock.patch.object(fau, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        profile_cache.clear()
+        self.addCleanup(profile_cache.clear)
+
+    def reference(self, path):
+        parts = path.strip('/').split('/')
+        node = self.users.get(parts[1])
+        if len(parts) == 3:
+            node = (node or {}).get(parts[2])
+        ref = mock.Mock()
+        ref.get.side_effect = lambda: self.read(path, node)
+        return ref
+
+    def read(self, path, node):
+        with self.reads_lock:
+            self.reads.append(path)
+        time.sleep(self.read_delay)
+        return dict(node) if isinstance(node, dict) else node
+
+    def test_rtdb_display_name_wins(self):
+        profiles = fau.get_profiles(['u1', 'u2', 'u3'])
+        self.assertEqual(profiles['u1'], {'uid': 'u1', 'email': 'u1@x', 'displayName': 'Renamed'})
+        self.assertEqual(profiles['u2']['displayName'], 'Auth Two')
+        # Unknown to Auth: whole RTDB profile
+        self.assertEqual(profiles['u3'], {'uid': 'u3', 'email': 'u3@x', 'displayName': 'Three'})
+
+
+    def test_cold_friend_list_reads_in_parallel(self):
+        uids = [f'f{i:02d}' for i in range(50)]
+        for uid in uids:
+            self.users[uid] = {'email': f'{uid}@x', 'displayName': uid.upper()}
+        self.fb_auth.get_users.return_value = mock.Mock(users=[
+            mock.Mock(uid=uid, email=f'{uid}@x', display_name='') for uid in uids])
+        self.read_delay = 0.05
+        started = time.monotonic()
+        profiles = fau.get_profiles(uids)
+        elapsed = time.monotonic() - started
+        self.assertEqual(profiles['f07']['displayName'], 'F07')
+        # One get_users() call and one RTDB read per friend, issued together rather than
+        # one round trip after another (50 sequential reads would take 2.5 s)
+        self.assertEqual(self.fb_auth.get_users.call_count, 1)
+        self.assertEqual(sorted(self.reads), sorted(f'/users/{uid}/displayName' for uid in uids))
+        self.assertLess(elapsed, 0.5)
+        # Stored in profile_cache together with the Auth data: a warm list reads nothing
+        self.reads.clear()
+        fau.get_profiles(uids)
+        self.assertEqual(self.reads, [])
+        self.assertEqual(self.fb_auth.get_users.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
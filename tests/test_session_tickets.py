@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import session_tickets
+
+
+class SessionTicketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.states = {'u1': {'valid_after_ms': 0, 'disabled': False}}
+        patcher = mock.patch.object(session_tickets, 'revocation_state', side_effect=self.states.get)
+        self.lookup = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_issue_and_verify(self):
+        ticket, expires_in = session_tickets.issue_ticket('u1', 'a@b.c', 'A')
+        self.assertGreater(expires_in, 0)
+        self.assertLessEqual(expires_in, session_tickets.TICKET_TTL)
+        ok, label, uid, email, name, auth_at = session_tickets.verify_ticket(ticket)
+        self.assertTrue(ok)
+        self.assertEqual((label, uid, email, name), ('a@b.c', 'u1', 'a@b.c', 'A'))
+        self.assertAlmostEqual(auth_at, time.time(), delta=5)
+
+    def test_resumed_ticket_keeps_auth_time(self):
+        auth_at = time.time() - session_tickets.SESSION_MAX_AGE + 30
+        _, expires_in = session_tickets.issue_ticket('u1', 'a@b.c', 'A', auth_at=auth_at)
+        self.assertLessEqual(expires_in, 30)
+
+    def test_tampered_ticket(self):
+        ticket, _ = session_tickets.issue_ticket('u1', 'a@b.c', 'A')
+        payload, _, sig = ticket.partition('.')
+        forged = session_tickets._b64(b'{"uid":"u2","auth":0,"exp":9999999999}')
+        for bad in (forged + '.' + sig, payload + '.' + sig[:-2] + 'AA', payload, 'x.é', ''):
+            ok, reason, uid = session_tickets.verify_ticket(bad)[:3]
+            self.assertFalse(ok, bad)
+            self.assertTrue(reason.startswith('invalid_ticket:'), reason)
+            self.assertEqual(uid, '')
+
+    def test_expired(self):
+        ticket, _ = session_tickets.issue_ticket('u1', 'a@b.c', 'A')
+        with mock.patch.object(session_tickets.time, 'time', return_value=time.time() + session_tickets.TICKET_TTL + 1):
+            ok, reason = session_tickets.verify_ticket(ticket)[:2]
+        self.assertFalse(ok)
+        self.assertEqual(reason, 'invalid_ticket: expired')
+
+    def test_revoked_after_auth(self):
+        ticket, _ = session_tickets.issue_ticket('u1', 'a@b.c', 'A', auth_at=time.time() - 60)
+        self.states['u1'] = {'valid_after_ms': int(time.time() * 1000), 'disabled': False}
+        self.assertEqual(session_tickets.verify_ticket(ticket)[:2], (False, 'invalid_ticket: token revoked'))
+
+    def test_disabled_or_deleted(self):
+        ticket, _ = session_tickets.issue_ticket('u1', 'a@b.c', 'A')
+        for state in ({'valid_after_ms': 0, 'disabled': True}, {'missing': True}):
+            self.states['u1'] = state
+            self.assertEqual(session_tickets.verify_ticket(ticket)[:2], (False, 'invalid_ticket: user disabled'))
+
+    def test_failed_revocation_lookup_refuses(self):
+        ticket, _ = session_tickets.issue_ticket('u3', 'c@d.e', 'C')
+        ok, reason = session_tickets.verify_ticket(ticket)[:2]
+        self.assertFalse(ok)
+        self.assertEqual(reason, 'invalid_ticket: revocation check failed')
+        self.lookup.assert_called_with('u3')
+
+
+class RevocationStateTest(unittest.TestCase):
+
+    def test_cache_hit_and_miss(self):
+        from Server import firebase_admin_utils as fau
+        from Server.cache import revocation_cache
+        self.addCleanup(revocation_cache.invalidate, 'u9')
+        revocation_cache.set('u9', {'valid_after_ms': 5, 'disabled': False})
+        self.assertEqual(fau.revocation_state('u9'), {'valid_after_ms': 5, 'disabled': False})
+        revocation_cache.invalidate('u9')
+        with mock.patch.object(fau, '_FIREBASE_AVAILABLE', True), \
+                mock.patch.object(fau, 'init_firebase_if_needed'), \
+                mock.patch.object(fau, '_firebase_initialized', True), \
+                mock.patch.object(fau._revocations, 'get', return_value={'missing': True}) as lookup:
+            self.assertEqual(fau.revocation_state('u9'), {'missing': True})
+        lookup.assert_called_once_with('u9')
+        with mock.patch.object(fau, '_FIREBASE_AVAILABLE', False):
+            self.assertIsNone(fau.revocation_state('u9'))
+
+    def test_missing_user_is_cached_briefly(self):
+        from Server import firebase_admin_utils as fau
+        from Server.cache import revocation_cache
+        self.addCleanup(revocation_cache.invalidate, 'u1', 'u2')
+        record = mock.Mock(uid='u1', tokens_valid_after_timestamp=7, disabled=False)
+        fb_auth = mock.Mock()
+        fb_auth.get_users.return_value = mock.Mock(users=[record])
+        with mock.patch.object(fau, 'fb_auth', fb_auth), \
+                mock.patch.object(revocation_cache, 'set', wraps=revocation_cache.set) as cache_set:
+            fau.RevocationLookup()._lookup(['u1', 'u2'])
+        cache_set.assert_any_call('u1', {'valid_after_ms': 7, 'disabled': False})
+        cache_set.assert_any_call('u2', {'missing': True}, ttl=fau.AUTH_MISSING_TTL)
+
+
+if __name__ == '__main__':
+    unittest.main()
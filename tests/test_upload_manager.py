@@ -0,0 +1,94 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+try:
+    from PyQt5.QtCore import QObject, pyqtSignal
+    from Client import upload_manager
+except ImportError:
+    upload_manager = None
+
+
+@unittest.skipIf(upload_manager is None, 'PyQt5 is not installed')
+class ChooseUploadPathTest(unittest.TestCase):
+
+    def test_auto_prefers_direct_below_the_threshold(self):
+        choose = upload_manager.choose_upload_path
+        self.assertEqual(choose(10, True, True, mode='auto', chunked_min=0), 'direct')
+        self.assertEqual(choose(10, True, True, mode='auto', chunked_min=100), 'direct')
+        self.assertEqual(choose(100, True, True, mode='auto', chunked_min=100), 'chunked')
+
+    def test_auto_uses_chunked_without_direct_upload(self):
+        choose = upload_manager.choose_upload_path
+        self.assertEqual(choose(10, False, True, mode='auto', chunked_min=0), 'chunked')
+        self.assertIsNone(choose(10, False, False, mode='auto', chunked_min=0))
+
+    def test_forced_modes(self):
+        choose = upload_manager.choose_upload_path
+        self.assertEqual(choose(10, True, True, mode='chunked', chunked_min=0), 'chunked')
+        self.assertIsNone(choose(10, True, False, mode='chunked', chunked_min=0))
+        self.assertEqual(choose(10 ** 9, True, True, mode='direct', chunked_min=100), 'direct')
+
+
+if upload_manager is not None:
+    class FakeWorker(QObject):
+        started_jobs = []
+        progress = pyqtSignal(int, int, float)
+        finished = pyqtSignal()
+
+        def __init__(self, *args, **kwargs):
+            super().__init__()
+            self.args = args
+
+        def start(self):
+            FakeWorker.started_jobs.append(type(self).__name__)
+
+        def cancel(self):
+            pass
+
+    class FakeDirectWorker(FakeWorker):
+        uploaded = pyqtSignal(str, str)
+        upload_failed = pyqtSignal(str)
+
+    class FakeChunkWorker(FakeWorker):
+        upload_failed = pyqtSignal(str, str)
+
+
+@unittest.skipIf(upload_manager is None, 'PyQt5 is not installed')
+class DirectFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeWorker.started_jobs = []
+        for name, value in (('DirectUploadWorker', FakeDirectWorker), ('ChunkUploadWorker', FakeChunkWorker),
+                            ('UPLOAD_MODE', 'auto'), ('CHUNKED_MIN_BYTES', 0)):
+            patcher = mock.patch.object(upload_manager, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.manager = upload_manager.UploadManager(mock.Mock(), mock.Mock(), direct_upload=mock.Mock())
+        self.finished = []
+        self.manager.job_finished.connect(lambda cid, ok, error: self.finished.append((ok, error)))
+
+    def test_failed_direct_upload_is_sent_in_chunks(self):
+        cid = self.manager.enqueue(self.path, to_uid='u2')
+        self.manager._jobs[cid].worker.upload_failed.emit('storage unavailable')
+        self.assertEqual(FakeWorker.started_jobs, ['FakeDirectWorker', 'FakeChunkWorker'])
+        self.assertEqual(self.finished, [])
+        self.assertEqual(self.manager._running, 1)
+
+    def test_cancelled_direct_upload_is_not_retried(self):
+        cid = self.manager.enqueue(self.path, to_uid='u2')
+        self.manager._jobs[cid].worker.upload_failed.emit('cancelled')
+        self.assertEqual(FakeWorker.started_jobs, ['FakeDirectWorker'])
+        self.assertEqual(self.finished, [(False, 'cancelled')])
+        self.assertEqual(self.manager._running, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Server import upload_spool
+
+
+class ParkedUploadExpiryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spool_dir.cleanup)
+        for name, value in (('SPOOL_DIR', self.spool_dir.name), ('RESUME_TTL', -1.0),
+                            ('_start_sweeper', lambda: None)):
+            patcher = mock.patch.object(upload_spool, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def park(self):
+        conn = object()
+        spool = upload_spool.open_upload('c1', conn, 'u1', 'a.bin', 8, chunk_size=4,
+                                         to_uid='u2', conversation_id='t1', sha256='ab' * 32)
+        spool.write_chunk(0, b'1234')
+        upload_spool.drop_uploads(conn)
+        return spool
+
+    def test_stats_releases_expired_uploads(self):
+        spool = self.park()
+        self.assertTrue(os.path.exists(spool.path))
+        stats = upload_spool.stats()
+        self.assertEqual((stats['parked'], stats['inflight_bytes']), (0, 0))
+        self.assertFalse(os.path.exists(spool.path))
+
+    def test_sweeper_expires_without_new_uploads(self):
+        spool = self.park()
+        with mock.patch.object(upload_spool.time, 'sleep'):
+            upload_spool._sweep()
+        self.assertTrue(spool.closed)
+        self.assertIsNone(upload_spool._sweeper)
+
+
+if __name__ == '__main__':
+    unittest.main()